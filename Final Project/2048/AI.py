@@ -1,17 +1,39 @@
+import json
 import random
-from inspect import signature
+import functools
 from typing import Callable, Union
 
 import numpy as np
-import pygame
+
+import engine
+import kernels
+import instrument
+import zobrist
 
 _MOVES = ["Up", "Down", "Left", "Right"]
 
-_KEYMAP = {"Up": pygame.K_UP, "Down": pygame.K_DOWN, "Left": pygame.K_LEFT, "Right": pygame.K_RIGHT}
-_REVERSE_KEYMAP = {v: k for k, v in _KEYMAP.items()}
+# The expected value of a spawned tile
+_MEAN_SPAWN = 0.9 * 2 + 0.1 * 4
+
+
+def __getattr__(name):
+    # _KEYMAP and _REVERSE_KEYMAP map moves to pygame's key codes and back; like move_event, they import pygame on
+    # first use
+    if name in ["_KEYMAP", "_REVERSE_KEYMAP"]:
+        import pygame
+        keymap = {move: getattr(pygame, "K_" + move.upper()) for move in _MOVES}
+        globals().update(_KEYMAP=keymap, _REVERSE_KEYMAP={v: k for k, v in keymap.items()})
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 HEURISTICS = ["greedy", "safe", "safest", "monotonic", "smooth", "corner_dist", "expert"]
 
+# The constants of expert_score: (base score, tile penalty, empty cell bonus, merge bonus, monotonicity penalty,
+# tile penalty exponent, monotonicity exponent). See tune.py to tune them.
+DEFAULT_EXPERT_WEIGHTS = (1600000, 11, 540, 700, 47, 3.5, 4)
+EXPERT_WEIGHTS = DEFAULT_EXPERT_WEIGHTS
+
 
 class _Node(object):
     def __init__(self, parent=None):
@@ -24,14 +46,19 @@ class _Node(object):
 
 
 class StateNode(_Node):
-    def __init__(self, state: np.ndarray, parent=None):
+    def __init__(self, state: np.ndarray, parent=None, key=None):
         self.state = state
+        # The Zobrist hash of the state; computed here unless the caller derived it from the parent's
+        self.key = zobrist.hash_grid(state) if key is None else key
         self.moves = {}  # Maps hashes of moves ("Up", "Down",...) to MoveNodes
         self.unvisited = valid_moves(state)
         super(StateNode, self).__init__(parent=parent)
+        # The game score on reaching the state, which simulations from it start from; visit_score is the score of
+        # the last simulation through it
+        self.score = 0
 
     def __hash__(self):
-        return str(self.state.tolist()).__hash__()
+        return self.key
 
     def add_move(self, move):
         if hash(move) not in self.moves:
@@ -60,27 +87,65 @@ class StateNode(_Node):
         scores = np.array(scores)
         return moves[np.random.choice(np.flatnonzero(scores == scores.max()))]
 
+    def move_scores(self):
+        """Returns a dictionary mapping each explored move to its average score."""
+        return {v.move: v.avg_score for _, v in self.moves.items()}
+
 
 class MoveNode(_Node):
     def __init__(self, move: str, parent=None):
         self.move = move
-        self.states = {}  # Maps StateNode hashes to StateNodes
+        self.states = {}  # Maps the Zobrist hashes of StateNodes to StateNodes
+        self.draws = {}  # Maps the Zobrist hashes of StateNodes to the number of times their state was drawn
+        self.gained = 0  # The score gained by the move, which doesn't depend on the tile that spawns after it
         super(MoveNode, self).__init__(parent=parent)
 
     def __hash__(self):
         return self.move.__hash__()
 
-    def add_state(self, state: np.ndarray):
-        if hash(str(state.tolist())) not in self.states:
-            new_state = StateNode(state, self)
+    def add_state(self, state: np.ndarray, key=None):
+        """
+        Add a resulting state if it isn't a child yet.
+
+        :param key: The Zobrist hash of the state, if already known
+        :return: The StateNode of the state
+        """
+        if key is None:
+            key = zobrist.hash_grid(state)
+        if key not in self.states:
+            instrument.count("mcts.new_nodes")
+            new_state = StateNode(state, self, key)
             new_state.depth = self.depth + 1
-            self.states.update({new_state.__hash__(): new_state})
+            self.states.update({key: new_state})
+        self.draws[key] = self.draws.get(key, 0) + 1
+        return self.states[key]
+
+    def can_widen(self, widening_exponent=None, widening_constant=1.0):
+        """
+        Whether a new tile spawn should be drawn for this move, under progressive widening: a move visited n times
+        has at most max(1, widening_constant * n ** widening_exponent) resulting states. Every spawn is drawn if
+        widening_exponent is None.
+        """
+        if widening_exponent is None:
+            return True
+        return len(self.states) < max(1, widening_constant * self.num_visits ** widening_exponent)
+
+    def sample_state(self):
+        """Choose one of the resulting states, each as often as it was drawn."""
+        keys = list(self.draws)
+        return self.states[random.choices(keys, weights=[self.draws[key] for key in keys])[0]]
 
 
 class GameTree(object):
     def __init__(self, grid: np.ndarray, max_search_depth=10, num_rollouts=100, epsilon=0, UCT=False,
-                 use_expert_score=False):
+                 use_expert_score=False, evaluate=None, budget=None, widening=None, widening_constant=1.0):
+        """
+        :param widening: The exponent of progressive widening of tile spawns (see MoveNode.can_widen), or None to
+                         add every spawn drawn to the tree
+        :param widening_constant: The constant of progressive widening
+        """
         self.root = StateNode(np.copy(grid))
+        self.zobrist = zobrist.table(grid.shape)
         self.cur_node = self.root
         self.max_search_depth = max_search_depth
         self.num_rollouts = num_rollouts
@@ -89,18 +154,37 @@ class GameTree(object):
         self.last_move = None
         self.max_score = 0
         self.use_expert_score = use_expert_score
+        self.evaluate = evaluate
+        self.widening = widening
+        self.widening_constant = widening_constant
+        # An optional budget policy (see budget.py), which sets the depth and rollouts of each search
+        self.budget = budget
         super(GameTree, self).__init__()
 
+    def _leaf_score(self, grid: np.ndarray, score):
+        return _leaf_score(grid, score, self.use_expert_score, self.evaluate)
+
     def MCTS(self, cur_grid: np.ndarray, cur_score, heuristic_type=None):
+        """Search the tree from a grid, returning the chosen move as a KEYDOWN event."""
+        return move_event(self.search(cur_grid, cur_score, heuristic_type))
+
+    @instrument.timed("mcts")
+    def search(self, cur_grid: np.ndarray, cur_score, heuristic_type=None):
+        """Search the tree from a grid, returning the chosen move."""
 
         if self.last_move is not None:
             # If this isn't our first search, update our current position in the tree (else we start at the root)
-            self.cur_node.moves[hash(self.last_move)].add_state(cur_grid)
-            self.cur_node = self.cur_node.moves[hash(self.last_move)].states[hash(str(cur_grid.tolist()))]
-            self.cur_node.visit_score = expert_score(cur_grid) if self.use_expert_score else cur_score
+            self.cur_node = self.cur_node.moves[hash(self.last_move)].add_state(
+                cur_grid, self.zobrist.hash(cur_grid))
+        self.cur_node.score = cur_score
+        self.cur_node.visit_score = self._leaf_score(cur_grid, cur_score)
+
+        if self.budget is not None:
+            self.max_search_depth, self.num_rollouts = self.budget(self.cur_node.state)
 
         moves = valid_moves(self.cur_node.state)
         search_node = self.cur_node
+        simulated = 0
 
         for move in moves:
             for _ in range(self.num_rollouts):
@@ -108,7 +192,7 @@ class GameTree(object):
                     if d == 0:
                         new_move = move
                     else:
-                        if len(valid_moves(search_node.state)) == 0:
+                        if not engine.move_mask(search_node.state):
                             break
                         # Choose a move
                         else:
@@ -121,11 +205,10 @@ class GameTree(object):
                                     new_move = search_node.select_next_move(self.max_score)
                             else:
                                 if random.random() < self.epsilon or heuristic_type is None:
-                                    new_move = _REVERSE_KEYMAP[random_move_event(search_node.state).dict["key"]]
+                                    new_move = random_move(search_node.state)
                                 else:
                                     if len(search_node.moves) == 0:
-                                        new_move = _REVERSE_KEYMAP[heuristic_move_event(search_node.state,
-                                                                                        heuristic_type).dict["key"]]
+                                        new_move = heuristic_move(search_node.state, heuristic_type)
                                     else:
                                         new_move = search_node.get_best_move()
 
@@ -133,13 +216,19 @@ class GameTree(object):
                     search_node.add_move(new_move)
                     move_node = search_node.moves[hash(new_move)]
 
-                    # Simulate move
-                    new_state, new_score = simulate_move(search_node.state, new_move, search_node.visit_score)
-                    new_score = expert_score(new_state) if self.use_expert_score else new_score
-                    move_node.add_state(new_state)
-                    search_node = move_node.states[hash(str(new_state.tolist()))]
-                    search_node.visit_score = new_score
-                    self.max_score = max(self.max_score, new_score)
+                    # Simulate move, or revisit a known tile spawn once the move has as many as it may have
+                    if move_node.can_widen(self.widening, self.widening_constant):
+                        new_state, new_score = simulate_move(search_node.state, new_move, search_node.score)
+                        move_node.gained = new_score - search_node.score
+                        search_node = move_node.add_state(
+                            new_state, self.zobrist.hash(new_state))
+                    else:
+                        new_score = search_node.score + move_node.gained
+                        search_node = move_node.sample_state()
+                    search_node.score = new_score
+                    simulated += 1
+                    search_node.visit_score = self._leaf_score(search_node.state, new_score)
+                    self.max_score = max(self.max_score, search_node.visit_score)
 
                 # All moves simulated; do backup
                 while search_node != self.cur_node:
@@ -149,7 +238,9 @@ class GameTree(object):
                     search_node.num_visits += 1
                     parent_move = search_node.parent
                     parent_move.visit_score = search_node.visit_score
-                    parent_move.avg_score = search_node.avg_score
+                    # A move's score averages over the tiles that spawned after it, not just the last one
+                    parent_move.avg_score = parent_move.avg_score + (
+                            parent_move.visit_score - parent_move.avg_score) / (parent_move.num_visits + 1)
                     parent_move.num_visits += 1
                     search_node = parent_move.parent
                     search_node.visit_score = parent_move.visit_score
@@ -159,42 +250,105 @@ class GameTree(object):
                         search_node.num_visits + 1)
                 search_node.num_visits += 1
 
+        instrument.count("mcts.rollouts", self.num_rollouts * len(moves))
+        instrument.count("mcts.nodes", simulated)
+
         # Choose best move
         self.last_move = self.cur_node.get_best_move()
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[self.last_move]})
+        return self.last_move
 
 
-def rollouts(grid: np.ndarray, score, heuristic_type=None, max_search_depth=10, num_rollouts=100, epsilon=0,
-             use_expert_score=False, hotfix=True):
+def _leaf_score(grid: np.ndarray, score, use_expert_score=False, evaluate=None):
+    """
+    Score the grid reached by a simulation: the game score plus evaluate(grid), an estimate of the score still to
+    come, if an evaluation function is supplied, else the expert score if requested, else the game score.
+    """
+    if evaluate is not None:
+        return score + evaluate(grid)
+    return expert_score(grid) if use_expert_score else score
+
+
+@instrument.timed("rollout")
+def rollout_move_scores(grid: np.ndarray, score, heuristic_type=None, max_search_depth=10, num_rollouts=100,
+                        epsilon=0, use_expert_score=False, evaluate=None, budget=None, common_random_numbers=False,
+                        control_variate=False, bootstrap=False):
+    """
+    Estimate the value of every valid move from 'grid' by averaging the outcome of random or heuristic-guided
+    rollouts. Rollouts are scored by _leaf_score.
+
+    :param budget: An optional budget policy (see budget.py), which overrides max_search_depth and num_rollouts
+    :param common_random_numbers: Whether the i-th rollout of every move draws the same random numbers, for its
+                                  spawns, random moves and the heuristic's tie-breaks, so that the moves are
+                                  compared on the same luck
+    :param control_variate: Whether to take out of the average the part of the outcomes explained by how many 4s
+                            were spawned, whose expected value is known
+    :param bootstrap: Whether rollouts end on the afterstate of their last move, before its tile spawns, which is
+                      what n-tuple networks evaluate (see ntuple.py). With an evaluation function, rollouts can then
+                      be cut short, e.g. to a max_search_depth of 1 or 2.
+    :return: A tuple of (moves, move_scores), where move_scores[i] is the average rollout score of moves[i].
+    """
+    if budget is not None:
+        max_search_depth, num_rollouts = budget(grid)
     moves = valid_moves(grid)
-    move_visits = [0] * len(moves)
-    move_scores = [0] * len(moves)
+    simulated = 0
+    if (kernels.ENABLED and heuristic_type is None and evaluate is None and not
+            (common_random_numbers or control_variate or bootstrap)):
+        # Random-policy rollouts run entirely in compiled code
+        move_scores = [0] * len(moves)
+        for move in range(len(moves)):
+            move_scores[move], move_simulated = kernels.rollouts(grid, score, moves[move], max_search_depth,
+                                                                 num_rollouts, use_expert_score, EXPERT_WEIGHTS)
+            simulated += move_simulated
+        instrument.count("rollout.rollouts", num_rollouts * len(moves))
+        instrument.count("rollout.nodes", simulated)
+        return moves, np.array(move_scores)
+
+    seeds = [random.getrandbits(64) for _ in range(num_rollouts)] if common_random_numbers else None
+    outcomes = np.zeros((len(moves), num_rollouts))
+    # The sum over each rollout's spawns of the spawned tile less its expected value
+    spawn_excess = np.zeros((len(moves), num_rollouts))
     for move in range(len(moves)):
-        avg_score = 0
-        for _ in range(num_rollouts):
+        for rollout in range(num_rollouts):
+            rng = random if seeds is None else random.Random(seeds[rollout])
+            new_grid, new_score = grid, score
             for d in range(max_search_depth + 1):
                 if d == 0:
-                    new_grid, new_score = simulate_move(grid, moves[move], score)
+                    new_move = moves[move]
                 else:
-                    if len(valid_moves(new_grid)) == 0:
+                    if not engine.move_mask(new_grid):
                         break
-                    if random.random() < epsilon or heuristic_type is None:
-                        new_move = _REVERSE_KEYMAP[random_move_event(new_grid).dict["key"]]
+                    if rng.random() < epsilon or heuristic_type is None:
+                        new_move = _choice(valid_moves(new_grid), rng)
                     else:
-                        new_move = _REVERSE_KEYMAP[heuristic_move_event(new_grid, heuristic_type).dict["key"]]
+                        new_move = heuristic_move(new_grid, heuristic_type, rng)
+                new_grid, new_score = quick_merge(new_grid, new_move, new_score)
+                simulated += 1
+                if bootstrap and d == max_search_depth:
+                    break
+                spawn_excess[move, rollout] += _spawn(new_grid, rng) - _MEAN_SPAWN
+            outcomes[move, rollout] = _leaf_score(new_grid, new_score, use_expert_score, evaluate)
+    instrument.count("rollout.rollouts", num_rollouts * len(moves))
+    instrument.count("rollout.nodes", simulated)
+    move_scores = outcomes.mean(axis=1)
+    if control_variate and num_rollouts > 1:
+        # The regression coefficient of the outcomes on the spawn excess, pooled over the moves
+        centred_outcomes = outcomes - move_scores[:, None]
+        centred_excess = spawn_excess - spawn_excess.mean(axis=1)[:, None]
+        variance = np.sum(centred_excess ** 2)
+        if variance > 0:
+            move_scores -= np.sum(centred_outcomes * centred_excess) / variance * spawn_excess.mean(axis=1)
+    return moves, move_scores
 
-                    new_grid, new_score = simulate_move(new_grid, new_move, new_score)
-            if use_expert_score:
-                avg_score = avg_score + (expert_score(new_grid) - avg_score) / (move_visits[move] + 1)
-            else:
-                avg_score = avg_score + (new_score - avg_score) / (move_visits[move] + 1)
-            move_visits[move] += 1
-            if hotfix:
-                new_grid, new_score = new_grid, new_score
-        move_scores[move] = avg_score
-    move_scores = np.array(move_scores)
-    return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[moves[np.random.choice(
-        np.flatnonzero(move_scores == move_scores.max()))]]})
+
+def rollouts(grid: np.ndarray, score, heuristic_type=None, max_search_depth=10, num_rollouts=100, epsilon=0,
+             use_expert_score=False, hotfix=True, evaluate=None, budget=None, common_random_numbers=False,
+             control_variate=False, bootstrap=False):
+    moves, move_scores = rollout_move_scores(grid, score, heuristic_type, max_search_depth=max_search_depth,
+                                             num_rollouts=num_rollouts, epsilon=epsilon,
+                                             use_expert_score=use_expert_score, evaluate=evaluate, budget=budget,
+                                             common_random_numbers=common_random_numbers,
+                                             control_variate=control_variate, bootstrap=bootstrap)
+    return move_event(moves[np.random.choice(np.flatnonzero(move_scores == move_scores.max()))])
 
 
 def _get_merge_directions(grid: np.ndarray):
@@ -208,9 +362,9 @@ def _get_merge_directions(grid: np.ndarray):
         if row.size >= 2:
             for i in range(row.size):
                 value = row[i]
-                if i > 0 and inds[i] % grid.shape[0] != 0 and row[i - 1] == value:  # Left
+                if i > 0 and inds[i] % grid.shape[1] != 0 and row[i - 1] == value:  # Left
                     move_list[inds[i]].append("Left")
-                if i < row.size - 1 and (inds[i] + 1) % grid.shape[0] != 0 and row[i + 1] == value:  # Right
+                if i < row.size - 1 and (inds[i] + 1) % grid.shape[1] != 0 and row[i + 1] == value:  # Right
                     move_list[inds[i]].append("Right")
 
     for c in range(grid.shape[1]):
@@ -220,15 +374,15 @@ def _get_merge_directions(grid: np.ndarray):
         if col.size >= 2:
             for i in range(col.size):
                 value = col[i]
-                if i > 0 and inds[i] % grid.shape[1] != 0 and col[i - 1] == value:  # Up
+                if i > 0 and col[i - 1] == value:  # Up
                     move_list[inds[i]].append("Up")
-                if i < col.size - 1 and (inds[i] + 1) % grid.shape[1] != 0 and col[i + 1] == value:  # Down
+                if i < col.size - 1 and col[i + 1] == value:  # Down
                     move_list[inds[i]].append("Down")
 
     return move_list
 
 
-def _heuristic_choose_direction(moves: list, heuristic_type="greedy"):
+def _heuristic_choose_direction(moves: list, heuristic_type="greedy", rng=random):
     """
     Given a list of possible merge directions, chooses a direction to move. Heuristic type 1 picks any possible
     merge; heuristic type 2 prioritizes moving to the bottom right, since grouping the largest tiles is an effective
@@ -236,25 +390,37 @@ def _heuristic_choose_direction(moves: list, heuristic_type="greedy"):
 
     :param moves: A list of possible merge directions from _get_merge_directions
     :param heuristic_type: The heuristic type to use. See the README for more info.
+    :param rng: The source of random numbers for ties, as in _choice
     :return: A direction, either "Up", "Down", "Left", or "Right", or False if no merges are possible.
     """
     if len(moves) == 0:
         return False
     elif heuristic_type == "greedy":
-        return random.choice(moves)
+        return _choice(moves, rng)
     else:
         if "Down" in moves:
             if "Right" in moves:
-                return random.choice(["Down", "Right"])
+                return _choice(["Down", "Right"], rng)
             return "Down"
         elif "Right" in moves:
             return "Right"
         else:
-            return random.choice(moves)
+            return _choice(moves, rng)
+
+
+def move_event(move: str):
+    """The KEYDOWN event of a move, as the game takes it. pygame is imported here, on first use, so that searches
+    and headless games don't load it."""
+    import pygame
+    return pygame.event.Event(pygame.KEYDOWN, {"key": getattr(pygame, "K_" + move.upper())})
+
+
+def random_move(grid: np.ndarray):
+    return random.choice(valid_moves(grid))
 
 
 def random_move_event(grid: np.ndarray):
-    return pygame.event.Event(pygame.KEYDOWN, {"key": random.choice([_KEYMAP[move] for move in valid_moves(grid)])})
+    return move_event(random_move(grid))
 
 
 def quick_merge_row(row, right=True, old_score=None, count_merges=False):
@@ -271,6 +437,8 @@ def quick_merge_row(row, right=True, old_score=None, count_merges=False):
     :return: The merged row if old_score is None; else a tuple of (merged_row, new_score), (merged_row, merge_count), or
              (merged_row, new_score, merge_count), depending on the supplied parameters.
     """
+    if kernels.ENABLED:
+        return kernels.quick_merge_row(row, right, old_score, count_merges)
     if right:
         row = row[::-1]
     values = []
@@ -300,6 +468,8 @@ def quick_merge_row(row, right=True, old_score=None, count_merges=False):
 
 
 def quick_merge(grid: np.ndarray, direction: str, cur_score=None, count_merges=False):
+    if kernels.ENABLED:
+        return kernels.quick_merge(grid, direction, cur_score, count_merges)
     merged = grid.copy()
     count = 0
     if direction in ["Up", "Down"]:
@@ -338,19 +508,37 @@ def quick_merge(grid: np.ndarray, direction: str, cur_score=None, count_merges=F
 
 def simulate_move(grid: np.ndarray, direction: str, cur_score):
     grid, new_score = quick_merge(grid, direction, cur_score)
+    _spawn(grid)
+    return grid, new_score
+
+
+def _choice(options, rng=random):
+    """
+    A random option. With an rng other than the random module, exactly one number is drawn, so that streams of
+    common random numbers stay in step whatever the number of options.
+    """
+    if rng is random:
+        return random.choice(options)
+    return options[int(rng.random() * len(options))]
+
+
+def _spawn(grid: np.ndarray, rng=random):
+    """Spawn a 2 or a 4 on a random empty cell of 'grid', in place, returning the tile, or _MEAN_SPAWN if it's full."""
     r, c = np.where(grid == 0)
     if len(r) > 0 and len(c) > 0:
-        i = random.choice(range(len(r)))
-        grid[r[i], c[i]] = 2 if random.random() < 0.9 else 4
-    return grid, new_score
+        i = _choice(range(len(r)), rng)
+        grid[r[i], c[i]] = tile = 2 if rng.random() < 0.9 else 4
+        return tile
+    return _MEAN_SPAWN
 
 
 def is_valid_move(grid: np.ndarray, direction: str):
-    return ~np.all(grid == quick_merge(grid, direction))
+    return bool(engine.move_mask(grid) >> _MOVES.index(direction) & 1)
 
 
 def valid_moves(grid: np.ndarray):
-    return [move for move in _MOVES if is_valid_move(grid, move)]
+    mask = engine.move_mask(grid)
+    return [move for i, move in enumerate(_MOVES) if mask >> i & 1]
 
 
 def is_safe_move(grid: np.ndarray, direction: str):
@@ -366,7 +554,7 @@ def safe_moves(grid: np.ndarray):
 def choose_move(grid: np.ndarray, moves: list, eval_func: Union[Callable[[np.ndarray], Union[int, float, complex]],
                                                                 Callable[[np.ndarray, np.ndarray],
                                                                              Union[int, float, complex]]],
-                compare_func=np.min):
+                compare_func=np.min, rng=random):
     """
     Choose a move to take based on an evaluation function. The move chosen will be the argmin of the function.
     :param grid: The current game grid
@@ -376,17 +564,28 @@ def choose_move(grid: np.ndarray, moves: list, eval_func: Union[Callable[[np.nda
                       new_grid) -> Number or eval_func(cur_grid, new_grid) -> Number.
     :param compare_func: The function used to compare the outputs of 'eval_func'. Choices are either numpy.min or
                          numpy.max.
+    :param rng: The source of random numbers for ties, as in _choice; with the random module, ties are broken with
+                numpy.random
     :return: The chosen move. This will be the argmin/argmax of 'eval_func' when it is evaluated for each move.
     """
     move_evals = []
     for move in moves:
         new_grid = quick_merge(grid, move)
-        if len(signature(eval_func).parameters) == 2:
+        if _num_required_args(eval_func) == 2:
             move_evals.append(eval_func(grid, new_grid))
         else:
             move_evals.append(eval_func(new_grid))
     move_evals = np.array(move_evals)
-    return moves[np.random.choice(np.flatnonzero(move_evals == compare_func(move_evals)))]
+    ties = np.flatnonzero(move_evals == compare_func(move_evals))
+    if rng is random:
+        return moves[np.random.choice(ties)]
+    return moves[_choice(ties.tolist(), rng)]
+
+
+@functools.lru_cache(maxsize=None)
+def _num_required_args(func):
+    from inspect import signature
+    return len([p for p in signature(func).parameters.values() if p.default is p.empty])
 
 
 def move_diff(cur_grid: np.ndarray, new_grid: np.ndarray):
@@ -394,101 +593,165 @@ def move_diff(cur_grid: np.ndarray, new_grid: np.ndarray):
 
 
 def smoothness(grid: np.ndarray):
-    return np.abs(grid[:-1, :] - grid[1:, :]).sum() + np.abs(grid[1:, :] - grid[:-1, :]).sum() + np.abs(
-        grid[:, :-1] - grid[:, 1:]).sum() + np.abs(grid[:, 1:] - grid[:, :-1]).sum()
+    """
+    Sum of absolute differences between neighbouring tiles. Accepts a single grid or a stack of grids of shape
+    (..., rows, columns), in which case one value is returned per grid.
+    """
+    return np.abs(grid[..., :-1, :] - grid[..., 1:, :]).sum(axis=(-2, -1)) + \
+        np.abs(grid[..., 1:, :] - grid[..., :-1, :]).sum(axis=(-2, -1)) + \
+        np.abs(grid[..., :, :-1] - grid[..., :, 1:]).sum(axis=(-2, -1)) + \
+        np.abs(grid[..., :, 1:] - grid[..., :, :-1]).sum(axis=(-2, -1))
 
 
 def monotonicity(grid: np.ndarray):
-    return np.sum((grid < np.roll(grid, 1, axis=0))[1:, :]) + np.sum((grid < np.roll(grid, 1, axis=1))[:, 1:])
+    """
+    Number of tiles smaller than the tile above or to the left of them. Accepts a single grid or a stack of grids.
+    """
+    return np.sum(grid[..., 1:, :] < grid[..., :-1, :], axis=(-2, -1)) + \
+        np.sum(grid[..., :, 1:] < grid[..., :, :-1], axis=(-2, -1))
 
 
 def dist_from_corner(grid: np.ndarray):
-    r, c = grid.nonzero()
-    return ((grid.shape[0] - 1 - r + grid.shape[1] - 1 - c) * grid[r, c]).sum()
+    """
+    Sum of tile_value x Manhattan_distance_from_bottom_right. Accepts a single grid or a stack of grids.
+    """
+    rows, cols = grid.shape[-2:]
+    dist = (rows - 1 - np.arange(rows))[:, np.newaxis] + (cols - 1 - np.arange(cols))[np.newaxis, :]
+    return (dist * grid).sum(axis=(-2, -1))
+
+
+def _line_merge_counts(lines: np.ndarray):
+    """
+    Count the merges quick_merge_row makes when each line of 'lines' (the last axis) is merged towards its end, i.e.
+    "Right" for rows and "Down" for columns. Like quick_merge_row, a freshly merged tile may merge again.
+    """
+    merges = np.zeros(lines.shape[:-1], dtype=int)
+    last = np.zeros(lines.shape[:-1], dtype=lines.dtype)
+    for i in range(lines.shape[-1] - 1, -1, -1):
+        n = lines[..., i]
+        merged = (n != 0) & (n == last)
+        merges += merged
+        last = np.where(merged, 2 * last, np.where(n != 0, n, last))
+    return merges
 
 
-def expert_score(grid: np.ndarray):
+def set_expert_weights(weights=None):
+    """Set the constants used by expert_score, or restore the defaults if 'weights' is None."""
+    global EXPERT_WEIGHTS
+    EXPERT_WEIGHTS = DEFAULT_EXPERT_WEIGHTS if weights is None else tuple(weights)
+
+
+def load_expert_weights(path):
+    """Set the constants used by expert_score from a JSON list, as written by tune.py."""
+    with open(path) as f:
+        set_expert_weights(json.load(f))
+
+
+def expert_score(grid: np.ndarray, weights=None):
+    """
+    The "expert" evaluation. Accepts a single grid or a stack of grids of shape (..., rows, columns), in which case
+    one score is returned per grid.
+
+    :param weights: The constants of the evaluation, as in DEFAULT_EXPERT_WEIGHTS; EXPERT_WEIGHTS if not supplied
+    """
+    base, tile_weight, empty_weight, merge_weight, monotonicity_weight, tile_exponent, monotonicity_exponent = \
+        EXPERT_WEIGHTS if weights is None else weights
+    if kernels.ENABLED and np.ndim(grid) == 2:
+        return kernels.expert_score(grid, EXPERT_WEIGHTS if weights is None else weights)
     pow_grid = np.log2(grid, out=np.zeros_like(grid), where=(grid != 0), casting='unsafe')
-    heuristic_score = 1600000
-    heuristic_score -= np.sum(pow_grid ** 3.5) * 11
-    heuristic_score += np.count_nonzero(grid == 0) * 540
+    heuristic_score = base
+    heuristic_score -= np.sum(pow_grid ** tile_exponent, axis=(-2, -1)) * tile_weight
+    heuristic_score += np.count_nonzero(grid == 0, axis=(-2, -1)) * empty_weight
 
-    _, merge_count = quick_merge(grid, "Right", count_merges=True)
-    _, new_count = quick_merge(grid, "Down", count_merges=True)
-    merge_count += new_count
-    heuristic_score += merge_count * 700
+    # quick_merge(..., count_merges=True) reports the count of the last line it merges, so only the bottom row
+    # ("Right") and the rightmost column ("Down") contribute.
+    merge_count = _line_merge_counts(grid[..., -1, :]) + _line_merge_counts(grid[..., :, -1])
+    heuristic_score += merge_count * merge_weight
 
-    left_mask = pow_grid[:, :-1] > pow_grid[:, 1:]
-    top_mask = pow_grid[:-1, :] > pow_grid[1:, :]
+    mono_grid = pow_grid ** monotonicity_exponent
+    left_diff = mono_grid[..., :, :-1] - mono_grid[..., :, 1:]
+    top_diff = mono_grid[..., :-1, :] - mono_grid[..., 1:, :]
+    left_mask = pow_grid[..., :, :-1] > pow_grid[..., :, 1:]
+    top_mask = pow_grid[..., :-1, :] > pow_grid[..., 1:, :]
 
-    horizontal_monotonicity = np.min([np.sum(pow_grid[:, :-1][left_mask] ** 4 - pow_grid[:, 1:][left_mask] ** 4),
-                                      np.sum(pow_grid[:, 1:][~left_mask] ** 4 - pow_grid[:, :-1][~left_mask] ** 4)])
+    horizontal_monotonicity = np.minimum(np.sum(np.where(left_mask, left_diff, 0), axis=(-2, -1)),
+                                         np.sum(np.where(~left_mask, -left_diff, 0), axis=(-2, -1)))
 
-    vertical_monotonicity = np.min([np.sum(pow_grid[:-1, :][top_mask] ** 4 - pow_grid[1:, :][top_mask] ** 4),
-                                    np.sum(pow_grid[1:, :][~top_mask] ** 4 - pow_grid[:-1, :][~top_mask] ** 4)])
+    vertical_monotonicity = np.minimum(np.sum(np.where(top_mask, top_diff, 0), axis=(-2, -1)),
+                                       np.sum(np.where(~top_mask, -top_diff, 0), axis=(-2, -1)))
 
-    heuristic_score -= (horizontal_monotonicity + vertical_monotonicity) * 47
+    heuristic_score -= (horizontal_monotonicity + vertical_monotonicity) * monotonicity_weight
 
     return heuristic_score
 
 
-def heuristic_move_event(grid: np.ndarray, heuristic_type="greedy"):
+@instrument.timed("heuristic")
+def heuristic_move(grid: np.ndarray, heuristic_type="greedy", rng=random):
+    """
+    The move a heuristic would make.
+
+    :param heuristic_type: The heuristic type to use. See the README for more info.
+    :param rng: The source of random numbers for ties, as in _choice, e.g. the seeded stream of a rollout
+    """
     if heuristic_type in ["greedy", "safe", "safest"]:
-        moves = [_heuristic_choose_direction(move, heuristic_type) for move in _get_merge_directions(grid)]
+        moves = [_heuristic_choose_direction(move, heuristic_type, rng) for move in _get_merge_directions(grid)]
         moves = np.array(moves)
         inds = grid.argsort(axis=None)[::-1]
         cell_move_priority = inds[grid.flatten()[inds] != 0]
         for move_ind in cell_move_priority:
             if moves[move_ind] == "Up":
                 if heuristic_type == "greedy":
-                    return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_UP})
+                    return "Up"
                 else:
                     # If up is an option, there is a companion tile that can merge down
-                    return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_DOWN})
+                    return "Down"
             elif moves[move_ind] == "Down":
-                return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_DOWN})
+                return "Down"
             elif moves[move_ind] == "Left":
                 if heuristic_type == "greedy":
-                    return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_LEFT})
+                    return "Left"
                 else:
                     # If left is an option, there is a companion tile that can merge right
-                    return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_RIGHT})
+                    return "Right"
             elif moves[move_ind] == "Right":
-                return pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_RIGHT})
+                return "Right"
 
         if heuristic_type == "safe":
             valid = valid_moves(grid)
             safe = safe_moves(grid)
             if safe:
-                return pygame.event.Event(pygame.KEYDOWN, {"key": random.choice([_KEYMAP[move] for move in safe])})
+                return _choice(safe, rng)
             else:
-                return pygame.event.Event(pygame.KEYDOWN, {"key": random.choice([_KEYMAP[move] for move in valid])})
+                return _choice(valid, rng)
 
         elif heuristic_type == "safest":
             valid = valid_moves(grid)
             safe = safe_moves(grid)
             if safe:
-                return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, safe, move_diff)]})
+                return choose_move(grid, safe, move_diff, rng=rng)
             else:
-                return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, valid, move_diff)]})
+                return choose_move(grid, valid, move_diff, rng=rng)
 
         else:
-            return pygame.event.Event(pygame.KEYDOWN,
-                                      {"key": random.choice([_KEYMAP[move] for move in valid_moves(grid)])})
+            return _choice(valid_moves(grid), rng)
 
     elif heuristic_type == "monotonic":
         valid = valid_moves(grid)
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, valid, monotonicity)]})
+        return choose_move(grid, valid, monotonicity, rng=rng)
 
     elif heuristic_type == "smooth":  # Smooth
         valid = valid_moves(grid)
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, valid, smoothness)]})
+        return choose_move(grid, valid, smoothness, rng=rng)
 
     elif heuristic_type == "corner_dist":
         grid = np.array(grid)
         valid = valid_moves(grid)
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, valid, dist_from_corner)]})
+        return choose_move(grid, valid, dist_from_corner, rng=rng)
     else:  # Expert
         grid = np.array(grid)
         valid = valid_moves(grid)
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[choose_move(grid, valid, expert_score, np.max)]})
+        return choose_move(grid, valid, expert_score, np.max, rng)
+
+
+def heuristic_move_event(grid: np.ndarray, heuristic_type="greedy"):
+    return move_event(heuristic_move(grid, heuristic_type))
@@ -1,26 +1,113 @@
 import time
 import os
+import json
 import itertools
-
-import pandas as pd
-import openpyxl
+import statistics as stats
+from collections import defaultdict
 
 import AI
 from main import run_game
+from profiling import profile_call, format_buckets
+from instrument import PERCENTILES
+from utils import write_to_disk
+
+
+class Manifest(object):
+    def __init__(self, path):
+        """
+        A durable record of the finished work of a sweep: a JSON Lines file, appended to and synced to disk as each
+        game of a configuration finishes, and once the configuration's results are written.
+
+        :param path: The manifest file; its records are read if it exists
+        """
+        self.path = path
+        self.games = defaultdict(dict)
+        self.written = set()
+        complete = True
+        if os.path.isfile(path):
+            with open(path) as file:
+                for line in file:
+                    complete = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last record may be cut short by a crash
+                        continue
+                    if record["type"] == "game":
+                        self.games[record["config"]][record["game"]] = record
+                    elif record["type"] == "written":
+                        self.written.add(record["config"])
+        self._file = open(path, 'a')
+        if not complete:
+            # The last record was cut short; start a new line after it
+            self._file.write("\n")
+
+    @staticmethod
+    def key(opts: dict):
+        """The key of a configuration in the manifest."""
+        return json.dumps(opts, sort_keys=True, default=str)
+
+    def add_game(self, config, game, seed, result):
+        """Record that game number 'game' of a configuration, played with 'seed', finished with 'result'."""
+        record = {"type": "game", "config": config, "game": game, "seed": seed, "result": result}
+        self.games[config][game] = record
+        self._append(record)
+
+    def add_written(self, config):
+        """Record that a configuration's results were written."""
+        self.written.add(config)
+        self._append({"type": "written", "config": config})
+
+    def _append(self, record):
+        self._file.write(json.dumps(record, default=float) + "\n")
+        write_to_disk(self._file)
 
+    def close(self):
+        self._file.close()
 
-def simulate_config(**kwargs):
+
+def _config_results(games: dict):
+    """The results of a configuration, as returned by run_game, from its records in a manifest."""
+    results = [games[game]["result"] for game in sorted(games)]
+    game_scores = [result["score"] for result in results]
+    best_tiles = [result["best_tile"] for result in results]
+    moves = sum(result["moves"] for result in results)
+    config_results = {
+        "game_scores": game_scores,
+        "best_tiles": best_tiles,
+        "max_score": max(game_scores),
+        "max_tile": max(best_tiles),
+        "avg_score": stats.mean(game_scores),
+        "avg_move_time": sum(result["move_seconds"] for result in results) / moves if moves else 0.0
+    }
+    for name in ["p%d_move_ms" % p for p in PERCENTILES] + ["nodes_per_second"]:
+        config_results[name] = [result[name] for result in results]
+    return config_results
+
+
+def simulate_config(profile=None, profile_output="profile", **kwargs):
     kwargs["simulate"] = True
     start_time = time.time()
-    results = run_game(**kwargs)
+    if profile:
+        results, buckets = profile_call(run_game, profiler=profile, output=profile_output, **kwargs)
+        print(format_buckets(buckets))
+        results.update(("profile " + bucket, seconds) for bucket, seconds in buckets.items())
+    else:
+        results = run_game(**kwargs)
     end_time = time.time()
     print("total seconds for the simulation:", int(end_time - start_time))
     return results
 
 
-def _write_to_excel(results: pd.DataFrame, fname: str, sheet_name: str):
+def _write_to_excel(results: "pd.DataFrame", fname: str, sheet_name: str):
+    import pandas as pd
+    import openpyxl
+
     if os.path.isfile(fname):
         book = openpyxl.load_workbook(fname)
+        # A sweep that stopped before recording a write in its manifest writes the sheet again
+        if sheet_name in book.sheetnames:
+            book.remove(book[sheet_name])
         w = pd.ExcelWriter(fname, engine='openpyxl', mode='a')
         w.book = book
         w.sheets = dict((ws.title, ws) for ws in book.worksheets)
@@ -30,30 +117,38 @@ def _write_to_excel(results: pd.DataFrame, fname: str, sheet_name: str):
         results.to_excel(writer, sheet_name)
 
 
-def simulate(AI_type="heuristic", num_iterations=30, outfile="simulation.xlsx", **kwargs):
+# Short names of the parameters and values of a configuration, for sheet names
+SHORT_NAMES = {
+    "AI_type": '',
+    "num_games": 'n=',
+    "max_depth": 'd=',
+    "num_rollouts": 'r=',
+    "epsilon": 'e=',
+    "UCT": 'U=',
+    "type": 't=',
+    "greedy": "grdy",
+    "safe": "sf",
+    "safest": "sfst",
+    "monotonic": "mn",
+    "smooth": "smth",
+    "corner_dist": "c_d",
+    "random": "rnd",
+    "rollout": "roll",
+    'True': 'T',
+    'False': 'F',
+    'None': 'rnd',
+    "use_expert": 'UE'
+}
+
+
+def sweep_configs(AI_type="heuristic", num_iterations=30, **kwargs):
+    """
+    The configurations of a sweep: every combination of a grid of AI parameters.
 
+    :param kwargs: Lists of values of AI parameters, overriding the default grid
+    :return: A list of dictionaries of AI parameters, each with its "AI_type" and "num_games"
+    """
     HEURISTICS = ["safest", "smooth", "monotonic"]
-    SHORT_NAMES = {
-        "AI_type": '',
-        "num_games": 'n=',
-        "max_depth": 'd=',
-        "num_rollouts": 'r=',
-        "epsilon": 'e=',
-        "UCT": 'U=',
-        "type": 't=',
-        "greedy": "grdy",
-        "safe": "sf",
-        "safest": "sfst",
-        "monotonic": "mn",
-        "smooth": "smth",
-        "corner_dist": "c_d",
-        "random": "rnd",
-        "rollout": "roll",
-        'True': 'T',
-        'False': 'F',
-        'None': 'rnd',
-        "use_expert": 'UE'
-    }
 
     params = {
         "AI_type": [AI_type],
@@ -78,20 +173,84 @@ def simulate(AI_type="heuristic", num_iterations=30, outfile="simulation.xlsx",
 
     vars = params.keys()
     vals = params.values()
+    return [dict(zip(vars, val_combo)) for val_combo in itertools.product(*vals)]
+
+
+def sheet_name(opts: dict):
+    """The name of a configuration's sheet."""
+    name = ''
+    for opt in opts:
+        name += SHORT_NAMES[opt] + \
+                (SHORT_NAMES[str(opts[opt])] if str(opts[opt]) in SHORT_NAMES else str(opts[opt])) + ','
+    return name[:-1]
+
+
+def default_manifest(outfile):
+    return os.path.splitext(outfile)[0] + ".manifest.jsonl"
+
+
+def write_config(manifest: Manifest, opts: dict, outfile, extra_results=None):
+    """
+    Write the results of a configuration, all of whose games are in a manifest, to its sheet of 'outfile', and record
+    that it was written.
+
+    :param extra_results: If supplied, a dictionary of more columns of the results
+    """
+    # Reporting needs pandas, which is only imported here
+    import pandas as pd
+
+    config = Manifest.key(opts)
+    results = _config_results(manifest.games[config])
+    results.update(extra_results or {})
+    results.update(opts)
+    _write_to_excel(pd.DataFrame(results), outfile, sheet_name(opts))
+    manifest.add_written(config)
+
+
+def simulate(AI_type="heuristic", num_iterations=30, outfile="simulation.xlsx", profile=None, manifest=None, seed=0,
+             **kwargs):
+    """
+    Play every combination of a grid of AI parameters, writing each one's results to a sheet of 'outfile'.
+
+    Every finished game is recorded in a manifest, so that a sweep that is stopped can be run again with the same
+    arguments to carry on: configurations whose results were written are skipped, and only the games a
+    configuration has left are played.
+
+    :param manifest: The manifest file; by default, 'outfile' with the extension ".manifest.jsonl"
+    :param seed: Game i of every configuration is played with the seed seed + i
+    :param profile: If supplied, one of profiling.PROFILERS to run each combination under; its time per bucket is
+                    added to the results, and its profile written next to 'outfile', named after the sheet
+    :param kwargs: Lists of values of AI parameters, overriding the default grid
+    """
+    manifest = Manifest(manifest or default_manifest(outfile))
+    try:
+        for opts in sweep_configs(AI_type, num_iterations, **kwargs):
+            config = Manifest.key(opts)
+            if config in manifest.written:
+                print("Skipping finished configuration:", opts)
+                continue
+            print("Current Configuration:")
+            print(opts)
+
+            remaining = [game for game in range(opts["num_games"]) if game not in manifest.games[config]]
+            profile_results = {}
+            if remaining:
+                if len(remaining) < opts["num_games"]:
+                    print("Resuming with %d of %d games left" % (len(remaining), opts["num_games"]))
+                finished = iter(remaining)
+
+                def on_game_end(result):
+                    game = next(finished)
+                    manifest.add_game(config, game, seed + game, result)
 
-    for val_combo in itertools.product(*vals):
-        opts = dict(zip(vars, val_combo))
-        print("Current Configuration:")
-        print(opts)
-        results = simulate_config(**opts)
-        results.update(opts)
-        df = pd.DataFrame(results)
-        sheet_name = ''
-        for opt in opts:
-            sheet_name += SHORT_NAMES[opt] + \
-                          (SHORT_NAMES[str(opts[opt])] if str(opts[opt]) in SHORT_NAMES else str(opts[opt])) + ','
-        sheet_name = sheet_name[:-1]
-        _write_to_excel(df, outfile, sheet_name)
+                profile_results = simulate_config(
+                    profile=profile, profile_output=os.path.splitext(outfile)[0] + '_' + sheet_name(opts),
+                    seeds=[seed + game for game in remaining], on_game_end=on_game_end,
+                    **dict(opts, num_games=len(remaining)))
+            write_config(manifest, opts, outfile, {name: value for name, value in profile_results.items()
+                                                   if name.startswith("profile ")})
+    finally:
+        manifest.close()
 
 
 if __name__ == "__main__":
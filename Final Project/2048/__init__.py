@@ -1,3 +1,9 @@
-from game import Game2048
-from manager import GameManager
-from main import run_game, main
+# The game and its window are imported on first use, so that importing the package stays cheap
+_EXPORTS = {"Game2048": "game", "GameManager": "manager", "run_game": "main", "main": "main"}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        import importlib
+        return getattr(importlib.import_module(_EXPORTS[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,257 @@
+"""Board-in, move-out access to every 2048 agent, without a game window.
+
+Each agent is asked for the move it would make on a grid, along with a score for every valid move. The agent types
+and their parameters are the ones accepted on the command line (see main.py), and missing parameters take the same
+defaults."""
+
+import json
+import atexit
+import argparse
+from functools import partial
+
+import numpy as np
+
+import AI
+from budget import make_budget
+from expectimax import Expectimax, open_cache, cache_tag
+from ntuple import NTupleNetwork
+from main import build_parser
+
+AI_TYPES = ["random", "heuristic", "rollout", "MCTS", "expectimax", "ntuple"]
+
+# Heuristics that score the grid after each move, and whether the lowest (np.min) or highest (np.max) score wins
+EVAL_HEURISTICS = {
+    "monotonic": (AI.monotonicity, np.min),
+    "smooth": (AI.smoothness, np.min),
+    "corner_dist": (AI.dist_from_corner, np.min),
+    "expert": (AI.expert_score, np.max),
+}
+
+# Agents that are kept between calls, so that their tables and caches stay warm
+_expectimax_agents = {}
+_shared_trees = {}
+_networks = {}
+_expert_weights = {}
+
+# Command line defaults of each agent type, and the command line arguments that parse each of its parameters
+_defaults = {}
+_arguments = {}
+
+
+def agent_options(AI_type, **kwargs):
+    """
+    Fill in the command line defaults for an agent.
+
+    :param AI_type: One of AI_TYPES
+    :param kwargs: Agent parameters, named as on the command line (e.g. type, max_depth, num_rollouts)
+    :return: A dictionary of all of the agent's parameters
+    """
+    if AI_type not in AI_TYPES:
+        raise ValueError("Invalid AI type %r; valid types are %s." % (AI_type, ", ".join(AI_TYPES)))
+    if AI_type not in _defaults:
+        parser = build_parser()
+        _defaults[AI_type] = vars(parser.parse_args([AI_type]))
+        subparsers = next(a for a in parser._actions if isinstance(a, argparse._SubParsersAction))
+        _arguments[AI_type] = {action.dest: action for action in parser._actions + subparsers.choices[AI_type]._actions
+                               if action.dest in _defaults[AI_type] and action.dest != "AI_type"}
+    opts = dict(_defaults[AI_type])
+    unknown = set(kwargs) - set(opts)
+    if unknown:
+        raise ValueError("Invalid parameters for %s: %s" % (AI_type, ", ".join(sorted(unknown))))
+    opts.update({name: _coerce(_arguments[AI_type][name], value) for name, value in kwargs.items()})
+    return opts
+
+
+def _coerce(action: argparse.Action, value):
+    """
+    Convert a parameter to the type its command line argument parses, so that e.g. a max_depth of "3" becomes 3.
+
+    :raises ValueError: If the value can't be converted, or isn't one of the argument's choices
+    """
+    if isinstance(action, argparse._StoreTrueAction):
+        if not isinstance(value, (bool, np.bool_)):
+            raise ValueError("Invalid value %r for %s; expected true or false." % (value, action.dest))
+        return bool(value)
+    if value is None and action.default is None:
+        return None
+    if action.type is not None:
+        if value is None or isinstance(value, (bool, np.bool_)) or \
+                (action.type is int and isinstance(value, float) and not value.is_integer()):
+            raise ValueError("Invalid value %r for %s; expected %s." % (value, action.dest, action.type.__name__))
+        try:
+            value = action.type(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value %r for %s; expected %s." % (value, action.dest, action.type.__name__))
+    if action.choices is not None and value not in action.choices:
+        raise ValueError("Invalid value %r for %s; valid values are %s."
+                         % (value, action.dest, ", ".join(map(str, action.choices))))
+    return value
+
+
+def is_deterministic(opts: dict):
+    """Whether an agent always gives the same move scores for the same grid, so that they may be cached."""
+    return opts["AI_type"] in ["expectimax", "ntuple"] or (opts["AI_type"] == "heuristic" and
+                                                            opts["type"] in EVAL_HEURISTICS)
+
+
+def _network(weights_file):
+    """Load an n-tuple network once and keep it."""
+    if not weights_file:
+        return None
+    if weights_file not in _networks:
+        _networks[weights_file] = NTupleNetwork.load(weights_file)
+    return _networks[weights_file]
+
+
+def _load_expert_weights(weights_file):
+    """The expert_score constants in a file, as written by tune.py, loaded once per file; None for the defaults."""
+    if not weights_file:
+        return None
+    if weights_file not in _expert_weights:
+        with open(weights_file) as f:
+            _expert_weights[weights_file] = tuple(json.load(f))
+    return _expert_weights[weights_file]
+
+
+def _use_expert_weights(weights_file):
+    """Set the expert_score constants for a call, for the agents that evaluate with AI.EXPERT_WEIGHTS."""
+    AI.set_expert_weights(_load_expert_weights(weights_file))
+
+
+def _close_shared_trees():
+    for tree in _shared_trees.values():
+        tree.close()
+    _shared_trees.clear()
+
+
+def _pick(scores: dict, compare_func=np.max):
+    """Pick the best move from a dictionary of move scores, breaking ties randomly like AI.choose_move."""
+    moves = list(scores)
+    values = np.array([scores[move] for move in moves])
+    return moves[np.random.choice(np.flatnonzero(values == compare_func(values)))]
+
+
+def batch_move_scores(grids: list, heuristic_type="expert", expert_weights=None):
+    """
+    Score the moves for many grids at once with one of the EVAL_HEURISTICS. The grids resulting from every valid move
+    of every grid are stacked and evaluated in a single vectorized call.
+
+    :param grids: A list of game grids
+    :param heuristic_type: A key of EVAL_HEURISTICS
+    :param expert_weights: A file of expert_score constants, for the "expert" heuristic
+    :return: A list of (move, scores) tuples, one per grid, as returned by move_scores
+    """
+    eval_func, compare_func = EVAL_HEURISTICS[heuristic_type]
+    if heuristic_type == "expert":
+        # The constants are passed rather than set, so that agents running on other threads keep theirs
+        eval_func = partial(eval_func, weights=_load_expert_weights(expert_weights) or AI.DEFAULT_EXPERT_WEIGHTS)
+    grid_moves = [AI.valid_moves(grid) for grid in grids]
+    for grid, moves in zip(grids, grid_moves):
+        if not moves:
+            raise ValueError("No valid moves on grid %s." % np.asarray(grid).tolist())
+    new_grids = [AI.quick_merge(grid, move) for grid, moves in zip(grids, grid_moves) for move in moves]
+    values = eval_func(np.stack(new_grids))
+
+    results = []
+    i = 0
+    for moves in grid_moves:
+        scores = {move: float(value) for move, value in zip(moves, values[i:i + len(moves)])}
+        results.append((_pick(scores, compare_func), scores))
+        i += len(moves)
+    return results
+
+
+def move_scores(grid: np.ndarray, score=0, AI_type="heuristic", **kwargs):
+    """
+    Ask an agent which move it would make.
+
+    :param grid: The current game grid
+    :param score: The current game score
+    :param AI_type: One of AI_TYPES
+    :param kwargs: Agent parameters, named as on the command line. Missing parameters take the command line defaults.
+    :return: A tuple of (move, scores), where move is one of "Up", "Down", "Left", "Right" and scores maps every
+             valid move to its score. Scores come from the agent itself: rollout and MCTS scores are average
+             outcomes, expectimax scores are utilities, and heuristic scores are the heuristic's value, where lower
+             is better for "monotonic", "smooth" and "corner_dist". Agents that only pick a move (random, greedy,
+             safe, safest) give the chosen move a score of 1 and every other valid move 0. N-tuple scores are
+             the move's reward plus the value of the resulting grid.
+    """
+    grid = np.array(grid)
+    opts = agent_options(AI_type, **kwargs)
+    moves = AI.valid_moves(grid)
+    if not moves:
+        raise ValueError("No valid moves on grid %s." % grid.tolist())
+    network = _network(opts.get("ntuple_weights"))
+    evaluate = None if network is None else network.evaluate
+
+    if AI_type == "heuristic" and opts["type"] in EVAL_HEURISTICS:
+        return batch_move_scores([grid], opts["type"], opts["expert_weights"])[0]
+
+    elif AI_type in ["random", "heuristic"]:
+        if AI_type == "random":
+            move = AI.random_move(grid)
+        else:
+            move = AI.heuristic_move(grid, opts["type"])
+        return move, {m: float(m == move) for m in moves}
+
+    elif AI_type == "rollout":
+        if opts["epsilon"] < 0 or opts["epsilon"] > 1:
+            raise ValueError("Epsilon must be in the interval [0, 1].")
+        _use_expert_weights(opts["expert_weights"])
+        heuristic_type = None if opts["type"] in [None, 'None'] else opts["type"]
+        moves, values = AI.rollout_move_scores(grid, score, heuristic_type, max_search_depth=opts["max_depth"],
+                                               num_rollouts=opts["num_rollouts"], epsilon=opts["epsilon"],
+                                               use_expert_score=opts["use_expert"], evaluate=evaluate,
+                                               budget=make_budget(opts["budget"], AI_type, opts["max_depth"],
+                                                                  opts["num_rollouts"]),
+                                               common_random_numbers=opts["common_random_numbers"],
+                                               control_variate=opts["control_variate"], bootstrap=opts["bootstrap"])
+        scores = {move: float(value) for move, value in zip(moves, values)}
+        return _pick(scores), scores
+
+    elif AI_type == "MCTS":
+        if opts["epsilon"] < 0 or opts["epsilon"] > 1:
+            raise ValueError("Epsilon must be in the interval [0, 1].")
+        _use_expert_weights(opts["expert_weights"])
+        if opts["workers"]:
+            if opts["widening"] is not None:
+                raise ValueError("Progressive widening isn't supported by the shared tree of --workers.")
+            # The workers keep the expert weights and network they were started with
+            agent_key = (opts["workers"], opts["max_depth"], opts["num_rollouts"], opts["epsilon"], opts["use_expert"],
+                         opts["ntuple_weights"], opts["expert_weights"], opts["budget"])
+            if agent_key not in _shared_trees:
+                from sharedtree import SharedTreeMCTS
+                if not _shared_trees:
+                    atexit.register(_close_shared_trees)
+                _shared_trees[agent_key] = SharedTreeMCTS(
+                    opts["workers"], opts["max_depth"], opts["num_rollouts"], opts["epsilon"], opts["use_expert"],
+                    evaluate, make_budget(opts["budget"], AI_type, opts["max_depth"], opts["num_rollouts"]))
+            scores = _shared_trees[agent_key].search(grid, score)
+            return _pick(scores), scores
+        tree = AI.GameTree(grid, max_search_depth=opts["max_depth"], num_rollouts=opts["num_rollouts"],
+                           epsilon=opts["epsilon"], UCT=opts["UCT"], use_expert_score=opts["use_expert"],
+                           evaluate=evaluate, budget=make_budget(opts["budget"], AI_type, opts["max_depth"],
+                                                                 opts["num_rollouts"]),
+                           widening=opts["widening"], widening_constant=opts["widening_constant"])
+        move = tree.search(grid, score)
+        return move, {m: float(v) for m, v in tree.root.move_scores().items()}
+
+    elif AI_type == "ntuple":
+        if network is None:
+            raise ValueError("The ntuple AI needs a weights file; see ntuple_weights.")
+        moves, _, _, values = network.move_values(grid)
+        scores = {move: float(value) for move, value in zip(moves, values)}
+        return max(scores, key=scores.get), scores
+
+    else:  # Expectimax
+        agent_key = opts["max_depth"], opts["cache_file"], opts["ntuple_weights"], opts["budget"], opts["no_prune"]
+        if agent_key not in _expectimax_agents:
+            cache = None
+            if opts["cache_file"]:
+                cache = open_cache(opts["cache_file"], opts["cache_size"], cache_tag(network))
+            _expectimax_agents[agent_key] = Expectimax(opts["max_depth"], cache, evaluate,
+                                                       make_budget(opts["budget"], AI_type, opts["max_depth"]),
+                                                       prune=not opts["no_prune"])
+        scores = {move: float(value) for move, value in _expectimax_agents[agent_key].move_values(grid).items()}
+        # Like Expectimax.get_best_move, ties go to the first move in AI._MOVES order
+        return max(scores, key=scores.get), scores
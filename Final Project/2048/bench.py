@@ -0,0 +1,309 @@
+"""Micro- and macro-benchmarks of the move engine and the agents.
+
+Micro-benchmarks time single calls (quick_merge, valid_moves, simulate_move, each heuristic of AI.HEURISTICS,
+expert_score and expectimax searches of depth 2 to 4) on a fixed corpus of boards, taken from seeded random games.
+Macro-benchmarks play seeded headless games with every agent type, through agents.move_scores, and time whole moves;
+agents that are kept between moves, such as expectimax, are timed as they are reused.
+Import benchmarks time the import of the main modules, and the start-up of `__main__.py --help`, in fresh
+interpreters, and note which of the modules that only the game window and reports need (pygame, pandas, ...) got
+loaded. Every benchmark is reported as its median seconds per operation over several repeats: per call for the
+micro-benchmarks, per move for the macro-benchmarks, and per import or start-up.
+
+Run `python bench.py run [-o OUT] [--quick] [-k FILTER] [--baseline BASELINE]` to write the results to a JSON file,
+and `python bench.py compare BASELINE RESULTS [--threshold THRESHOLD]` to compare two result files; benchmarks that
+got slower by more than the threshold (a fraction, 0.1 by default) are flagged as regressions, and the exit status is
+1 if there are any."""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import statistics as stats
+
+import numpy as np
+
+import AI
+import headless
+from expectimax import Expectimax
+
+# The moves into a game at which corpus boards are taken, so that it holds early, middle and late boards
+_CORPUS_MOVES = (5, 20, 50, 100, 150, 200, 300, 400)
+
+
+def corpus(num_games=4, seed=0):
+    """
+    The fixed corpus of boards: boards of seeded games of random moves, taken at each of _CORPUS_MOVES moves into a
+    game that gets that far. Every board has a valid move.
+
+    :param num_games: The number of games boards are taken from
+    :param seed: The seed of the first game; game i uses seed + i
+    :return: A list of grids
+    """
+    boards = []
+    for i in range(num_games):
+        rng = random.Random(seed + i)
+        grid = headless.new_grid(rng)
+        for moves in range(max(_CORPUS_MOVES) + 1):
+            valid = AI.valid_moves(grid)
+            if not valid:
+                break
+            if moves in _CORPUS_MOVES:
+                boards.append(grid.copy())
+            grid = AI.quick_merge(grid, rng.choice(valid))
+            headless.spawn_tile(grid, rng)
+    return boards
+
+
+def _time(func, repeat=5, min_time=0.1):
+    """
+    Time a function by repeats of enough calls to take at least 'min_time' seconds.
+
+    :return: A list of the seconds per call of each repeat
+    """
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2 if elapsed <= 0 else max(2, min(10, int(1.5 * min_time / elapsed)))
+    timings = [elapsed / calls]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        timings.append((time.perf_counter() - start) / calls)
+    return timings
+
+
+def micro_benchmarks(boards):
+    """
+    The micro-benchmarks on a corpus of boards.
+
+    :return: A dictionary mapping each benchmark's name to a tuple of (function, operations), where one call of
+             function does 'operations' operations
+    """
+    moved = [(grid, move) for grid in boards for move in AI._MOVES]
+    # Expectimax searches are slow, so deeper ones see fewer boards
+    searched = {2: boards, 3: boards[::2], 4: boards[::8]}
+
+    benchmarks = {
+        "quick_merge": (lambda: [AI.quick_merge(grid, move) for grid, move in moved], len(moved)),
+        "valid_moves": (lambda: [AI.valid_moves(grid) for grid in boards], len(boards)),
+        "simulate_move": (lambda: [AI.simulate_move(grid, move, 0) for grid, move in moved], len(moved)),
+        "expert_score": (lambda: [AI.expert_score(grid) for grid in boards], len(boards)),
+    }
+    for heuristic_type in AI.HEURISTICS:
+        benchmarks["heuristic." + heuristic_type] = (
+            lambda heuristic_type=heuristic_type: [AI.heuristic_move(grid, heuristic_type) for grid in boards],
+            len(boards))
+    for depth, grids in searched.items():
+        # A new agent per call, so that each search is timed cold. main.py and agents.move_scores keep one agent for
+        # every move, warm started by the last search, and that path is timed by the expectimax macro-benchmark.
+        benchmarks["expectimax.d%d" % depth] = (
+            lambda depth=depth, grids=grids: [Expectimax(depth).best_move(grid) for grid in grids], len(grids))
+    return benchmarks
+
+
+# The modules whose import is timed, and the modules only the game window and reports should load
+IMPORTS = ["engine", "AI", "expectimax", "headless", "agents", "main", "game"]
+_UI_MODULES = ["pygame", "appdirs", "pandas", "openpyxl"]
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_import(module=None, repeat=5):
+    """
+    Time the import of a module, or the start-up of `__main__.py --help` if None, in fresh interpreters.
+
+    :return: A tuple of (timings, loaded): the seconds of each import or start-up, and the modules of _UI_MODULES
+             it loaded
+    """
+    if module is None:
+        # Timed from outside, so that Python's own start-up is part of the time
+        command = [sys.executable, "-c", "import sys, runpy; sys.argv = ['__main__.py', '--help']; "
+                                         "runpy.run_path('__main__.py', run_name='__main__')"]
+    else:
+        command = [sys.executable, "-c", "import sys, time; start = time.perf_counter(); import %s; "
+                                         "print(time.perf_counter() - start, *[m for m in %r if m in sys.modules])"
+                                         % (module, _UI_MODULES)]
+    timings = []
+    loaded = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(command, cwd=_HERE, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        elapsed = time.perf_counter() - start
+        if module is None:
+            timings.append(elapsed)
+        else:
+            # pygame may print a banner first
+            result = output.splitlines()[-1].split()
+            timings.append(float(result[0]))
+            loaded = result[1:]
+    return timings, loaded
+
+
+# The agents of the macro-benchmarks, as keyword arguments of agents.move_scores
+MACRO_AGENTS = {
+    "random": {"AI_type": "random"},
+    "heuristic": {"AI_type": "heuristic"},
+    "heuristic_expert": {"AI_type": "heuristic", "type": "expert"},
+    "rollout": {"AI_type": "rollout"},
+    "MCTS": {"AI_type": "MCTS"},
+    "expectimax": {"AI_type": "expectimax"},
+}
+
+
+def play(agent: dict, num_games=2, max_moves=50, seed=0):
+    """
+    Play seeded headless games with an agent.
+
+    :param agent: The keyword arguments of agents.move_scores
+    :param seed: The seed of the first game; game i uses seed + i, for both its tile spawns and the agent
+    :return: A tuple of (seconds_per_move, moves, scores)
+    """
+    import agents
+
+    moves, scores = 0, []
+    elapsed = 0.0
+    for i in range(num_games):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        start = time.perf_counter()
+        result = headless.play_game(lambda grid, score: agents.move_scores(grid, score, **agent)[0], seed=seed + i,
+                                    max_moves=max_moves)
+        elapsed += time.perf_counter() - start
+        moves += result["moves"]
+        scores.append(int(result["score"]))
+    return elapsed / max(moves, 1), moves, scores
+
+
+def run(quick=False, name_filter=None, seed=0, ntuple_weights=None):
+    """
+    Run the benchmarks.
+
+    :param quick: Whether to run fewer repeats, on a smaller corpus and shorter games
+    :param name_filter: If supplied, only run the benchmarks whose names contain it
+    :param seed: The seed of the corpus and of the macro-benchmark games
+    :param ntuple_weights: If supplied, also benchmark the ntuple agent with these weights
+    :return: A dictionary of the "environment" and the "benchmarks", which maps each benchmark's name to a dictionary
+             of its "kind" ("micro", "import" or "macro"), median "seconds_per_op", "timings" of each repeat, and
+             "operations" per repeat; import benchmarks also have the modules of _UI_MODULES they "loaded", and
+             macro-benchmarks the "scores" of their games
+    """
+    repeat = 3 if quick else 5
+    boards = corpus(2 if quick else 4, seed)
+    results = {}
+
+    for name, (func, operations) in micro_benchmarks(boards).items():
+        if name_filter and name_filter not in name:
+            continue
+        timings = [t / operations for t in _time(func, repeat, 0.05 if quick else 0.2)]
+        results[name] = {"kind": "micro", "seconds_per_op": stats.median(timings), "timings": timings,
+                         "operations": operations}
+        print("%-28s %12.2f us/op" % (name, 1e6 * results[name]["seconds_per_op"]))
+
+    for module in IMPORTS + [None]:
+        name = "startup.cli_help" if module is None else "import." + module
+        if name_filter and name_filter not in name:
+            continue
+        timings, loaded = time_import(module, repeat)
+        results[name] = {"kind": "import", "seconds_per_op": stats.median(timings), "timings": timings,
+                         "operations": 1, "loaded": loaded}
+        print("%-28s %12.2f ms%s" % (name, 1e3 * results[name]["seconds_per_op"],
+                                     "  (loads %s)" % ", ".join(loaded) if loaded else ""))
+
+    macro_agents = dict(MACRO_AGENTS)
+    if ntuple_weights:
+        macro_agents["ntuple"] = {"AI_type": "ntuple", "ntuple_weights": ntuple_weights}
+    for agent_name, agent in macro_agents.items():
+        name = "moves." + agent_name
+        if name_filter and name_filter not in name:
+            continue
+        # Games are seeded, so repeats play the same moves
+        runs = [play(agent, 1 if quick else 2, 20 if quick else 50, seed) for _ in range(repeat)]
+        timings = [seconds_per_move for seconds_per_move, _, _ in runs]
+        results[name] = {"kind": "macro", "seconds_per_op": stats.median(timings), "timings": timings,
+                         "operations": runs[0][1], "scores": runs[0][2]}
+        print("%-28s %12.1f moves/s" % (name, 1 / results[name]["seconds_per_op"]))
+
+    return {"environment": {"python": platform.python_version(), "numpy": np.__version__,
+                            "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            "quick": quick, "seed": seed},
+            "benchmarks": results}
+
+
+def compare(baseline: dict, results: dict, threshold=0.1):
+    """
+    Compare two sets of results, printing the change of every benchmark they share.
+
+    :param threshold: The fraction by which a benchmark may get slower before it is flagged as a regression
+    :return: The names of the regressed benchmarks
+    """
+    regressions = []
+    print("%-28s %14s %14s %9s" % ("Benchmark", "baseline", "current", "change"))
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            print("%-28s %14s %11.2f us %9s" % (name, "-", 1e6 * result["seconds_per_op"], "new"))
+            continue
+        before = baseline["benchmarks"][name]["seconds_per_op"]
+        change = result["seconds_per_op"] / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-28s %11.2f us %11.2f us %+8.1f%%%s" % (name, 1e6 * before, 1e6 * result["seconds_per_op"],
+                                                         100 * change, flag))
+    missing = set(baseline["benchmarks"]) - set(results["benchmarks"])
+    if missing:
+        print("Not run:", ", ".join(sorted(missing)))
+    if regressions:
+        print("%d regression(s) beyond %.0f%%: %s" % (len(regressions), 100 * threshold, ", ".join(regressions)))
+    return regressions
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the 2048 move engine and agents.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument('-o', "--out", nargs='?', default="bench.json", type=str)
+    run_parser.add_argument("--quick", action='store_true')
+    run_parser.add_argument('-k', "--filter", nargs='?', default=None, type=str)
+    run_parser.add_argument("--seed", nargs='?', default=0, type=int)
+    run_parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    run_parser.add_argument("--baseline", nargs='?', default=None, type=str)
+    run_parser.add_argument("--threshold", nargs='?', default=0.1, type=float)
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline", type=str)
+    compare_parser.add_argument("results", type=str)
+    compare_parser.add_argument("--threshold", nargs='?', default=0.1, type=float)
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == "run":
+        results = run(args.quick, args.filter, args.seed, args.ntuple_weights)
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
+        baseline = args.baseline and _load(args.baseline)
+    else:
+        results = _load(args.results)
+        baseline = _load(args.baseline)
+    if baseline and compare(baseline, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
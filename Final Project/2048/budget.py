@@ -0,0 +1,160 @@
+"""Search budgets that follow the board.
+
+A budget policy is called with the current grid and returns a Budget: the depth to search and, for rollout-based
+agents, the number of rollouts per move. Without a policy, the expectimax, rollout and MCTS agents search with the same
+budget on every move. AdaptiveBudget spends less on open boards, where most moves are safe and a wide tree makes deep
+search expensive, and more on crowded ones, where a single move can lose the game and the tree is narrow and cheap.
+
+Run `python budget.py [-n|--num_games NUM_GAMES] [--seed SEED] {rollout,MCTS,expectimax} ...` to compare the fixed
+and adaptive budgets of an agent on the same headless games; the agent's arguments are those of `__main__.py`."""
+
+import sys
+import time
+import random
+import argparse
+import statistics as stats
+from collections import namedtuple
+
+import numpy as np
+
+import AI
+
+Budget = namedtuple("Budget", ["depth", "rollouts"])
+
+BUDGETS = ["fixed", "adaptive"]
+
+
+def board_features(grid: np.ndarray):
+    """
+    The features a budget is chosen from.
+
+    :return: A tuple of (empty_cells, distinct_tiles, legal_moves)
+    """
+    grid = np.asarray(grid)
+    return int(np.count_nonzero(grid == 0)), len(np.unique(grid[grid != 0])), len(AI.valid_moves(grid))
+
+
+class AdaptiveBudget(object):
+    def __init__(self, depth, rollouts=None, depth_step=1, min_depth=1, open_cells=6, crowded_cells=1,
+                 many_tiles=9):
+        """
+        :param depth: The search depth on an ordinary board, in the agent's own units (plies for expectimax, moves
+                      for rollouts and MCTS)
+        :param rollouts: The number of rollouts per move on an ordinary board, if the agent uses rollouts
+        :param depth_step: How much the depth changes per level of difficulty; 2 for expectimax, so that a level is a
+                           move and a tile spawn
+        :param min_depth: The smallest depth searched
+        :param open_cells: Boards with at least this many empty cells are easy, unless they have many distinct tiles
+                           or only two legal moves
+        :param crowded_cells: Boards with at most this many empty cells are critical. Their trees are narrow, so the
+                              extra search is cheap.
+        :param many_tiles: Boards with at least this many distinct tiles are never easy, since they take more moves
+                           to clean up
+        """
+        self.depth = depth
+        self.rollouts = rollouts
+        self.depth_step = depth_step
+        self.min_depth = min_depth
+        self.open_cells = open_cells
+        self.crowded_cells = crowded_cells
+        self.many_tiles = many_tiles
+
+    def level(self, grid: np.ndarray):
+        """
+        How hard a board is: -1 (easy), 0 (ordinary) or 1 (critical), or None if there is only one legal move and so
+        nothing to decide.
+        """
+        empty, distinct, legal = board_features(grid)
+        if legal <= 1:
+            return None
+        if empty <= self.crowded_cells:
+            return 1
+        if empty >= self.open_cells and distinct < self.many_tiles and legal > 2:
+            return -1
+        return 0
+
+    def __call__(self, grid: np.ndarray):
+        level = self.level(grid)
+        if level is None:
+            return Budget(self.min_depth, None if self.rollouts is None else 1)
+        depth = max(self.min_depth, self.depth + level * self.depth_step)
+        rollouts = None if self.rollouts is None else max(1, int(self.rollouts * 2.0 ** level))
+        return Budget(depth, rollouts)
+
+
+def make_budget(budget, AI_type, max_depth, num_rollouts=None):
+    """
+    The budget policy of an agent, as chosen on the command line.
+
+    :param budget: One of BUDGETS
+    :param AI_type: "rollout", "MCTS" or "expectimax"
+    :return: The policy, or None for a fixed budget
+    """
+    if budget not in BUDGETS:
+        raise ValueError("Invalid budget %r; valid budgets are %s." % (budget, ", ".join(BUDGETS)))
+    if budget == "fixed":
+        return None
+    if AI_type == "expectimax":
+        return AdaptiveBudget(max_depth, depth_step=2)
+    return AdaptiveBudget(max_depth, num_rollouts)
+
+
+def benchmark(AI_type, num_games=5, seed=0, **kwargs):
+    """
+    Play the same headless games with the fixed and the adaptive budget of an agent.
+
+    :param AI_type: "rollout", "MCTS" or "expectimax"
+    :param num_games: The number of games per budget
+    :param seed: The seed of the first game; game i uses seed + i, for both its tile spawns and the agent
+    :param kwargs: Agent parameters, as for agents.move_scores
+    :return: A dictionary mapping each budget to a dictionary of its "scores", "best_tiles", "moves" and average
+             "move_time" in seconds
+    """
+    import agents
+    import headless
+
+    results = {}
+    for budget in BUDGETS:
+        scores, best_tiles, num_moves, move_times = [], [], [], []
+        for i in range(num_games):
+            random.seed(seed + i)
+            np.random.seed(seed + i)
+
+            def choose_move(grid, score):
+                start = time.perf_counter()
+                move = agents.move_scores(grid, score, AI_type, budget=budget, **kwargs)[0]
+                move_times.append(time.perf_counter() - start)
+                return move
+
+            result = headless.play_game(choose_move, seed=seed + i)
+            scores.append(int(result["score"]))
+            best_tiles.append(result["best_tile"])
+            num_moves.append(result["moves"])
+        results[budget] = {"scores": scores, "best_tiles": best_tiles, "moves": num_moves,
+                           "move_time": stats.mean(move_times)}
+        print("%-8s average score: %8.0f, max tile: %5d, average move time: %7.2f ms, moves: %d" % (
+            budget, stats.mean(scores), max(best_tiles), 1000 * results[budget]["move_time"], sum(num_moves)))
+    return results
+
+
+def main():
+    from main import build_parser
+
+    parser = argparse.ArgumentParser(description="Compare the fixed and adaptive search budgets of a 2048 agent.")
+    parser.add_argument('-n', "--num_games", nargs='?', default=5, type=int)
+    parser.add_argument("--seed", nargs='?', default=0, type=int)
+    args, agent_args = parser.parse_known_args(sys.argv[1:])
+
+    opts = vars(build_parser().parse_args(agent_args))
+    AI_type = opts["AI_type"]
+    if AI_type not in ["rollout", "MCTS", "expectimax"]:
+        parser.error("Budgets apply to the rollout, MCTS and expectimax agents.")
+    # Game length is set by this benchmark, and the budget by the comparison
+    for option in ["num_games", "budget", "AI_type", "trajectory_file", "stats_file", "profile", "profile_output",
+                   "rows", "columns"]:
+        opts.pop(option, None)
+    benchmark(AI_type, args.num_games, args.seed, **opts)
+
+
+if __name__ == "__main__":
+    main()
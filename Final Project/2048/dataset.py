@@ -0,0 +1,257 @@
+"""Datasets of positions labelled by expectimax, for training policies and value functions.
+
+Positions are sampled from seeded headless self-play (headless.play_game, with a heuristic policy that plays a random
+move with probability 'epsilon') or replayed from trajectory logs, and each one is labelled with the expectimax value
+of all four moves (see agents.move_scores) by a pool of worker processes.
+
+Positions are deduplicated by their canonical packed grid: the smaller of the packed grid and its transpose (see
+engine.py). Expectimax values are unchanged by transposing a grid (see expectimax.open_cache), with the moves Up and
+Left, and Down and Right, swapped, so a grid and its transpose are labelled once.
+
+Labelled positions are written to numbered shards, "shard-00000.npz", ... in the output directory, each holding:
+* "boards": uint8 (N, 4, 4) tile exponents (see engine.to_exponents), as sampled, not canonical
+* "keys": uint64 (N,) canonical packed grids
+* "values": float32 (N, 4) expectimax values of the moves in AI._MOVES order, NaN for invalid moves
+* "best_move": int8 (N,) the index of the best move in AI._MOVES order, ties going to the first
+* "games_done": the number of source games whose positions are in this shard or an earlier one
+A shard is only written once the positions of a whole game are in it, and is written to a temporary file first, so
+the output directory always holds complete shards. A run started again on the same directory, with the same arguments,
+skips the games already done and carries on with the same deduplication, so it writes the same dataset as a run that
+was never stopped.
+
+Run with `python dataset.py [-j|--workers WORKERS] [-d|--max_depth DEPTH] [--shard_size N] [--seed SEED]
+[--policy HEURISTIC] [--epsilon EPSILON] [--sample FRACTION] [--trajectories FILE ...] out_dir [num_games]`."""
+
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+
+import AI
+import engine
+import agents
+import headless
+import trajectory
+from utils import write_to_disk
+
+SHARD_PATTERN = "shard-%05d.npz"
+
+# Expectimax options of the labelling workers, set by _init_labeller
+_label_opts = {}
+
+
+def canonical_key(grid: np.ndarray):
+    """The canonical packed grid of a 4x4 grid, or None if it can't be packed."""
+    key = engine.pack_grid(grid)
+    if key is None or np.shape(grid) != (4, 4):
+        return None
+    return min(key, engine.transpose_packed(key))
+
+
+def selfplay_games(num_games, seed=0, policy="expert", epsilon=0.1, start=0):
+    """
+    The positions of seeded headless self-play games. Game i is seeded with seed + i.
+
+    :param policy: The heuristic of the "heuristic" agent that plays the games
+    :param epsilon: The probability of a random move instead of the policy's
+    :param start: The index of the first game
+    :return: A generator of the list of (grid, score) positions of each game, before each of its moves
+    """
+    for game in range(start, num_games):
+        rng = random.Random(seed + game)
+        np.random.seed((seed + game) % 2 ** 32)
+        positions = []
+
+        def choose_move(grid, score):
+            positions.append((grid.copy(), score))
+            if rng.random() < epsilon:
+                return rng.choice(AI.valid_moves(grid))
+            return agents.move_scores(grid, score, "heuristic", type=policy)[0]
+
+        headless.play_game(choose_move, seed=seed + game)
+        yield positions
+
+
+def trajectory_games(paths, start=0):
+    """
+    The positions of the games of trajectory logs, in order, skipping those without moves left.
+
+    :param start: The index of the first game, counting across the logs
+    :return: A generator of the list of (grid, score) positions of each game
+    """
+    game = 0
+    for path in paths:
+        reader = trajectory.TrajectoryReader(path)
+        for i in range(len(reader)):
+            if game >= start:
+                yield [(grid, score) for grid, score in trajectory.replay(reader.game(i)) if AI.valid_moves(grid)]
+            game += 1
+
+
+def _init_labeller(opts):
+    _label_opts.update(opts)
+
+
+def label(grids):
+    """
+    Label grids with expectimax.
+
+    :return: A tuple of (values, best_move) arrays, as stored in shards
+    """
+    values = np.full((len(grids), len(AI._MOVES)), np.nan, dtype=np.float32)
+    for i, grid in enumerate(grids):
+        _, scores = agents.move_scores(grid, 0, "expectimax", **_label_opts)
+        for move, value in scores.items():
+            values[i, AI._MOVES.index(move)] = value
+    # np.nanargmax gives ties to the first move, like agents.move_scores
+    best_move = np.array([np.nanargmax(row) for row in values], dtype=np.int8)
+    return values, best_move
+
+
+def read_shards(out_dir):
+    """
+    Read the shards of a dataset.
+
+    :return: A list of the shards' paths and a dictionary of their arrays, concatenated, as stored in shards
+    """
+    paths = sorted(glob.glob(os.path.join(out_dir, SHARD_PATTERN.replace("%05d", "[0-9]" * 5))))
+    shards = [np.load(path) for path in paths]
+    arrays = {name: np.concatenate([shard[name] for shard in shards]) if shards else
+              np.zeros((0,) + shape, dtype=dtype)
+              for name, shape, dtype in [("boards", (4, 4), np.uint8), ("keys", (), np.uint64),
+                                         ("values", (4,), np.float32), ("best_move", (), np.int8)]}
+    arrays["games_done"] = int(shards[-1]["games_done"]) if shards else 0
+    return paths, arrays
+
+
+def _write_shard(path, buffer, games_done):
+    """Write a shard atomically: to a temporary file, synced to disk and then renamed."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, boards=np.array([b for b, _, _, _ in buffer], dtype=np.uint8).reshape(-1, 4, 4),
+                 keys=np.array([k for _, k, _, _ in buffer], dtype=np.uint64),
+                 values=np.array([v for _, _, v, _ in buffer], dtype=np.float32).reshape(-1, 4),
+                 best_move=np.array([m for _, _, _, m in buffer], dtype=np.int8), games_done=games_done)
+        write_to_disk(file)
+    os.replace(tmp_path, path)
+
+
+def generate(out_dir, num_games=1000, workers=None, max_depth=3, shard_size=100000, seed=0, policy="expert",
+             epsilon=0.1, sample=1.0, trajectories=None, ntuple_weights=None):
+    """
+    Generate a dataset, or carry on with one that was stopped.
+
+    :param out_dir: The directory of the shards; created if it doesn't exist
+    :param num_games: The number of self-play games to sample positions from. With 'trajectories', the most games of
+                      the logs to sample from.
+    :param workers: The number of labelling processes; one per CPU if not supplied
+    :param max_depth: The expectimax search depth
+    :param shard_size: The fewest positions per shard, but for the last one
+    :param seed: The seed of the self-play games, and of the sampling of positions
+    :param sample: The fraction of positions to sample from each game
+    :param trajectories: If supplied, a list of trajectory logs to sample positions from instead of self-play
+    :param ntuple_weights: If supplied, an n-tuple network for expectimax to evaluate leaves with
+    :return: The number of labelled positions in the dataset
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths, existing = read_shards(out_dir)
+    seen = set(existing["keys"].tolist())
+    start = existing["games_done"]
+    total = len(existing["keys"])
+    if paths:
+        print("Resuming after %d games, with %d positions in %d shards" % (start, total, len(paths)))
+
+    if trajectories:
+        games = trajectory_games(trajectories, start)
+    else:
+        games = selfplay_games(num_games, seed, policy, epsilon, start)
+
+    def new_positions():
+        # Runs ahead of the labelling, in the pool's task thread; it alone updates 'seen'
+        for game, positions in enumerate(games, start):
+            if game >= num_games:
+                return
+            rng = random.Random("sample-%d-%d" % (seed, game))
+            grids = []
+            for grid, _ in positions:
+                key = canonical_key(grid)
+                if key is None or key in seen or rng.random() >= sample:
+                    continue
+                seen.add(key)
+                grids.append((grid, key))
+            yield game, grids
+
+    label_opts = {"max_depth": max_depth, "ntuple_weights": ntuple_weights}
+    workers = workers or os.cpu_count()
+    pool = mp.Pool(workers, initializer=_init_labeller, initargs=(label_opts,)) if workers > 1 else None
+    if pool is None:
+        _init_labeller(label_opts)
+
+    def labelled():
+        tasks = new_positions()
+        if pool is None:
+            for game, grids in tasks:
+                yield game, grids, label([grid for grid, _ in grids])
+        else:
+            # Labels come back in the order of the games, whichever worker finishes first
+            results = pool.imap(_label_game, tasks)
+            for game, grids, labels in results:
+                yield game, grids, labels
+
+    buffer = []
+    shard = len(paths)
+    start_time = time.time()
+    try:
+        for game, grids, (values, best_move) in labelled():
+            buffer.extend((engine.to_exponents(grid), key, values[i], best_move[i])
+                          for i, (grid, key) in enumerate(grids))
+            if len(buffer) >= shard_size:
+                _write_shard(os.path.join(out_dir, SHARD_PATTERN % shard), buffer, game + 1)
+                total += len(buffer)
+                print("Shard %d: %d positions after %d games (%.0f positions/s)" % (
+                    shard, total, game + 1, (total - len(existing["keys"])) / (time.time() - start_time)))
+                shard += 1
+                buffer = []
+            last_game = game
+        if buffer:
+            _write_shard(os.path.join(out_dir, SHARD_PATTERN % shard), buffer, last_game + 1)
+            total += len(buffer)
+            print("Shard %d: %d positions after %d games" % (shard, total, last_game + 1))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return total
+
+
+def _label_game(task):
+    game, grids = task
+    return game, grids, label([grid for grid, _ in grids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a dataset of positions labelled by expectimax.")
+    parser.add_argument("out_dir", type=str, help="The directory of the dataset's shards")
+    parser.add_argument("num_games", nargs='?', default=1000, type=int)
+    parser.add_argument('-j', "--workers", nargs='?', default=None, type=int)
+    parser.add_argument('-d', "--max_depth", nargs='?', default=3, type=int)
+    parser.add_argument("--shard_size", nargs='?', default=100000, type=int)
+    parser.add_argument("--seed", nargs='?', default=0, type=int)
+    parser.add_argument("--policy", nargs='?', choices=list(agents.EVAL_HEURISTICS), default="expert", type=str)
+    parser.add_argument("--epsilon", nargs='?', default=0.1, type=float)
+    parser.add_argument("--sample", nargs='?', default=1.0, type=float)
+    parser.add_argument("--trajectories", nargs='+', default=None, type=str)
+    parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    kwargs = vars(parser.parse_args(sys.argv[1:]))
+
+    total = generate(**kwargs)
+    print("%d labelled positions in %s" % (total, kwargs["out_dir"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""Simulation sweeps spread over many machines: a coordinator hands out games to workers over TCP.
+
+The coordinator holds the sweep of Simulator.sweep_configs as units of one game each: a configuration, a game number
+and the seed of the game. Workers on any host connect to it (through a multiprocessing manager, authenticated by a
+shared key), take a unit at a time, play it as a headless game with agents.move_scores, and send back the game's
+summary. Nothing is shared but the connection: the coordinator alone records results, in a Simulator.Manifest, and
+writes a configuration's sheet once all of its games are in.
+
+A unit is leased to the worker that took it. Workers send a heartbeat every few seconds while they play; when a worker
+misses its heartbeats for 'lease_timeout' seconds (it crashed, or its host or network went down), its units go back to
+the front of the queue for another worker. A result that arrives for a unit already done is dropped. As with
+Simulator.simulate, a coordinator started again with the same arguments carries on from its manifest.
+
+Games follow the rules of headless games (see headless.py), so their results are not mixed with those of
+Simulator.simulate: the manifest is kept apart, next to the outfile.
+
+Run `python distributed.py coordinator [--host HOST] [--port PORT] [--authkey KEY] [-j LOCAL_WORKERS] [-n NUM_GAMES]
+[-o OUTFILE] [--seed SEED] [--lease_timeout SECONDS] {heuristic,rollout,MCTS,...}` to serve a sweep, and
+`python distributed.py worker [--host HOST] [--port PORT] [--authkey KEY] [-j WORKERS]` on every host to work on it;
+`-j` of the coordinator also starts workers on its own host."""
+
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+import Simulator
+from instrument import MoveRecorder
+
+DEFAULT_PORT = 20480
+
+# The seconds between a worker's heartbeats, and between its requests while it waits for a unit
+HEARTBEAT_INTERVAL = 2.0
+
+
+class Coordinator(object):
+    def __init__(self, configs, outfile="simulation_distributed.xlsx", manifest=None, seed=0, lease_timeout=30.0):
+        """
+        :param configs: The configurations of the sweep, as returned by Simulator.sweep_configs
+        :param outfile: The Excel file of the results, one sheet per configuration
+        :param manifest: The manifest file; by default, 'outfile' with the extension ".manifest.jsonl"
+        :param seed: Game i of every configuration is played with the seed seed + i
+        :param lease_timeout: The seconds without a heartbeat after which a worker's units are handed out again
+        """
+        self.outfile = outfile
+        self.lease_timeout = lease_timeout
+        self.manifest = Simulator.Manifest(manifest or Simulator.default_manifest(outfile))
+        self.finished = threading.Event()
+
+        self._lock = threading.Lock()
+        self._configs = {}
+        self._units = {}
+        self._pending = deque()
+        self._leases = {}
+        self._last_seen = {}
+        for opts in configs:
+            config = Simulator.Manifest.key(opts)
+            if config in self.manifest.written:
+                continue
+            self._configs[config] = opts
+            for game in range(opts["num_games"]):
+                if game not in self.manifest.games[config]:
+                    unit_id = len(self._units)
+                    self._units[unit_id] = (config, opts, game, seed + game)
+                    self._pending.append(unit_id)
+        self.retried = 0
+        # Configurations whose games all finished before a restart are written straight away
+        for config in list(self._configs):
+            self._write_if_done(config)
+        if not self._configs:
+            self.finished.set()
+
+    def get_unit(self, worker):
+        """
+        Lease the next unit to a worker.
+
+        :return: A tuple of (status, unit): ("unit", (unit_id, opts, game, seed)), ("wait", None) if every unit left
+                 is leased, or ("done", None) once the sweep is finished
+        """
+        with self._lock:
+            self._last_seen[worker] = time.time()
+            if not self._pending:
+                return ("done", None) if not self._leases else ("wait", None)
+            unit_id = self._pending.popleft()
+            self._leases[unit_id] = worker
+            config, opts, game, seed = self._units[unit_id]
+            return "unit", (unit_id, opts, game, seed)
+
+    def heartbeat(self, worker):
+        with self._lock:
+            self._last_seen[worker] = time.time()
+
+    def put_result(self, worker, unit_id, result):
+        """Record the result of a unit; results of units that are already done are dropped."""
+        with self._lock:
+            self._last_seen[worker] = time.time()
+            if unit_id not in self._units:
+                return
+            config, opts, game, seed = self._units.pop(unit_id)
+            self._leases.pop(unit_id, None)
+            if unit_id in self._pending:
+                self._pending.remove(unit_id)
+            self.manifest.add_game(config, game, seed, result)
+            print("Game %d of %s: score %d (%d units left)" % (game, Simulator.sheet_name(opts), result["score"],
+                                                                len(self._units)))
+            self._write_if_done(config)
+
+    def _write_if_done(self, config):
+        opts = self._configs[config]
+        if len(self.manifest.games[config]) == opts["num_games"]:
+            Simulator.write_config(self.manifest, opts, self.outfile)
+            del self._configs[config]
+            if not self._configs:
+                self.finished.set()
+
+    def expire_leases(self):
+        """Hand out again the units of workers that missed their heartbeats."""
+        with self._lock:
+            now = time.time()
+            lost = {worker for worker, seen in self._last_seen.items() if now - seen > self.lease_timeout}
+            for unit_id, worker in list(self._leases.items()):
+                if worker in lost:
+                    del self._leases[unit_id]
+                    self._pending.appendleft(unit_id)
+                    self.retried += 1
+                    print("Worker %s was lost; game %d of %s will be played again" % (
+                        worker, self._units[unit_id][2], Simulator.sheet_name(self._units[unit_id][1])))
+            for worker in lost:
+                del self._last_seen[worker]
+
+    def close(self):
+        self.manifest.close()
+
+
+class _CoordinatorManager(BaseManager):
+    pass
+
+
+def serve(coordinator: Coordinator, host="", port=DEFAULT_PORT, authkey=b"2048", local_workers=0):
+    """
+    Serve a coordinator's units until its sweep is finished.
+
+    :param host: The interface to listen on; all of them by default
+    :param local_workers: The number of worker processes to start on this host
+    """
+    _CoordinatorManager.register("coordinator", callable=lambda: coordinator)
+    server = _CoordinatorManager(address=(host, port), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving %d games on port %d" % (len(coordinator._units), server.address[1]))
+
+    processes = [mp.Process(target=work, args=("localhost", server.address[1], authkey), daemon=True)
+                 for _ in range(local_workers)]
+    for process in processes:
+        process.start()
+    try:
+        while not coordinator.finished.wait(HEARTBEAT_INTERVAL):
+            coordinator.expire_leases()
+        # Give the workers time to hear that the sweep is finished
+        time.sleep(2 * HEARTBEAT_INTERVAL)
+        for process in processes:
+            process.join()
+    finally:
+        server.stop_event.set()
+        coordinator.close()
+
+
+def play(opts: dict, seed):
+    """
+    Play a unit: one headless game of a configuration.
+
+    :return: A dictionary of the game's summary, as returned by instrument.MoveRecorder.end_game, and the
+             "move_seconds" its moves took
+    """
+    import agents
+    import headless
+
+    agent_opts = {name: value for name, value in opts.items() if name not in ["AI_type", "num_games"]}
+    recorder = MoveRecorder()
+    move_seconds = []
+
+    def choose_move(grid, score):
+        recorder.start_move()
+        start = time.perf_counter()
+        move = agents.move_scores(grid, score, opts["AI_type"], **agent_opts)[0]
+        move_seconds.append(time.perf_counter() - start)
+        recorder.end_move(move)
+        return move
+
+    random.seed(seed)
+    np.random.seed(seed)
+    result = headless.play_game(choose_move, seed=seed)
+    return dict(recorder.end_game(result["score"], result["best_tile"]), move_seconds=sum(move_seconds))
+
+
+def work(host="localhost", port=DEFAULT_PORT, authkey=b"2048"):
+    """Play units of a coordinator until its sweep is finished, or it can't be reached."""
+    _CoordinatorManager.register("coordinator")
+    manager = _CoordinatorManager(address=(host, port), authkey=authkey)
+    manager.connect()
+    coordinator = manager.coordinator()
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                coordinator.heartbeat(worker)
+            except (OSError, EOFError):
+                return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    played = 0
+    try:
+        while True:
+            status, unit = coordinator.get_unit(worker)
+            if status == "done":
+                break
+            if status == "wait":
+                time.sleep(HEARTBEAT_INTERVAL)
+                continue
+            unit_id, opts, game, seed = unit
+            coordinator.put_result(worker, unit_id, play(opts, seed))
+            played += 1
+    except (OSError, EOFError):
+        # The coordinator has gone; anything unfinished is handed out again when it restarts
+        pass
+    finally:
+        stop.set()
+    print("Worker %s played %d games" % (worker, played))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Simulator sweep over many machines.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    coordinator_parser = subparsers.add_parser("coordinator")
+    coordinator_parser.add_argument("AI_type", choices=["random", "heuristic", "rollout", "MCTS", "expectimax"],
+                                    type=str)
+    coordinator_parser.add_argument("--host", nargs='?', default="", type=str)
+    coordinator_parser.add_argument("--port", nargs='?', default=DEFAULT_PORT, type=int)
+    coordinator_parser.add_argument("--authkey", nargs='?', default="2048", type=str)
+    coordinator_parser.add_argument('-j', "--local_workers", nargs='?', default=0, type=int)
+    coordinator_parser.add_argument('-n', "--num_games", nargs='?', default=30, type=int)
+    coordinator_parser.add_argument('-o', "--outfile", nargs='?', default="simulation_distributed.xlsx", type=str)
+    coordinator_parser.add_argument("--seed", nargs='?', default=0, type=int)
+    coordinator_parser.add_argument("--lease_timeout", nargs='?', default=30.0, type=float)
+
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("--host", nargs='?', default="localhost", type=str)
+    worker_parser.add_argument("--port", nargs='?', default=DEFAULT_PORT, type=int)
+    worker_parser.add_argument("--authkey", nargs='?', default="2048", type=str)
+    worker_parser.add_argument('-j', "--workers", nargs='?', default=1, type=int)
+
+    args = parser.parse_args(sys.argv[1:])
+    authkey = args.authkey.encode()
+    if args.command == "coordinator":
+        coordinator = Coordinator(Simulator.sweep_configs(args.AI_type, args.num_games), args.outfile,
+                                  seed=args.seed, lease_timeout=args.lease_timeout)
+        serve(coordinator, args.host, args.port, authkey, args.local_workers)
+        print("Sweep finished; %d games were played again after their workers were lost" % coordinator.retried)
+    else:
+        processes = [mp.Process(target=work, args=(args.host, args.port, authkey)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Compact board representations and move rules shared by the search structures and tools.
+
+A grid of up to 16 cells is packed into a single 64-bit integer, with four bits per cell holding the tile's exponent
+(0 for an empty cell, 1 for a 2, 2 for a 4, ...), row-major from the top-left cell in the most significant bits.
+Larger grids are kept as NumPy arrays of exponents, which the move functions below handle for any board size."""
+
+import numpy as np
+
+# The largest exponent a packed cell can hold (a 32768 tile)
+MAX_EXPONENT = 15
+
+
+def to_exponents(grid: np.ndarray):
+    """Convert tile values to their exponents, with 0 for empty cells."""
+    grid = np.asarray(grid)
+    return np.log2(grid, out=np.zeros_like(grid), where=(grid != 0), casting='unsafe')
+
+
+def pack_grid(grid: np.ndarray):
+    """
+    Pack a grid of up to 16 cells into a 64-bit integer.
+
+    :param grid: The game grid, holding tile values
+    :return: The packed grid, or None if the grid has too many cells or a tile is too large to pack
+    """
+    if np.size(grid) > 16:
+        return None
+    key = 0
+    for value in np.asarray(grid).flat:
+        exponent = int(value).bit_length() - 1 if value else 0
+        if exponent > MAX_EXPONENT:
+            return None
+        key = (key << 4) | exponent
+    return key
+
+
+def unpack_grid(key: int, shape=(4, 4)):
+    """Unpack a grid packed by pack_grid."""
+    size = shape[0] * shape[1]
+    exponents = [(key >> (4 * (size - 1 - i))) & 0xF for i in range(size)]
+    return np.array([1 << e if e else 0 for e in exponents]).reshape(shape)
+
+
+def transpose_packed(key: int):
+    """Transpose a packed 4x4 grid, swapping the cells at (r, c) and (c, r)."""
+    result = 0
+    for r in range(4):
+        for c in range(4):
+            result |= ((key >> (4 * (15 - (4 * r + c)))) & 0xF) << (4 * (15 - (4 * c + r)))
+    return result
+
+
+def game_merge(grid: np.ndarray, direction: str):
+    """
+    Make a move by the rules of Game2048, without spawning a tile. Unlike AI.quick_merge, a freshly merged tile never
+    merges again.
+
+    :return: A tuple of (new_grid, score_gained)
+    """
+    grid = np.asarray(grid)
+    merged, score, _ = move_exponents(to_exponents(grid), direction, chain=False)
+    return np.where(merged > 0, np.left_shift(1, merged, dtype=np.int64), 0).astype(grid.dtype), int(score)
+
+
+def tile_destinations(grid: np.ndarray, new_grid: np.ndarray, direction: str):
+    """
+    The cell each tile of 'grid' moved to, found from the grids before and after a move in 'direction'.
+
+    Tiles keep their order along each line, and each cell after the move holds one tile, or the tiles merged into it,
+    so the sums of the tiles along a line, before and after, match up where each group of tiles ends. A tile goes to
+    the first cell after the move whose running sum reaches its own. This holds for the rules of Game2048 and of
+    AI.quick_merge alike.
+
+    :return: An array of the shape of 'grid' of the flat index of the cell each tile moved to, -1 for empty cells
+    """
+    grid = np.asarray(grid)
+    cells = orient(np.arange(grid.size).reshape(grid.shape), direction)
+    before = orient(grid, direction).astype(np.int64)
+    after = orient(np.asarray(new_grid), direction).astype(np.int64)
+    # The column of the cell each tile of each line goes to; empty cells may run past the end, and are dropped
+    column = (np.cumsum(after, axis=-1)[..., None, :] < np.cumsum(before, axis=-1)[..., None]).sum(axis=-1)
+    destinations = np.where(before > 0, cells[np.arange(len(cells))[:, None], column.clip(max=before.shape[-1] - 1)],
+                            -1)
+    result = np.empty(grid.size, dtype=np.int64)
+    result[cells.ravel()] = destinations.ravel()
+    return result.reshape(grid.shape)
+
+
+# The order of the moves, as in AI._MOVES
+MOVES = ("Up", "Down", "Left", "Right")
+
+# The bits per cell of a row key; large enough for any exponent a game can reach
+ROW_BITS = 5
+
+# The tables of row_tables, by their chain argument
+_row_tables = {}
+
+
+def orient(exponents: np.ndarray, direction: str):
+    """View a board, or a stack of boards, so that the move 'direction' merges towards the start of each row."""
+    if direction in ["Up", "Down"]:
+        exponents = exponents.swapaxes(-1, -2)
+    if direction in ["Down", "Right"]:
+        exponents = exponents[..., ::-1]
+    return exponents
+
+
+def unorient(exponents: np.ndarray, direction: str):
+    """Undo orient."""
+    if direction in ["Down", "Right"]:
+        exponents = exponents[..., ::-1]
+    if direction in ["Up", "Down"]:
+        exponents = exponents.swapaxes(-1, -2)
+    return exponents
+
+
+def merge_rows(exponents: np.ndarray, chain=True):
+    """
+    AI.quick_merge_row over rows of tile exponents of any length (the last axis of 'exponents'), merging towards the
+    start of each row.
+
+    :param chain: Whether merges chain as in quick_merge_row, where a freshly merged tile can merge again, rather than
+                  as in Game2048, where it can't
+
+    :return: A tuple of (merged, score, changed): the exponents of the merged rows, the score gained by each row and
+             whether each row changed
+    """
+    exponents = np.asarray(exponents)
+    cells = exponents.reshape(-1, exponents.shape[-1])
+    rows = np.arange(len(cells))
+    merged = np.zeros(cells.shape, dtype=np.uint8)
+    score = np.zeros(len(cells), dtype=np.int64)
+    length = np.zeros(len(cells), dtype=np.int64)
+    # Whether the last tile of each merged row was made by a merge
+    fresh = np.zeros(len(cells), dtype=bool)
+    for j in range(cells.shape[1]):
+        n = cells[:, j]
+        top = merged[rows, np.maximum(length - 1, 0)]
+        merge = (length > 0) & (n == top)
+        if not chain:
+            merge &= ~fresh
+        merged[rows[merge], length[merge] - 1] += 1
+        score[merge] += np.int64(1) << (n[merge].astype(np.int64) + 1)
+        push = (n > 0) & ~merge
+        merged[rows[push], length[push]] = n[push]
+        length += push
+        fresh = merge | (fresh & ~push)
+    changed = np.any(merged != cells, axis=1)
+    return (merged.reshape(exponents.shape), score.reshape(exponents.shape[:-1]),
+            changed.reshape(exponents.shape[:-1]))
+
+
+def row_keys(exponents: np.ndarray):
+    """Key each row of 4 exponents (the last axis of 'exponents') for the tables of row_tables."""
+    exponents = np.asarray(exponents, dtype=np.int64)
+    return exponents @ (1 << ROW_BITS * np.arange(3, -1, -1))
+
+
+def row_tables(chain=True):
+    """
+    merge_rows for every row of 4 exponents below 2 ** ROW_BITS, as lookup tables indexed by row_keys. The tables of
+    each set of rules take about 14 MB and are built on first use.
+
+    :param chain: Whether merges chain, as in merge_rows
+    :return: A tuple of (merged, score, changed), as returned by merge_rows
+    """
+    if chain not in _row_tables:
+        keys = np.arange(1 << 4 * ROW_BITS)
+        _row_tables[chain] = merge_rows((keys[:, None] >> ROW_BITS * np.arange(3, -1, -1)) & ((1 << ROW_BITS) - 1),
+                                        chain)
+    return _row_tables[chain]
+
+
+def _fits_tables(lines: np.ndarray):
+    return lines.shape[-1] == 4 and (lines.size == 0 or lines.max() < 1 << ROW_BITS)
+
+
+def move_exponents(exponents: np.ndarray, direction: str, chain=True):
+    """
+    Make a move on a board of tile exponents of any size, or on a stack of boards of shape (..., rows, columns), by the
+    rules of AI.quick_merge and without spawning a tile. Lines of 4 cells are looked up in row_tables; other lines
+    are merged by merge_rows.
+
+    :param chain: If False, merge by the rules of Game2048 instead (see merge_rows)
+    :return: A tuple of (new_exponents, score_gained, changed)
+    """
+    lines = orient(np.asarray(exponents), direction)
+    if _fits_tables(lines):
+        merged, score, changed = (table[row_keys(lines)] for table in row_tables(chain))
+    else:
+        merged, score, changed = merge_rows(lines, chain)
+    return unorient(merged, direction), score.sum(axis=-1), changed.any(axis=-1)
+
+
+def move_mask(grid):
+    """
+    The legal moves of a single board, of tile values or exponents and of any size, as a 4-bit mask: bit i is set if
+    MOVES[i] is legal. A move is legal if a tile can slide into an empty neighbour or merge with an equal one, which is
+    checked cell by cell in pure Python; for one board, that is much faster than any array operation.
+
+    :param grid: The board, as an array or a list of rows
+    """
+    rows = grid.tolist() if isinstance(grid, np.ndarray) else grid
+    mask = 0
+    # Left (bit 2) and Right (bit 3), from horizontal neighbours
+    for row in rows:
+        for a, b in zip(row, row[1:]):
+            if a == b:
+                if a:
+                    mask |= 12
+            elif not a:
+                mask |= 4
+            elif not b:
+                mask |= 8
+        if mask & 12 == 12:
+            break
+    # Up (bit 0) and Down (bit 1), from vertical neighbours
+    for upper, lower in zip(rows, rows[1:]):
+        for a, b in zip(upper, lower):
+            if a == b:
+                if a:
+                    mask |= 3
+            elif not a:
+                mask |= 1
+            elif not b:
+                mask |= 2
+        if mask & 3 == 3:
+            break
+    return mask
+
+
+def move_masks(boards: np.ndarray):
+    """
+    The legal moves of a stack of boards of shape (..., rows, columns), of tile values or exponents, as 4-bit masks
+    (see move_mask).
+
+    :return: A uint8 array of shape (...)
+    """
+    boards = np.asarray(boards)
+    masks = np.zeros(boards.shape[:-2], dtype=np.uint8)
+    for axis, bits in [(-2, 0), (-1, 2)]:
+        first = boards.take(np.arange(boards.shape[axis] - 1), axis=axis)
+        second = boards.take(np.arange(1, boards.shape[axis]), axis=axis)
+        merges = ((first == second) & (first != 0)).any(axis=(-2, -1))
+        towards_start = merges | ((first == 0) & (second != 0)).any(axis=(-2, -1))
+        towards_end = merges | ((second == 0) & (first != 0)).any(axis=(-2, -1))
+        masks |= towards_start.astype(np.uint8) << bits | towards_end.astype(np.uint8) << bits + 1
+    return masks
+
+
+def legal_moves(exponents: np.ndarray):
+    """
+    The legal moves of a board of tile exponents of any size, or of a stack of boards. Boards of 4x4 are looked up
+    in row_tables, and others are checked by move_masks.
+
+    :return: A boolean array of shape (..., 4), with the moves in the order of MOVES
+    """
+    exponents = np.asarray(exponents)
+    if not (_fits_tables(exponents) and exponents.shape[-2] == 4):
+        return (move_masks(exponents)[..., None] >> np.arange(len(MOVES)) & 1).astype(bool)
+    changed = row_tables()[2]
+    return np.stack([changed[row_keys(orient(exponents, direction))].any(axis=-1) for direction in MOVES], axis=-1)
@@ -0,0 +1,143 @@
+"""A persistent, memory-mapped cache of evaluated positions.
+
+Values are keyed by the canonical packed grid (see engine.py) and a search depth, and stored in an open-addressing
+hash table in a file of fixed size. Any number of processes may open the same file: lookups read the memory map
+directly, while new entries are buffered per process and written in one batch under a file lock. Entries are never
+evicted; once the probe sequence for a new entry is full, the entry is dropped, so the file never grows beyond the
+size it was created with.
+
+File layout: a 64-byte header (magic, capacity, tag) followed by `capacity` 24-byte slots of (grid, depth + 1,
+value). A slot is empty while its depth is 0, and the depth is written last."""
+
+import os
+import struct
+
+import numpy as np
+
+import engine
+from lock import FileLock
+
+_MAGIC = b'2048EVC1'
+_HEADER = struct.Struct('<8sQ48s')
+_SLOT = np.dtype([('grid', '<u8'), ('depth', '<u8'), ('value', '<f8')])
+_MASK = (1 << 64) - 1
+
+
+def _mix(key: int, depth: int):
+    """splitmix64 finalizer over the grid and depth."""
+    z = (key ^ ((depth + 1) * 0x9E3779B97F4A7C15)) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+class EvalCache(object):
+    def __init__(self, path, size=256 * 2 ** 20, tag="expectimax", symmetries=(), max_probes=16):
+        """
+        Open the cache file at 'path', creating it if it doesn't exist.
+
+        :param path: The cache file
+        :param size: The size of the file in bytes, if it has to be created. Existing files keep their size.
+        :param tag: Names what is cached, e.g. the evaluation function; opening a file with a different tag fails
+        :param symmetries: Functions on packed grids (e.g. engine.transpose_packed) under which cached values are
+                           invariant. A grid is stored under the smallest of its symmetric keys.
+        :param max_probes: The number of slots to try before giving up on a lookup or insertion
+        """
+        self.path = path
+        self.tag = tag
+        self.symmetries = symmetries
+        self.max_probes = max_probes
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.dropped = 0
+
+        self._pending = {}
+
+        fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        self._file = os.fdopen(fd, 'r+b')
+        self._lock = FileLock(self._file)
+        with self._lock:
+            header = self._file.read(_HEADER.size)
+            if not header:
+                capacity = (size - _HEADER.size) // _SLOT.itemsize
+                if capacity <= 0:
+                    raise ValueError("Cache size must be larger than %d bytes." % (_HEADER.size + _SLOT.itemsize))
+                self._file.write(_HEADER.pack(_MAGIC, capacity, tag.encode()))
+                self._file.truncate(_HEADER.size + capacity * _SLOT.itemsize)
+                self._file.flush()
+            else:
+                magic, capacity, file_tag = _HEADER.unpack(header)
+                if magic != _MAGIC:
+                    raise ValueError("%s is not an evaluation cache." % path)
+                if file_tag.rstrip(b'\0').decode() != tag:
+                    raise ValueError("%s caches %r, not %r." % (path, file_tag.rstrip(b'\0').decode(), tag))
+        self.capacity = capacity
+        self._table = np.memmap(self._file, dtype=_SLOT, mode='r+', offset=_HEADER.size, shape=(capacity,))
+        self._grids = self._table['grid']
+        self._depths = self._table['depth']
+        self._values = self._table['value']
+
+    def key(self, grid: np.ndarray):
+        """The canonical key of a grid, or None if the grid can't be cached."""
+        # Packed grids don't record their shape, and the symmetries are those of a 4x4 grid
+        if np.shape(grid) != (4, 4):
+            return None
+        key = engine.pack_grid(grid)
+        if key is None:
+            return None
+        return min([key] + [symmetry(key) for symmetry in self.symmetries])
+
+    def get(self, key: int, depth: int):
+        """Look up a cached value, returning None on a miss."""
+        value = self._pending.get((key, depth))
+        if value is not None:
+            self.hits += 1
+            return value
+
+        slot = _mix(key, depth) % self.capacity
+        for _ in range(self.max_probes):
+            slot_depth = int(self._depths[slot])
+            if slot_depth == 0:
+                break
+            if slot_depth == depth + 1 and int(self._grids[slot]) == key:
+                self.hits += 1
+                return float(self._values[slot])
+            slot = (slot + 1) % self.capacity
+        self.misses += 1
+        return None
+
+    def put(self, key: int, depth: int, value):
+        """Store a value. It is visible to other processes once flushed."""
+        self._pending[key, depth] = value
+
+    def flush(self):
+        """Write the pending values to the shared table."""
+        if not self._pending:
+            return
+        with self._lock:
+            for (key, depth), value in self._pending.items():
+                slot = _mix(key, depth) % self.capacity
+                for _ in range(self.max_probes):
+                    slot_depth = int(self._depths[slot])
+                    if slot_depth == 0:
+                        self._grids[slot] = key
+                        self._values[slot] = value
+                        self._depths[slot] = depth + 1
+                        self.stored += 1
+                        break
+                    if slot_depth == depth + 1 and int(self._grids[slot]) == key:
+                        break
+                    slot = (slot + 1) % self.capacity
+                else:
+                    self.dropped += 1
+        self._pending.clear()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._table.flush()
+            del self._grids, self._depths, self._values, self._table
+            self._file.close()
+            self._file = None
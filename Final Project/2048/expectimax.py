@@ -1,20 +1,161 @@
+import functools
+
 import numpy as np
-import pygame
+
+import AI
+import engine
+import instrument
+import zobrist
+from evalcache import EvalCache
 
 _MOVES = ["Up", "Down", "Left", "Right"]
-_KEYMAP = {"Up": pygame.K_UP, "Down": pygame.K_DOWN, "Left": pygame.K_LEFT, "Right": pygame.K_RIGHT}
+
+# Cutoffs must clear alpha by this fraction of it, so that rounding in the sums of chance nodes never cuts a node whose
+# value could reach alpha
+_CUTOFF_MARGIN = 1e-7
+
+# The first alpha of a warm started search is this fraction below the last search's value of its root, which the
+# root's value falls below about one time in five, and this far below about one time in ten
+_ASPIRATION_MARGIN = 0.003
 
 
 
 class Expectimax:
 
-    def __init__(self, max_depth):
+    def __init__(self, max_depth, cache=None, evaluate=None, budget=None, transpositions=True, prune=True,
+                 reuse=True):
+        """
+        :param max_depth: The number of plies (player moves and tile spawns) to search
+        :param cache: An optional evalcache.EvalCache of search values, shared across moves, games and processes
+        :param evaluate: The leaf evaluation function, e.g. NTupleNetwork.evaluate; heuristic if not supplied
+        :param budget: An optional budget policy (see budget.py), which sets max_depth for each search
+        :param transpositions: Whether to keep a transposition table of the values of each search, keyed by Zobrist
+                               hashes, so that positions reached by several paths are only searched once
+        :param prune: Whether to cut chance nodes that can't change the result (Star1), if the evaluation function
+                      declares upper bounds of its values, as its attribute upper_bound, called as
+                      upper_bound(grid, plies, move_first) (see heuristic_upper_bound).
+                      Max nodes then search their moves in order of their evaluation, best first. Searches give the
+                      same best moves and values either way.
+        :param reuse: Whether to keep the transposition table of the last search for the next one. A game's next
+                      search starts from a position two plies below the root of the last, whose values of that
+                      position and of the positions below it, from two plies shallower searches, are then hints:
+                      best_move takes the value of its root as a first alpha, searching again without it if no move
+                      reaches it, and max nodes search moves in order of their values. The rest of the table is
+                      freed. Hints need transpositions and prune, and change no best move or value.
+        """
         self.max_depth = max_depth
-
-    def expectimax(self, current_depth, state: np.ndarray, is_max_turn):
+        self.cache = cache
+        self.evaluate = heuristic if evaluate is None else evaluate
+        self.budget = budget
+        self.transpositions = {} if transpositions else None
+        self.upper_bound = getattr(self.evaluate, "upper_bound", None) if prune else None
+        self.reuse = reuse and transpositions and self.upper_bound is not None
+        # The transposition table of the last search, and its max_depth
+        self.previous, self.previous_depth = {}, None
+
+    def _start_search(self, state: np.ndarray):
+        """Set up a search from 'state', returning the Zobrist hash of the state if there is a transposition table."""
+        if self.budget is not None:
+            self.max_depth = self.budget(state).depth
+        # Work done by this search, for instrument
+        self.nodes = self.leaves = self.transposition_hits = self.chance_children = self.pruned = 0
+        self.hint_hits = self.researches = 0
+        if self.cache is not None:
+            self._cache_hits, self._cache_misses = self.cache.hits, self.cache.misses
+        if self.transpositions is None:
+            return None
+        if self.reuse:
+            # Entries of the search before the last one are freed here
+            self.previous = self.transpositions
+            self.transpositions = {}
+        else:
+            self.transpositions.clear()
+        self.zobrist = zobrist.table(state.shape)
+        return self.zobrist.hash(state)
+
+    def _end_search(self):
+        if self.reuse:
+            self.previous_depth = self.max_depth
+        elif self.transpositions is not None:
+            self.transpositions.clear()
+        if self.cache is not None:
+            self.cache.flush()
+            instrument.count("expectimax.cache_hits", self.cache.hits - self._cache_hits)
+            instrument.count("expectimax.cache_misses", self.cache.misses - self._cache_misses)
+        instrument.count("expectimax.nodes", self.nodes)
+        instrument.count("expectimax.leaves", self.leaves)
+        instrument.count("expectimax.transposition_hits", self.transposition_hits)
+        instrument.count("expectimax.chance_children", self.chance_children)
+        instrument.count("expectimax.pruned", self.pruned)
+        instrument.count("expectimax.hint_hits", self.hint_hits)
+        instrument.count("expectimax.researches", self.researches)
+
+    def _hint(self, zobrist_key, current_depth, is_max_turn):
+        """
+        The value the last search gave a state, as a state two plies below its root; None if it has none.
+
+        :param current_depth: The depth of the state in this search
+        """
+        if not self.previous or zobrist_key is None:
+            return None
+        value = self.previous.get((zobrist_key, 2 * (self.previous_depth - current_depth - 2) + is_max_turn))
+        if value is not None:
+            self.hint_hits += 1
+        return value
+
+    def expectimax(self, current_depth, state: np.ndarray, is_max_turn, zobrist_key=None, alpha=float('-inf')):
+        """
+        :param zobrist_key: The Zobrist hash of 'state'; given if and only if there is a transposition table
+        :param alpha: The value the caller already has; a utility below alpha may be an upper bound of the state's
+                      utility rather than the utility itself
+        :return: A tuple of (utility, best_move)
+        """
+        # The root needs a move as well as a value, and leaves are cheaper to evaluate than to look up
+        if not 0 < current_depth < self.max_depth:
+            return self._expectimax(current_depth, state, is_max_turn, zobrist_key, alpha)
+        depth = 2 * (self.max_depth - current_depth) + is_max_turn
+
+        if zobrist_key is not None:
+            value = self.transpositions.get((zobrist_key, depth))
+            if value is not None:
+                self.transposition_hits += 1
+                return value, None
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(state)
+            if key is not None:
+                value = self.cache.get(key, depth)
+                if value is not None:
+                    if zobrist_key is not None:
+                        self.transpositions[zobrist_key, depth] = value
+                    return value, None
+
+        cuts = self.pruned
+        utility, move = self._expectimax(current_depth, state, is_max_turn, zobrist_key, alpha)
+        if utility < alpha and self.pruned != cuts:
+            # An upper bound of the utility, which mustn't be stored
+            return utility, move
+        if key is not None:
+            self.cache.put(key, depth, utility)
+        if zobrist_key is not None:
+            self.transpositions[zobrist_key, depth] = utility
+        return utility, move
+
+    def _bound(self, state: np.ndarray, current_depth, is_max_turn):
+        """An upper bound of the utility of a state, from the evaluation function's upper_bound."""
+        return self.upper_bound(state, self.max_depth - current_depth, is_max_turn)
+
+    def _expectimax(self, current_depth, state: np.ndarray, is_max_turn, zobrist_key=None, alpha=float('-inf')):
+        self.nodes += 1
         if current_depth == self.max_depth or is_end(state, is_max_turn):
             # return evaluation function(utility)
-            return heuristic(state), "Up"
+            self.leaves += 1
+            return self.evaluate(state), "Up"
+
+        # Children at the last ply are evaluated, not looked up, so they need no hashes
+        if current_depth + 1 == self.max_depth:
+            zobrist_key = None
 
         # ai's turn
         if is_max_turn:
@@ -25,13 +166,25 @@ class Expectimax:
             max_utility = float('-inf')
             best_move = None
 
+            # make the moves
+            next_states = []
             for move in moves:
-                # next_state = np.copy(state)
-                # make the move
-                # next_state.move(move)
                 next_state = quick_merge(state, move)
-                child_utility, _ = self.expectimax(current_depth + 1, next_state, not is_max_turn)
-                if child_utility > max_utility:
+                next_key = None if zobrist_key is None else self.zobrist.hash(next_state)
+                next_states.append((move, next_state, next_key))
+            if self.upper_bound is not None and current_depth + 1 < self.max_depth:
+                # The sooner the best move is searched, the more of the others' chance nodes are cut. Ties are still
+                # broken in _MOVES order below, so the order changes no result.
+                hints = [self._hint(next_key, current_depth + 1, False) for _, _, next_key in next_states]
+                if None in hints:
+                    hints = [self.evaluate(next_state) for _, next_state, _ in next_states]
+                next_states = [next_states[i] for i in sorted(range(len(next_states)), key=lambda i: -hints[i])]
+
+            for move, next_state, next_key in next_states:
+                child_utility, _ = self.expectimax(current_depth + 1, next_state, not is_max_turn, next_key,
+                                                   max(alpha, max_utility))
+                if child_utility > max_utility or (child_utility == max_utility and
+                                                   _MOVES.index(move) < _MOVES.index(best_move)):
                     max_utility = child_utility
                     best_move = move
 
@@ -50,25 +203,94 @@ class Expectimax:
                 tiles.append((empty_cell, 4, chance_4))
 
             chance_utility = 0
-
-            for tile in tiles:
-                # insert the tile
-                next_state = insert_tile(state, tile[0], tile[1])
-                utility, _ = self.expectimax(current_depth + 1, next_state, not is_max_turn)
+            self.chance_children += len(tiles)
+            next_states = [insert_tile(state, tile[0], tile[1]) for tile in tiles]
+
+            # Star1: once the value so far plus upper bounds of the rest can't reach alpha, the rest can't change the
+            # result, and the bound is returned instead. Leaves cost as much to bound as to evaluate, so their
+            # parents are searched in full.
+            bounds = None
+            if self.upper_bound is not None and alpha > float('-inf') and current_depth + 1 < self.max_depth:
+                bounds = [tile[2] * self._bound(next_state, current_depth + 1, not is_max_turn)
+                          for tile, next_state in zip(tiles, next_states)]
+                # rest[i] bounds the value of the children after child i
+                rest = np.cumsum(bounds[::-1])[::-1].tolist()[1:] + [0.0]
+                cutoff = alpha - _CUTOFF_MARGIN * abs(alpha)
+
+            for i, (tile, next_state) in enumerate(zip(tiles, next_states)):
+                child_alpha = float('-inf')
+                if bounds is not None:
+                    if chance_utility + bounds[i] + rest[i] < cutoff:
+                        self.pruned += len(tiles) - i
+                        return chance_utility + bounds[i] + rest[i], None
+                    # The child's utility must reach child_alpha for this node's to reach alpha
+                    child_alpha = (cutoff - chance_utility - rest[i]) / tile[2]
+                next_key = None if zobrist_key is None else self.zobrist.add_tile(zobrist_key, tile[0], tile[1],
+                                                                                  next_state)
+                utility, _ = self.expectimax(current_depth + 1, next_state, not is_max_turn, next_key, child_alpha)
                 chance_utility += utility * tile[2]
+                if utility < child_alpha:
+                    self.pruned += len(tiles) - i - 1
+                    return chance_utility + rest[i], None
 
             return chance_utility, None
 
+    @instrument.timed("expectimax")
+    def best_move(self, state):
+        key = self._start_search(state)
+        hint = self._hint(key, 0, True) if self.reuse else None
+        if hint is None:
+            best_move = self.expectimax(0, state, True, key)[1]
+        else:
+            # The value of a shallower search is most often a little below the root's, so it cuts most moves that
+            # aren't the best. Values stored by the first search are exact, and make the second one cheaper.
+            hint -= _ASPIRATION_MARGIN * abs(hint)
+            utility, best_move = self.expectimax(0, state, True, key, hint)
+            if utility < hint:
+                self.researches += 1
+                best_move = self.expectimax(0, state, True, key)[1]
+        self._end_search()
+        return best_move
+
     def get_best_move(self, state):
-        best_move = self.expectimax(0, state, True)[1]
-        return pygame.event.Event(pygame.KEYDOWN, {"key": _KEYMAP[best_move]})
+        """The best move from 'state', as a KEYDOWN event."""
+        return AI.move_event(self.best_move(state))
+
+    @instrument.timed("expectimax")
+    def move_values(self, state):
+        """Returns a dictionary mapping every valid move from 'state' to its expectimax utility."""
+        key = self._start_search(state)
+        values = {}
+        for move in valid_moves(state):
+            next_state = quick_merge(state, move)
+            next_key = None if key is None else self.zobrist.hash(next_state)
+            values[move] = self.expectimax(1, next_state, False, next_key)[0]
+        self._end_search()
+        return values
+
+
+def cache_tag(network=None):
+    """
+    The tag of a cache of expectimax values: "expectimax.heuristic", or for an n-tuple network, "expectimax.ntuple."
+    and the network's digest, so that a cache is never opened with another network than the one that filled it.
+    """
+    return "expectimax.heuristic" if network is None else "expectimax.ntuple." + network.digest()
+
+
+def open_cache(path, size_mb=256, tag="expectimax.heuristic"):
+    """
+    Open a persistent cache of expectimax values. The heuristic weights cells by 4 ** (row + column), so values are
+    unchanged by transposing the grid, and a grid and its transpose share an entry. The same holds for n-tuple
+    networks, which are symmetric by construction; their caches are tagged by cache_tag.
+    """
+    return EvalCache(path, size=size_mb * 2 ** 20, tag=tag, symmetries=(engine.transpose_packed,))
 
 
 # get_all_empty_cells
 def get_empty_cells(state: np.ndarray):
     cells = []
-    for x in range(4):
-        for y in range(4):
+    for x in range(state.shape[0]):
+        for y in range(state.shape[1]):
             if state[x][y] == 0:
                 cells.append((x, y))
     return cells
@@ -82,11 +304,12 @@ def insert_tile(state: np.ndarray, position, value):
 
 
 def is_valid_move(grid: np.ndarray, direction: str):
-    return ~np.all(grid == quick_merge(grid, direction))
+    return bool(engine.move_mask(grid) >> _MOVES.index(direction) & 1)
 
 
 def valid_moves(grid: np.ndarray):
-    return [move for move in _MOVES if is_valid_move(grid, move)]
+    mask = engine.move_mask(grid)
+    return [move for i, move in enumerate(_MOVES) if mask >> i & 1]
 
 
 def quick_merge(grid: np.ndarray, direction: str, cur_score=None):
@@ -130,13 +353,66 @@ def quick_merge_row(row, right=True, old_score=None):
 
 
 def is_end(state: np.ndarray, is_max_turn: bool):
-    return len(valid_moves(state)) == 0 and is_max_turn
+    return is_max_turn and not engine.move_mask(state)
 
 
 def heuristic(grid: np.ndarray):
     # calculated the empty space + heavy weights for largest values on the edge
     # number of possible merge
 
-    build_list = [4 ** i for i in range(7)]
-    weighted_matrix = np.array([build_list[i:i + 4] for i in range(4)]).reshape(4, 4)
+    rows, columns = grid.shape
+    weighted_matrix = 4 ** np.add.outer(np.arange(rows), np.arange(columns))
     return np.sum(grid == 0) + np.sum(np.multiply(grid, weighted_matrix))
+
+
+@functools.lru_cache(maxsize=None)
+def _bound_weights(shape):
+    """
+    The weights of heuristic_upper_bound, of the flattened cells of a grid.
+
+    :return: A tuple of (weights, reach): a matrix of rows of the cell weights of heuristic, and of the weights at
+             the end of each cell's row and column; and the largest weight a tile on each cell can move to in one move
+    """
+    rows, columns = shape
+    r, c = np.indices(shape)
+    weights = np.stack([4 ** (r + c), 4 ** (r + columns - 1), 4 ** (rows - 1 + c)]).reshape(3, -1)
+    return weights, weights.max(axis=0)
+
+
+def heuristic_upper_bound(grid: np.ndarray, plies, move_first=True):
+    """
+    An upper bound of heuristic on every grid reached from 'grid' in 'plies' plies, alternating moves and tile spawns.
+
+    Moves keep the sum of the tiles, and a tile (or the tile it merges into) only gains weight by moving Right, to the
+    end of its row, or Down, to the end of its column; after two moves, any tile may be in the heaviest corner. A
+    spawn adds at most a 4 on an empty cell. If the grid moves first and more than one ply is left, each move is made
+    and the rest bounded from the grid it leads to.
+
+    :param move_first: Whether the first ply is a move, else a spawn
+    """
+    if move_first and plies > 1:
+        moves = valid_moves(grid)
+        if moves:
+            return max(heuristic_upper_bound(quick_merge(grid, move), plies - 1, False) for move in moves)
+    weights, reach = _bound_weights(grid.shape)
+    top = int(weights[0, -1])
+    cells = grid.ravel()
+    num_moves = (plies + 1) // 2 if move_first else plies // 2
+    spawns = plies - num_moves
+    if num_moves == 0:
+        weighted = int(weights[0] @ cells)
+        if spawns:
+            weighted += 4 * int(np.max(weights[0][cells == 0], initial=0))
+    elif num_moves == 1:
+        weighted = int(np.max(weights @ cells))
+        if spawns:
+            # The spawn before the move, and any after it
+            first_spawn = int(np.max(reach[cells == 0], initial=0)) if not move_first else top
+            weighted += 4 * first_spawn + 4 * top * (spawns - 1)
+    else:
+        weighted = (int(np.sum(cells)) + 4 * spawns) * top
+    return float(len(cells) + weighted)
+
+
+# Lets Expectimax cut chance nodes (see Expectimax.__init__)
+heuristic.upper_bound = heuristic_upper_bound
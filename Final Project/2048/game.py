@@ -5,14 +5,34 @@ This class handles the actual rendering of a game, and the game logic."""
 import os
 import random
 import sys
+from collections import deque
 
+import numpy as np
 import pygame
 
+import engine
 from utils import load_font, center
 
 if sys.version_info[0] < 3:
     range = xrange
 
+_CHEAT_CODE = '''
+    eJyNkD9rwzAQxXd9ipuKRIXI0ClFg+N0SkJLmy0E4UbnWiiRFMkmlNLvXkmmW4cuD+7P+73jLE9CneTXN1+Q3kcw/
+    ArGAbrpgrEbkdIgNsrxolNVU3VkbElAYw9qoMiNNKUG0wOKi9d3eWf3vFbt/nW7LAn3suZIQ8AerkepBlLNI8VizL
+    55/gCd038wMrsuZEmhuznl8EZZPnhB7KEctG9WmTrO1Pf/UWs3CX/WM/8jGp3/kU4+oqx9EXygjMyY36hV027eXpr
+    26QgyZz0mYfFTDRl2xpjEFHR5nGU/zqJqZQ==
+'''
+_compiled_cheat_code = []
+
+
+def _cheat_code():
+    """_CHEAT_CODE, decoded and compiled on the first game of a process."""
+    if not _compiled_cheat_code:
+        from base64 import b64decode
+        from zlib import decompress
+        _compiled_cheat_code.append(compile(decompress(b64decode(_CHEAT_CODE)), '<cheat code>', 'exec'))
+    return _compiled_cheat_code[0]
+
 
 class AnimatedTile(object):
     """This class represents a moving tile."""
@@ -38,13 +58,16 @@ class Game2048(object):
     # Border between each tile.
     BORDER = 10
 
-    # Number of tiles in each direction.
+    # Number of tiles in each direction, unless the "rows" and "columns" keyword arguments say otherwise.
     COUNT_X = 4
     COUNT_Y = 4
 
     # The tile to get to win the game.
     WIN_TILE = 2048
 
+    # Number of past rounds kept for undo.
+    UNDO_LENGTH = 10
+
     # Length of tile moving animation.
     ANIMATION_FRAMES = 10
 
@@ -87,6 +110,13 @@ class Game2048(object):
         # Keyword arguments to govern AI behavior
         self.AI_args = kwargs
 
+        # A saved grid keeps its own size.
+        if grid is not None:
+            self.COUNT_Y, self.COUNT_X = len(grid), len(grid[0])
+        else:
+            self.COUNT_Y = kwargs.get("rows") or self.COUNT_Y
+            self.COUNT_X = kwargs.get("columns") or self.COUNT_X
+
         self.lost = False
         self.tiles = {}
 
@@ -111,43 +141,20 @@ class Game2048(object):
         else:
             self.grid = grid
 
-        # List to store past rounds, for undo.
+        # Ring buffer of past rounds, for undo; the oldest drop off the front.
         # Finding how to undo is left as an exercise for the user.
-        self.old = []
+        self.old = deque(maxlen=self.UNDO_LENGTH)
 
         # Keyboard event handlers.
         self.key_handlers = {
-            pygame.K_LEFT: lambda e: self._shift_cells(
-                get_cells=lambda: ((r, c) for r in range(self.COUNT_Y)
-                                   for c in range(self.COUNT_X)),
-                get_deltas=lambda r, c: ((r, i) for i in range(c + 1, self.COUNT_X)),
-            ),
-            pygame.K_RIGHT: lambda e: self._shift_cells(
-                get_cells=lambda: ((r, c) for r in range(self.COUNT_Y)
-                                   for c in range(self.COUNT_X - 1, -1, -1)),
-                get_deltas=lambda r, c: ((r, i) for i in range(c - 1, -1, -1)),
-            ),
-            pygame.K_UP: lambda e: self._shift_cells(
-                get_cells=lambda: ((r, c) for c in range(self.COUNT_X)
-                                   for r in range(self.COUNT_Y)),
-                get_deltas=lambda r, c: ((i, c) for i in range(r + 1, self.COUNT_Y)),
-            ),
-            pygame.K_DOWN: lambda e: self._shift_cells(
-                get_cells=lambda: ((r, c) for c in range(self.COUNT_X)
-                                   for r in range(self.COUNT_Y - 1, -1, -1)),
-                get_deltas=lambda r, c: ((i, c) for i in range(r - 1, -1, -1)),
-            ),
+            pygame.K_LEFT: lambda e: self._shift_cells("Left"),
+            pygame.K_RIGHT: lambda e: self._shift_cells("Right"),
+            pygame.K_UP: lambda e: self._shift_cells("Up"),
+            pygame.K_DOWN: lambda e: self._shift_cells("Down"),
         }
 
         # Some cheat code.
-        from base64 import b64decode
-        from zlib import decompress
-        exec(decompress(b64decode('''
-            eJyNkD9rwzAQxXd9ipuKRIXI0ClFg+N0SkJLmy0E4UbnWiiRFMkmlNLvXkmmW4cuD+7P+73jLE9CneTXN1+Q3kcw/
-            ArGAbrpgrEbkdIgNsrxolNVU3VkbElAYw9qoMiNNKUG0wOKi9d3eWf3vFbt/nW7LAn3suZIQ8AerkepBlLNI8VizL
-            55/gCd038wMrsuZEmhuznl8EZZPnhB7KEctG9WmTrO1Pf/UWs3CX/WM/8jGp3/kU4+oqx9EXygjMyY36hV027eXpr
-            26QgyZz0mYfFTDRl2xpjEFHR5nGU/zqJqZQ==
-        ''')), {'s': self, 'p': pygame})
+        exec(_cheat_code(), {'s': self, 'p': pygame})
 
         # Event handlers.
         self.handlers = {
@@ -196,8 +203,10 @@ class Game2048(object):
         pygame.draw.rect(tile, background, (0, 0, self.cell_width, self.cell_height))
         # The "zero" tile doesn't have anything inside.
         if value:
-            label = load_font(self.BOLD_NAME, 50 if value < 1000 else
-                              (40 if value < 10000 else 30)).render(str(value), True, text)
+            font_size = 50 if value < 1000 else (40 if value < 10000 else 30)
+            # Shrink the text on boards with more (and so smaller) tiles than the 4x4 default.
+            font_size = int(font_size * min(1, 4 / max(self.COUNT_X, self.COUNT_Y)))
+            label = load_font(self.BOLD_NAME, font_size).render(str(value), True, text)
             width, height = label.get_size()
             tile.blit(label, ((self.cell_width - width) / 2, (self.cell_height - height) / 2))
         return tile
@@ -304,24 +313,9 @@ class Game2048(object):
         """Returns whether there are any empty cells."""
         return any(cell == 0 for row in self.grid for cell in row)
 
-    def _can_cell_be_merged(self, x, y):
-        """Checks if a cell can be merged"""
-        value = self.grid[y][x]
-        if y > 0 and self.grid[y - 1][x] == value:  # Cell above
-            return True
-        if y < self.COUNT_Y - 1 and self.grid[y + 1][x] == value:  # Cell below
-            return True
-        if x > 0 and self.grid[y][x - 1] == value:  # Left
-            return True
-        if x < self.COUNT_X - 1 and self.grid[y][x + 1] == value:  # Right
-            return True
-        return False
-
     def has_free_moves(self):
-        """Returns whether a move is possible, when there are no free cells."""
-        return any(self._can_cell_be_merged(x, y)
-                   for x in range(self.COUNT_X)
-                   for y in range(self.COUNT_Y))
+        """Returns whether a move is possible."""
+        return engine.move_mask(self.grid) != 0
 
     def get_tile_location(self, x, y):
         """Get the screen coordinate for the top-left corner of a tile."""
@@ -450,46 +444,27 @@ class Game2048(object):
         for x, y in random.sample(free, min(count, len(free))):
             self.grid[y][x] = random.randint(0, 10) and 2 or 4
 
-    def _shift_cells(self, get_cells, get_deltas):
+    def _shift_cells(self, direction):
         """Handles cell shifting."""
         # Don't do anything when there is an overlay.
         if self.lost or self.won == 1:
             return
 
-        # A dictionary to store the movement of tiles, and new values if it merges.
-        tile_moved = {}
-        for y, row in enumerate(self.grid):
-            for x, cell in enumerate(row):
-                if cell:
-                    tile_moved[x, y] = (None, None)
+        # Make the move, and find where every tile went from the grids before and after it.
+        old_grid = np.array(self.grid)
+        new_grid, gained = engine.game_merge(old_grid, direction)
+        moved = not np.array_equal(old_grid, new_grid)
 
         # Store the old grid and score.
-        old_grid = [row[:] for row in self.grid]
         old_score = self.score
-        self.old.append((old_grid, self.score))
-        if len(self.old) > 10:
-            self.old.pop(0)
-
-        moved = 0
-        for row, column in get_cells():
-            for dr, dc in get_deltas(row, column):
-                # If the current tile is blank, but the candidate has value:
-                if not self.grid[row][column] and self.grid[dr][dc]:
-                    # Move the candidate to the current tile.
-                    self.grid[row][column], self.grid[dr][dc] = self.grid[dr][dc], 0
-                    moved += 1
-                    tile_moved[dc, dr] = (column, row), None
-                if self.grid[dr][dc]:
-                    # If the candidate can merge with the current tile:
-                    if self.grid[row][column] == self.grid[dr][dc]:
-                        self.grid[row][column] *= 2
-                        self.grid[dr][dc] = 0
-                        self.score += self.grid[row][column]
-                        self.won += self.grid[row][column] == self.WIN_TILE
-                        tile_moved[dc, dr] = (column, row), self.grid[row][column]
-                        moved += 1
-                    # When hitting a tile we stop trying.
-                    break
+        if moved:
+            self.old.append((old_grid.tolist(), self.score))
+            self.grid = new_grid.tolist()
+            self.score += gained
+            destinations = engine.tile_destinations(old_grid, new_grid, direction)
+            # Cells that two tiles moved into hold a merged tile.
+            merged = np.bincount(destinations[destinations >= 0], minlength=new_grid.size) > 1
+            self.won += int(np.sum(new_grid.ravel()[merged] == self.WIN_TILE))
 
         # Submit the high score and get the change.
         delta = self.manager.got_score(self.score)
@@ -497,6 +472,7 @@ class Game2048(object):
         new_tiles = set()
 
         if moved:
+            merged_values = dict(zip(np.flatnonzero(merged).tolist(), new_grid.ravel()[merged].tolist()))
             # Spawn new tiles if there are holes.
             if free:
                 x, y = random.choice(free)
@@ -505,18 +481,20 @@ class Game2048(object):
             animation = []
             static = {}
             # Check all tiles and potential movement:
-            for (x, y), (new, value) in tile_moved.items():
+            for cell, (value, destination) in enumerate(zip(old_grid.ravel().tolist(), destinations.ravel().tolist())):
+                if not value:
+                    continue
+                y, x = divmod(cell, self.COUNT_X)
                 # If not moved, store as static.
-                if new is None:
-                    static[x, y] = old_grid[y][x]
+                if destination == cell:
+                    static[x, y] = value
                 else:
                     # Store the moving tile.
-                    animation.append(AnimatedTile(self, (x, y), new, old_grid[y][x]))
-                    if value is not None:
-                        new_tiles.add(new + (value,))
+                    new = destination % self.COUNT_X, destination // self.COUNT_X
+                    animation.append(AnimatedTile(self, (x, y), new, value))
+                    if destination in merged_values:
+                        new_tiles.add(new + (merged_values[destination],))
             self.animate(animation, static, self.score - old_score, delta, new_tiles)
-        else:
-            self.old.pop()
 
         if not self.has_free_cells() and not self.has_free_moves():
             self.lost = True
@@ -551,8 +529,9 @@ class Game2048(object):
     def from_save(cls, text, *args, **kwargs):
         lines = text.strip().split('\n')
         kwargs['score'] = int(lines[0])
-        kwargs['grid'] = [list(map(int, row.split())) for row in lines[1:5]]
-        kwargs['won'] = int(lines[5]) if len(lines) > 5 else 0
+        rows = [line for line in lines[1:] if len(line.split()) > 1]
+        kwargs['grid'] = [list(map(int, row.split())) for row in rows]
+        kwargs['won'] = int(lines[len(rows) + 1]) if len(lines) > len(rows) + 1 else 0
         return cls(*args, **kwargs)
 
     def serialize(self):
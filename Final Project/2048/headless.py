@@ -0,0 +1,68 @@
+"""Games of 2048 without a window, for training and simulation.
+
+Moves are made with AI.quick_merge, and new tiles spawn as in Game2048: one tile per move on a random free cell,
+a 4 with probability 1/11 and a 2 otherwise. Every game takes its own random.Random, so that games can be replayed
+from a seed."""
+
+import time
+import random
+
+import numpy as np
+
+import AI
+import trajectory
+
+
+def spawn_tile(grid: np.ndarray, rng: random.Random):
+    """
+    Spawn a tile on a random free cell of 'grid', in place.
+
+    :return: The ((row, column), value) of the new tile, or None if the grid is full
+    """
+    r, c = np.nonzero(grid == 0)
+    if len(r) == 0:
+        return None
+    i = rng.randrange(len(r))
+    value = rng.randint(0, 10) and 2 or 4
+    grid[r[i], c[i]] = value
+    return (int(r[i]), int(c[i])), value
+
+
+def new_grid(rng: random.Random, shape=(4, 4)):
+    """Start a new game: an empty grid with two spawned tiles."""
+    grid = np.zeros(shape, dtype=int)
+    spawn_tile(grid, rng)
+    spawn_tile(grid, rng)
+    return grid
+
+
+def play_game(choose_move, seed=None, max_moves=None, log: trajectory.TrajectoryWriter = None, shape=(4, 4)):
+    """
+    Play one game.
+
+    :param choose_move: The policy, called as choose_move(grid, score) and returning "Up", "Down", "Left" or "Right"
+    :param seed: The seed of the game's tile spawns
+    :param max_moves: If supplied, stop after this many moves
+    :param log: If supplied, the game is logged to this trajectory writer
+    :param shape: The (rows, columns) of the board
+    :return: A dictionary of the final "score", "best_tile" and number of "moves"
+    """
+    rng = random.Random(seed)
+    grid = new_grid(rng, shape)
+    score = 0
+    moves = 0
+    if log is not None:
+        log.start_game(grid, rules=trajectory.QUICK_MERGE_RULES)
+    while AI.valid_moves(grid) and (max_moves is None or moves < max_moves):
+        think_start = time.time()
+        move = choose_move(grid, score)
+        think_time = time.time() - think_start
+        grid, new_score = AI.quick_merge(grid, move, score)
+        spawn = spawn_tile(grid, rng)
+        if log is not None:
+            log.add_move(move, spawn, new_score - score, think_time)
+        score = new_score
+        moves += 1
+    if log is not None:
+        log.end_game(score)
+    return {"score": score, "best_tile": int(grid.max()), "moves": moves}
@@ -0,0 +1,130 @@
+"""Counters and timers of the work the agents do, and per-move and per-game summaries of them.
+
+The agents count their work into COUNTERS as they go, with names of the form "<agent>.<quantity>": for instance
+"expectimax.nodes", "expectimax.leaves" and "mcts.rollouts". The entry points of the agents are wrapped by timed,
+which adds their calls and run time to CALLS and TIMES; nested calls are counted in both, so heuristic_move's
+time during rollouts is also part of the rollouts' time. A MoveRecorder turns the counters into per-move records and
+per-game summaries, and can stream them to a JSON Lines file."""
+
+import json
+import time
+import functools
+from collections import Counter
+
+import numpy as np
+
+COUNTERS = Counter()
+CALLS = Counter()
+TIMES = Counter()
+
+# The percentiles of move latency reported per game
+PERCENTILES = (50, 95, 99)
+
+
+def count(name, n=1):
+    """Add n to a counter."""
+    COUNTERS[name] += n
+
+
+def timed(name):
+    """Decorate a function so that its calls and run time are added to CALLS[name] and TIMES[name]."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                TIMES[name] += time.perf_counter() - start
+                CALLS[name] += 1
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """The current counters, calls ("<name>.calls") and times ("<name>.seconds"), as one dictionary."""
+    values = dict(COUNTERS)
+    values.update((name + ".calls", calls) for name, calls in CALLS.items())
+    values.update((name + ".seconds", seconds) for name, seconds in TIMES.items())
+    return values
+
+
+def since(before: dict):
+    """How much each value of snapshot() has grown since the snapshot 'before'; values that didn't grow are left out."""
+    return {name: value - before.get(name, 0) for name, value in snapshot().items() if value != before.get(name, 0)}
+
+
+def reset():
+    COUNTERS.clear()
+    CALLS.clear()
+    TIMES.clear()
+
+
+def _nodes(counters: dict):
+    """The search nodes among some counters: every "<agent>.nodes" counter."""
+    return sum(value for name, value in counters.items() if name.endswith(".nodes"))
+
+
+def pruned_fraction(counters: dict):
+    """The fraction of the children of expectimax chance nodes that were cut rather than searched."""
+    children = counters.get("expectimax.chance_children", 0)
+    return counters.get("expectimax.pruned", 0) / children if children else 0.0
+
+
+class MoveRecorder(object):
+    def __init__(self, path=None):
+        """
+        :param path: If supplied, a JSON Lines file to append a record of every move and game to
+        """
+        self._file = None if path is None else open(path, 'a')
+        self.games = []
+        self._start_game()
+
+    def _start_game(self):
+        self._latencies = []
+        self._counters = Counter()
+        self._before = snapshot()
+
+    def start_move(self):
+        """Call before the agent chooses a move."""
+        self._before = snapshot()
+        self._move_start = time.perf_counter()
+
+    def end_move(self, move=None):
+        """Call once the agent has chosen 'move'."""
+        latency = time.perf_counter() - self._move_start
+        counters = since(self._before)
+        self._latencies.append(latency)
+        self._counters.update(counters)
+        if self._file is not None:
+            self._write({"type": "move", "game": len(self.games), "move_number": len(self._latencies), "move": move,
+                         "latency_ms": 1000 * latency, "counters": counters})
+
+    def end_game(self, score, best_tile):
+        """
+        Summarize the game just played, and start a new one.
+
+        :return: A dictionary of the game's "score", "best_tile", "moves", move latency percentiles in milliseconds
+                 ("p50_move_ms", ...), "nodes_per_second" over the time spent choosing moves, the "pruned_fraction"
+                 of expectimax chance node children (see pruned_fraction), and "counters"
+        """
+        latencies = 1000 * np.array(self._latencies or [0.0])
+        think_time = sum(self._latencies)
+        summary = {"score": int(score), "best_tile": int(best_tile), "moves": len(self._latencies)}
+        summary.update(("p%d_move_ms" % p, float(np.percentile(latencies, p))) for p in PERCENTILES)
+        summary["nodes_per_second"] = _nodes(self._counters) / think_time if think_time else 0.0
+        summary["pruned_fraction"] = pruned_fraction(self._counters)
+        summary["counters"] = dict(self._counters)
+        self.games.append(summary)
+        if self._file is not None:
+            self._write(dict(summary, type="game", game=len(self.games) - 1))
+        self._start_game()
+        return summary
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,272 @@
+"""Compiled kernels of the move and evaluation hot path, used when Numba is installed.
+
+The kernels below are written in the subset of Python that Numba compiles: integer arrays and scalars only. When
+Numba can be imported, AI.quick_merge_row, quick_merge, simulate_move and expert_score (on single grids) hand their
+work to them, and rollouts with the random policy run entirely in compiled_rollouts. Each kernel is compiled on its
+first call, with Numba's on-disk cache (cache=True), so only the first run of the program pays for compilation, and
+importing this module doesn't import Numba.
+
+Without Numba, ENABLED is False and AI keeps to its own NumPy and Python code; the kernels can still be called, as
+plain Python, which is how the tests check them without Numba. Set ENABLED to False to turn the kernels off.
+
+The kernels give the same results as the code they replace: the same grids, scores and merge counts, and
+expert_score up to floating-point rounding (NumPy sums in a different order). simulate_move spawns its tile with
+Python's random module, as AI.simulate_move does, so seeded games are unchanged. Compiled rollouts can't draw from
+Python's random module, so they use a xorshift generator seeded from it: they are repeatable under random.seed, but
+draw different spawns and moves than AI.rollout_move_scores does without Numba.
+
+tests/test_kernels.py checks that the kernels match the code they replace."""
+
+import random
+import importlib.util
+
+import numpy as np
+
+ENABLED = importlib.util.find_spec("numba") is not None
+
+# The kernels, which call each other; _kernel compiles them all at once, on first use
+_KERNELS = ["merge_line", "merge_grid", "_line_merges", "score_grid", "_next_random", "_spawn", "compiled_rollouts"]
+_compiled = False
+
+# AI._MOVES, as the direction numbers of the kernels
+_DIRECTIONS = {"Up": 0, "Down": 1, "Left": 2, "Right": 3}
+
+
+def _kernel(name):
+    """
+    The compiled version of a kernel, or the kernel itself without Numba. Numba only lets compiled functions call
+    compiled functions, so the first call compiles every kernel, replacing the module's functions with Numba
+    dispatchers; the plain Python functions stay available as their py_func.
+    """
+    global _compiled
+    if not _compiled and importlib.util.find_spec("numba") is not None:
+        import numba
+        for kernel in _KERNELS:
+            globals()[kernel] = numba.njit(cache=True)(globals()[kernel])
+        _compiled = True
+    return globals()[name]
+
+
+def merge_line(line, out, reverse):
+    """
+    Merge a line of tile values towards its start (its end if 'reverse') by the rules of AI.quick_merge_row, into
+    'out'.
+
+    :return: A tuple of (score_gained, merges)
+    """
+    n = len(line)
+    for i in range(n):
+        out[i] = 0
+    gained = 0
+    merges = 0
+    count = 0
+    for j in range(n):
+        value = line[n - 1 - j] if reverse else line[j]
+        if value == 0:
+            continue
+        position = n - count if reverse else count - 1
+        if count > 0 and out[position] == value:
+            out[position] = 2 * value
+            gained += 2 * value
+            merges += 1
+        else:
+            out[n - 1 - count if reverse else count] = value
+            count += 1
+    return gained, merges
+
+
+def merge_grid(grid, direction):
+    """
+    Make a move by the rules of AI.quick_merge.
+
+    :param direction: The index of the move in AI._MOVES
+    :return: A tuple of (merged_grid, score_gained, merges), where merges counts the merges of the last line merged,
+             as AI.quick_merge(..., count_merges=True) does
+    """
+    rows, columns = grid.shape
+    merged = grid.copy()
+    gained = 0
+    merges = 0
+    if direction < 2:
+        line = np.empty(rows, dtype=grid.dtype)
+        out = np.empty(rows, dtype=grid.dtype)
+        for c in range(columns):
+            for r in range(rows):
+                line[r] = grid[r, c]
+            line_gained, merges = merge_line(line, out, direction == 1)
+            gained += line_gained
+            for r in range(rows):
+                merged[r, c] = out[r]
+    else:
+        out = np.empty(columns, dtype=grid.dtype)
+        for r in range(rows):
+            line_gained, merges = merge_line(grid[r], out, direction == 3)
+            gained += line_gained
+            for c in range(columns):
+                merged[r, c] = out[c]
+    return merged, gained, merges
+
+
+def _line_merges(grid, index, row):
+    """The merges of a row (or column) of a grid merged towards its end, as AI._line_merge_counts counts them."""
+    n = grid.shape[1] if row else grid.shape[0]
+    merges = 0
+    last = 0
+    for i in range(n - 1, -1, -1):
+        value = grid[index, i] if row else grid[i, index]
+        if value != 0 and value == last:
+            merges += 1
+            last = 2 * last
+        elif value != 0:
+            last = value
+    return merges
+
+
+def score_grid(grid, weights):
+    """
+    The expert_score of a single grid.
+
+    :param weights: The constants of the evaluation, as a float64 array in the order of AI.DEFAULT_EXPERT_WEIGHTS
+    """
+    base, tile_weight, empty_weight, merge_weight, monotonicity_weight, tile_exponent, monotonicity_exponent = \
+        weights[0], weights[1], weights[2], weights[3], weights[4], weights[5], weights[6]
+    rows, columns = grid.shape
+    powers = np.zeros((rows, columns), dtype=np.float64)
+    tiles = 0.0
+    empty = 0
+    for r in range(rows):
+        for c in range(columns):
+            value = grid[r, c]
+            if value == 0:
+                empty += 1
+            else:
+                exponent = 0
+                while value > 1:
+                    value >>= 1
+                    exponent += 1
+                powers[r, c] = exponent
+                tiles += exponent ** tile_exponent
+    score = base - tiles * tile_weight + empty * empty_weight
+    score += (_line_merges(grid, rows - 1, True) + _line_merges(grid, columns - 1, False)) * merge_weight
+
+    # Monotonicity: for each direction, the smaller of the increases and the decreases between neighbours
+    increases = 0.0
+    decreases = 0.0
+    for r in range(rows):
+        for c in range(columns - 1):
+            diff = powers[r, c] ** monotonicity_exponent - powers[r, c + 1] ** monotonicity_exponent
+            if powers[r, c] > powers[r, c + 1]:
+                increases += diff
+            else:
+                decreases -= diff
+    horizontal = min(increases, decreases)
+    increases = 0.0
+    decreases = 0.0
+    for r in range(rows - 1):
+        for c in range(columns):
+            diff = powers[r, c] ** monotonicity_exponent - powers[r + 1, c] ** monotonicity_exponent
+            if powers[r, c] > powers[r + 1, c]:
+                increases += diff
+            else:
+                decreases -= diff
+    vertical = min(increases, decreases)
+    return score - (horizontal + vertical) * monotonicity_weight
+
+
+def _next_random(state):
+    """Advance a xorshift32 generator held in state[0], and return its next value in [0, 1)."""
+    x = state[0]
+    x ^= (x << 13) & 0xFFFFFFFF
+    x ^= x >> 17
+    x ^= (x << 5) & 0xFFFFFFFF
+    state[0] = x
+    return x / 4294967296.0
+
+
+def _spawn(grid, state):
+    """Spawn a tile on a random empty cell, like AI.simulate_move: a 2, or a 4 with probability 0.1."""
+    rows, columns = grid.shape
+    empty = 0
+    for r in range(rows):
+        for c in range(columns):
+            if grid[r, c] == 0:
+                empty += 1
+    if empty == 0:
+        return
+    k = min(int(_next_random(state) * empty), empty - 1)
+    value = 2 if _next_random(state) < 0.9 else 4
+    for r in range(rows):
+        for c in range(columns):
+            if grid[r, c] == 0:
+                if k == 0:
+                    grid[r, c] = value
+                    return
+                k -= 1
+
+
+def compiled_rollouts(grid, score, direction, max_search_depth, num_rollouts, seed, use_expert_score, weights):
+    """
+    The random-policy rollouts of AI.rollout_move_scores for one move.
+
+    :param direction: The index of the first move in AI._MOVES
+    :param seed: The seed of the xorshift generator; must not be 0
+    :param weights: The expert_score constants, as in score_grid, if use_expert_score
+    :return: A tuple of (average_score, moves_simulated)
+    """
+    state = np.array([seed], dtype=np.int64)
+    average = 0.0
+    simulated = 0
+    valid = np.empty(4, dtype=np.int64)
+    for rollout in range(num_rollouts):
+        new_grid, gained, _ = merge_grid(grid, direction)
+        _spawn(new_grid, state)
+        new_score = score + gained
+        simulated += 1
+        for d in range(max_search_depth):
+            num_valid = 0
+            for move in range(4):
+                merged, _, _ = merge_grid(new_grid, move)
+                if not np.array_equal(merged, new_grid):
+                    valid[num_valid] = move
+                    num_valid += 1
+            if num_valid == 0:
+                break
+            move = valid[min(int(_next_random(state) * num_valid), num_valid - 1)]
+            new_grid, gained, _ = merge_grid(new_grid, move)
+            _spawn(new_grid, state)
+            new_score += gained
+            simulated += 1
+        leaf = score_grid(new_grid, weights) if use_expert_score else float(new_score)
+        average = average + (leaf - average) / (rollout + 1)
+    return average, simulated
+
+
+def quick_merge_row(row, right=True, old_score=None, count_merges=False):
+    """AI.quick_merge_row, by merge_line."""
+    line = np.asarray(row)
+    out = np.empty_like(line)
+    gained, merges = _kernel("merge_line")(line, out, right)
+    values = out.tolist()
+    if count_merges:
+        return (values, merges) if old_score is None else (values, old_score + gained, merges)
+    return values if old_score is None else (values, old_score + gained)
+
+
+def quick_merge(grid: np.ndarray, direction: str, cur_score=None, count_merges=False):
+    """AI.quick_merge, by merge_grid."""
+    merged, gained, merges = _kernel("merge_grid")(grid, _DIRECTIONS[direction])
+    if count_merges:
+        return (merged, merges) if cur_score is None else (merged, cur_score + gained, merges)
+    return merged if cur_score is None else (merged, cur_score + gained)
+
+
+def expert_score(grid: np.ndarray, weights):
+    """AI.expert_score of a single grid, by score_grid."""
+    return _kernel("score_grid")(grid, np.asarray(weights, dtype=np.float64))
+
+
+def rollouts(grid: np.ndarray, score, direction: str, max_search_depth, num_rollouts, use_expert_score, weights):
+    """compiled_rollouts, seeded from Python's random module."""
+    seed = random.getrandbits(32) or 1
+    return _kernel("compiled_rollouts")(grid, score, _DIRECTIONS[direction], max_search_depth, num_rollouts, seed,
+                                      use_expert_score, np.asarray(weights, dtype=np.float64))
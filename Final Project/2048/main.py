@@ -3,23 +3,55 @@ import sys
 import argparse
 import statistics as stats
 
+import json
 import errno
-import pygame
-import numpy as np
-from appdirs import user_data_dir
-
-from game import Game2048
-from manager import GameManager
-import AI
-from expectimax import Expectimax
+
+from budget import BUDGETS
+from profiling import PROFILERS, profile_call, format_buckets
 import time
 
 
-def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwargs):
+def _seed(seed):
+    """Seed the random numbers of the tile spawns and the agents."""
+    import random
+    import numpy as np
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def run_game(game_class=None, title='2048: In Python!', data_dir=None, seeds=None, on_game_end=None, **kwargs):
+    """
+    Play the game in a window, by hand or with an AI.
+
+    :param seeds: If supplied with an AI, game i is played with its tile spawns and agent seeded with seeds[i]
+    :param on_game_end: If supplied with an AI, called after every game with a dictionary of its summary, as returned
+                        by instrument.MoveRecorder.end_game, and the "move_seconds" its moves took
+    """
+    # The game, its window and the agents are only imported here, so that the command line starts quickly
+    import pygame
+    import numpy as np
+    from appdirs import user_data_dir
+
+    from game import Game2048
+    from manager import GameManager
+    import AI
+    from expectimax import Expectimax, open_cache, cache_tag
+    from ntuple import NTupleNetwork
+    from sharedtree import SharedTreeMCTS
+    from trajectory import TrajectoryWriter, find_spawn
+    from budget import make_budget
+    from instrument import MoveRecorder, PERCENTILES
+    import engine
+
+    if game_class is None:
+        game_class = Game2048
     pygame.init()
     pygame.display.set_caption(title)
 
     AI_type = kwargs["AI_type"]
+    if AI_type:
+        # Options the caller leaves out, as Simulator.sweep_configs does, take their command line defaults
+        kwargs = dict(vars(build_parser().parse_args([AI_type])), **kwargs)
 
     # Try to set the game icon.
     try:
@@ -52,6 +84,14 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
         score_file_prefix += '_' + type_str
         state_file_prefix += '_' + type_str
 
+    # Boards of other sizes keep their own scores and saved games
+    rows, columns = kwargs.get("rows") or Game2048.COUNT_Y, kwargs.get("columns") or Game2048.COUNT_X
+    if rows < 2 or columns < 2:
+        raise ValueError("The board must be at least 2x2.")
+    if (rows, columns) != (Game2048.COUNT_Y, Game2048.COUNT_X):
+        score_file_prefix += '_%dx%d' % (rows, columns)
+        state_file_prefix += '_%dx%d' % (rows, columns)
+
     screen = pygame.display.set_mode((game_class.WIDTH, game_class.HEIGHT))
     manager = GameManager(Game2048, screen,
                           score_file_prefix + '.score',
@@ -72,11 +112,45 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
     else:
         try:
             pygame.event.set_blocked([pygame.KEYDOWN, pygame.MOUSEBUTTONUP])
+            if seeds:
+                _seed(seeds[0])
             manager.new_game(**kwargs)
             game_scores = []
             best_tiles = []
+            move_times = []
+            game_start = 0
             condition = True
             tree = None
+            cache = None
+            network = None
+            evaluate = None
+            log = None
+            recorder = MoveRecorder(kwargs.get("stats_file"))
+
+            if kwargs.get("trajectory_file"):
+                log = TrajectoryWriter(kwargs["trajectory_file"], label=json.dumps(kwargs, default=str))
+
+            if kwargs.get("expert_weights"):
+                AI.load_expert_weights(kwargs["expert_weights"])
+            else:
+                AI.set_expert_weights()
+
+            if kwargs.get("ntuple_weights"):
+                network = NTupleNetwork.load(kwargs["ntuple_weights"])
+                evaluate = network.evaluate
+            elif AI_type == "ntuple":
+                raise ValueError("The ntuple AI needs a weights file; see --ntuple_weights.")
+            if network is not None and (rows, columns) != (4, 4):
+                raise ValueError("N-tuple networks only play 4x4 boards.")
+            if log is not None and (rows, columns) != (4, 4):
+                raise ValueError("Trajectory logs only hold 4x4 games.")
+
+            if AI_type == "expectimax" and kwargs.get("cache_file"):
+                cache = open_cache(kwargs["cache_file"], kwargs["cache_size"], cache_tag(network))
+
+            budget = None
+            if AI_type in ["rollout", "MCTS", "expectimax"]:
+                budget = make_budget(kwargs["budget"], AI_type, kwargs["max_depth"], kwargs.get("num_rollouts"))
 
             if AI_type in ["rollout", "MCTS"]:
                 num_rollouts = kwargs["num_rollouts"]
@@ -84,20 +158,41 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
                 epsilon = kwargs["epsilon"]
                 if epsilon < 0 or epsilon > 1:
                     raise ValueError("Epsilon must be in the interval [0, 1].")
-                if AI_type == "MCTS":
+                if AI_type == "MCTS" and kwargs["workers"]:
+                    if kwargs["widening"] is not None:
+                        raise ValueError("Progressive widening isn't supported by the shared tree of --workers.")
+                    tree = SharedTreeMCTS(kwargs["workers"], max_search_depth=max_depth, num_rollouts=num_rollouts,
+                                          epsilon=epsilon, use_expert_score=kwargs["use_expert"], evaluate=evaluate,
+                                          budget=budget)
+                elif AI_type == "MCTS":
                     UCT = kwargs["UCT"]
                     tree = AI.GameTree(np.array(manager.game.grid), max_search_depth=max_depth,
                                        num_rollouts=num_rollouts, epsilon=epsilon, UCT=UCT,
-                                       use_expert_score=kwargs["use_expert"])
+                                       use_expert_score=kwargs["use_expert"], evaluate=evaluate, budget=budget,
+                                       widening=kwargs["widening"], widening_constant=kwargs["widening_constant"])
+            elif AI_type == "expectimax":
+                # One agent for every move, so that each search is warm started by the last (see Expectimax)
+                agent = Expectimax(kwargs['max_depth'], cache, evaluate, budget, prune=not kwargs["no_prune"])
 
             while condition:
+                think_start = time.time()
+                recorder.start_move()
                 if manager.game.lost:
                     event = pygame.event.Event(pygame.MOUSEBUTTONUP, {"pos": manager.game.lost_try_again_pos})
                     game_scores.append(manager.game.score)
                     best_tiles.append(np.max(manager.game.grid))
+                    summary = recorder.end_game(manager.game.score, best_tiles[-1])
                     print(len(game_scores))
-                    if AI_type in ["random", "heuristic", "MCTS", "rollout", "expectimax"]:
+                    if log is not None and log.in_game:
+                        log.end_game(manager.game.score)
+                    if AI_type in ["random", "heuristic", "MCTS", "rollout", "expectimax", "ntuple"]:
                         condition = kwargs["num_games"] > len(game_scores)
+                    if on_game_end is not None:
+                        on_game_end(dict(summary, move_seconds=sum(move_times[game_start:])))
+                    game_start = len(move_times)
+                    # The next game starts with the try again button below
+                    if seeds and condition:
+                        _seed(seeds[len(game_scores)])
                 elif manager.game.won == 1:
                     event = pygame.event.Event(pygame.MOUSEBUTTONUP, {"pos": manager.game.keep_going_pos})
                 elif AI_type == "random":
@@ -107,14 +202,34 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
                 elif AI_type == "rollout":
                     event = AI.rollouts(np.array(manager.game.grid), manager.game.score, kwargs["type"],
                                         max_search_depth=max_depth, num_rollouts=num_rollouts, epsilon=epsilon,
-                                        use_expert_score=kwargs["use_expert"])
+                                        use_expert_score=kwargs["use_expert"], evaluate=evaluate, budget=budget,
+                                        common_random_numbers=kwargs["common_random_numbers"],
+                                        control_variate=kwargs["control_variate"], bootstrap=kwargs["bootstrap"])
                 elif AI_type == "MCTS":
                     event = tree.MCTS(np.array(manager.game.grid), manager.game.score)
                 elif AI_type == "expectimax":
-                    event = Expectimax(kwargs['max_depth']).get_best_move(np.array(manager.game.grid))
+                    event = agent.get_best_move(np.array(manager.game.grid))
+                elif AI_type == "ntuple":
+                    event = network.move_event(np.array(manager.game.grid))
                 else:
                     raise ValueError("AI mode selected but invalid AI type was supplied!")
-                manager.dispatch(event)
+
+                think_time = time.time() - think_start
+                if event.type == pygame.KEYDOWN:
+                    move_times.append(think_time)
+                    recorder.end_move(AI._REVERSE_KEYMAP[event.dict["key"]])
+
+                if log is not None and event.type == pygame.KEYDOWN:
+                    old_grid = np.array(manager.game.grid)
+                    old_score = manager.game.score
+                    if not log.in_game:
+                        log.start_game(old_grid)
+                    manager.dispatch(event)
+                    move = AI._REVERSE_KEYMAP[event.dict["key"]]
+                    spawn = find_spawn(engine.game_merge(old_grid, move)[0], np.array(manager.game.grid))
+                    log.add_move(move, spawn, manager.game.score - old_score, think_time)
+                else:
+                    manager.dispatch(event)
                 manager.draw()
 
             print("Number of games played:", len(game_scores))
@@ -125,8 +240,23 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
             print("Max Score:", max(game_scores))
             print("Max Tile:", max(best_tiles))
             print("Average Score:", stats.mean(game_scores))
+            print("Average move time: %.2f ms" % (1000 * stats.mean(move_times)))
+            print("Move time per game (mean of games): " + ", ".join(
+                "p%d %.2f ms" % (p, stats.mean(game["p%d_move_ms" % p] for game in recorder.games))
+                for p in PERCENTILES) + ", %.0f nodes/s" % stats.mean(game["nodes_per_second"]
+                                                                     for game in recorder.games))
+            if cache is not None:
+                print("Cache hits: %d, misses: %d, stored: %d, dropped: %d" % (cache.hits, cache.misses,
+                                                                               cache.stored, cache.dropped))
 
         finally:
+            recorder.close()
+            if isinstance(tree, SharedTreeMCTS):
+                tree.close()
+            if cache is not None:
+                cache.close()
+            if log is not None:
+                log.close()
             if "simulate" not in kwargs:
                 pygame.quit()
                 manager.close()
@@ -137,15 +267,25 @@ def run_game(game_class=Game2048, title='2048: In Python!', data_dir=None, **kwa
                 "best_tiles": best_tiles,
                 "max_score": max(game_scores),
                 "max_tile": max(best_tiles),
-                "avg_score": stats.mean(game_scores)
+                "avg_score": stats.mean(game_scores),
+                "avg_move_time": stats.mean(move_times)
             }
+            # Per-game instrumentation, one entry per game like game_scores
+            for name in ["p%d_move_ms" % p for p in PERCENTILES] + ["nodes_per_second"]:
+                results[name] = [game[name] for game in recorder.games]
             return results
 
 
-def main():
+def build_parser():
     # Parse command line args
     parser = argparse.ArgumentParser(description="Play 2048, or choose an AI to play instead!")
     parser.add_argument('--AI_type', action='store_true')
+    parser.add_argument('--trajectory_file', default=None, type=str)
+    parser.add_argument('--stats_file', default=None, type=str)
+    parser.add_argument('--profile', nargs='?', choices=PROFILERS, const="cprofile", default=None, type=str)
+    parser.add_argument('--profile_output', default="profile", type=str)
+    parser.add_argument('--rows', default=4, type=int)
+    parser.add_argument('--columns', default=4, type=int)
     subparsers = parser.add_subparsers(dest='AI_type')
 
     random_parser = subparsers.add_parser("random")
@@ -156,6 +296,7 @@ def main():
                                                                       "smooth", "corner_dist", "expert"],
                                   default="safe", type=str)
     heuristic_parser.add_argument("num_games", nargs='?', default=10, type=int)
+    heuristic_parser.add_argument("--expert_weights", nargs='?', default=None, type=str)
 
     MCTS_parser = subparsers.add_parser("MCTS")
     MCTS_parser.add_argument('-r', "--num_rollouts", nargs='?', default=25, type=int)
@@ -166,7 +307,13 @@ def main():
                                                                     "smooth", "corner_dist", "expert"],
                              default="smooth", type=str)
     MCTS_parser.add_argument("num_games", nargs='?', default=10, type=int)
+    MCTS_parser.add_argument("--budget", nargs='?', choices=BUDGETS, default="fixed", type=str)
+    MCTS_parser.add_argument("--widening", nargs='?', default=None, type=float)
+    MCTS_parser.add_argument("--widening_constant", nargs='?', default=1.0, type=float)
+    MCTS_parser.add_argument('-j', "--workers", nargs='?', default=None, type=int)
     MCTS_parser.add_argument("--use_expert", action='store_true')
+    MCTS_parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    MCTS_parser.add_argument("--expert_weights", nargs='?', default=None, type=str)
 
     rollout_parser = subparsers.add_parser("rollout")
     rollout_parser.add_argument('-r', "--num_rollouts", nargs='?', default=25, type=int)
@@ -176,15 +323,41 @@ def main():
                                                                     "smooth", "corner_dist", "expert"],
                                 default="safest", type=str)
     rollout_parser.add_argument("--use_expert", action='store_true')
+    rollout_parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    rollout_parser.add_argument("--expert_weights", nargs='?', default=None, type=str)
     rollout_parser.add_argument("num_games", nargs='?', default=10, type=int)
+    rollout_parser.add_argument("--budget", nargs='?', choices=BUDGETS, default="fixed", type=str)
+    rollout_parser.add_argument("--common_random_numbers", action='store_true')
+    rollout_parser.add_argument("--control_variate", action='store_true')
+    rollout_parser.add_argument("--bootstrap", action='store_true')
 
     expectimax_parser = subparsers.add_parser("expectimax")
     expectimax_parser.add_argument('-d', "--max_depth", nargs='?', default=3, type=int)
     expectimax_parser.add_argument("num_games", nargs='?', default=10, type=int)
+    expectimax_parser.add_argument("--budget", nargs='?', choices=BUDGETS, default="fixed", type=str)
+    expectimax_parser.add_argument("--cache_file", nargs='?', default=None, type=str)
+    expectimax_parser.add_argument("--cache_size", nargs='?', default=256, type=int)
+    expectimax_parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    expectimax_parser.add_argument("--no_prune", action='store_true')
 
-    kwargs = vars(parser.parse_args(sys.argv[1:]))
+    ntuple_parser = subparsers.add_parser("ntuple")
+    ntuple_parser.add_argument("--ntuple_weights", nargs='?', default=None, type=str)
+    ntuple_parser.add_argument("num_games", nargs='?', default=10, type=int)
+
+    return parser
+
+
+def main():
+    kwargs = vars(build_parser().parse_args(sys.argv[1:]))
+
+    profiler = kwargs.pop("profile")
+    profile_output = kwargs.pop("profile_output")
 
     start_time = time.time()
-    run_game(**kwargs)
+    if profiler:
+        buckets = profile_call(run_game, profiler=profiler, output=profile_output, **kwargs)[1]
+        print(format_buckets(buckets))
+    else:
+        run_game(**kwargs)
     end_time = time.time()
     print("total seconds for the simulation:", int(end_time - start_time))
@@ -0,0 +1,228 @@
+"""An n-tuple network value function for 2048, trained by TD(0) on afterstates.
+
+The network looks at a few groups of 4 or 6 cells (tuples) in each of the 8 rotations and reflections of the grid.
+Every tuple has a float32 lookup table indexed by the exponents of its cells, and the value of a grid is the sum of
+the looked-up weights, so one evaluation costs (number of tuples) x 8 array reads.
+
+The value of an afterstate (the grid after a move, before the new tile spawns) estimates the score still to be
+gained in the game, as in Szubert & Jaskowski, "Temporal Difference Learning of N-Tuple Networks for the Game 2048"
+(2014). Train a network with `python ntuple.py [--tuples {small,large}] [-a|--alpha ALPHA] [--seed SEED]
+[--checkpoint_every N] weights num_games`."""
+
+import os
+import sys
+import time
+import hashlib
+import random
+import argparse
+import statistics as stats
+
+import numpy as np
+
+import AI
+import engine
+import headless
+import instrument
+
+# Tuples of flat cell indices (row * 4 + column), before the 8 symmetries are applied
+TUPLES = {
+    # Two rows and two 2x2 squares; 1 MB of weights
+    "small": [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 4, 5], [1, 2, 5, 6]],
+    # The 6-tuples of Szubert & Jaskowski; 256 MB of weights
+    "large": [[0, 1, 2, 3, 4, 5], [4, 5, 6, 7, 8, 9], [0, 1, 2, 4, 5, 6], [4, 5, 6, 8, 9, 10]],
+}
+
+
+def _symmetries():
+    """The 8 rotations and reflections of a 4x4 grid, each as the flat cell index read at every position."""
+    cells = np.arange(16).reshape(4, 4)
+    return [np.rot90(c, k).ravel() for c in [cells, cells.T] for k in range(4)]
+
+
+class NTupleNetwork(object):
+    def __init__(self, tuples=TUPLES["small"], weights: np.ndarray = None):
+        """
+        :param tuples: A list of tuples of flat cell indices, all of the same length
+        :param weights: The flat float32 weights of every tuple's table, one after the other; zeros if not supplied
+        """
+        self.tuples = np.array(tuples)
+        if self.tuples.ndim != 2:
+            raise ValueError("All tuples must have the same length.")
+        num_tuples, length = self.tuples.shape
+        self.table_size = 16 ** length
+
+        if weights is None:
+            weights = np.zeros(num_tuples * self.table_size, dtype=np.float32)
+        elif weights.shape != (num_tuples * self.table_size,):
+            raise ValueError("Expected %d weights, got %d." % (num_tuples * self.table_size, weights.size))
+        self.weights = weights
+
+        # _cells[t, s] lists the cells that tuple t reads in symmetry s
+        self._cells = np.array([[symmetry[t] for symmetry in _symmetries()] for t in self.tuples])
+        self._shifts = 4 * np.arange(length)
+        self._offsets = (np.arange(num_tuples) * self.table_size)[:, np.newaxis]
+
+    def _indices(self, grid: np.ndarray):
+        """The weight indices read for a grid or a stack of grids, of shape (..., tuples, 8)."""
+        grid = np.asarray(grid)
+        if grid.shape[-2:] != (4, 4):
+            raise ValueError("N-tuple networks only evaluate 4x4 grids, not %dx%d." % grid.shape[-2:])
+        exponents = np.minimum(engine.to_exponents(grid), engine.MAX_EXPONENT).reshape(grid.shape[:-2] + (16,))
+        return (exponents[..., self._cells] << self._shifts).sum(axis=-1) + self._offsets
+
+    def evaluate(self, grid: np.ndarray):
+        """The value of a grid, or of each grid in a stack of grids of shape (..., 4, 4)."""
+        return self.weights[self._indices(grid)].sum(axis=(-2, -1), dtype=np.float64)
+
+    def update(self, grid: np.ndarray, delta):
+        """Add 'delta' to every weight read for 'grid'."""
+        np.add.at(self.weights, self._indices(grid).ravel(), np.float32(delta))
+
+    @instrument.timed("ntuple")
+    def move_values(self, grid: np.ndarray):
+        """
+        Score every valid move by its reward plus the value of the resulting afterstate.
+
+        :return: A tuple of (moves, afterstates, rewards, values)
+        """
+        moves = AI.valid_moves(grid)
+        after_states = []
+        rewards = []
+        for move in moves:
+            after_state, reward = AI.quick_merge(grid, move, 0)
+            after_states.append(after_state)
+            rewards.append(reward)
+        values = np.array(rewards) + self.evaluate(np.stack(after_states)) if moves else np.array([])
+        instrument.count("ntuple.nodes", len(moves))
+        return moves, after_states, rewards, values
+
+    def best_move(self, grid: np.ndarray):
+        moves, _, _, values = self.move_values(grid)
+        return moves[int(np.argmax(values))]
+
+    def move_event(self, grid: np.ndarray):
+        return AI.move_event(self.best_move(grid))
+
+    def learn_game(self, rng: random.Random, alpha=0.0025):
+        """
+        Play one game greedily and learn from it with TD(0) on afterstates: the value of each afterstate is moved
+        towards the reward of the next move plus the value of the next afterstate.
+
+        :return: The final score and best tile of the game
+        """
+        grid = headless.new_grid(rng)
+        score = 0
+        last_after_state = None
+        while True:
+            moves, after_states, rewards, values = self.move_values(grid)
+            if not moves:
+                break
+            best = int(np.argmax(values))
+            if last_after_state is not None:
+                self.update(last_after_state, alpha * (values[best] - self.evaluate(last_after_state)))
+            last_after_state = after_states[best]
+            score += rewards[best]
+            grid = last_after_state.copy()
+            headless.spawn_tile(grid, rng)
+
+        if last_after_state is not None:
+            # No more rewards after the final afterstate
+            self.update(last_after_state, -alpha * self.evaluate(last_after_state))
+        return score, int(grid.max())
+
+    def self_play(self, rng: random.Random):
+        """
+        Play one game greedily without learning, and return the TD(0) errors that learn_game would apply, so that
+        the updates can be made elsewhere (see selfplay.py).
+
+        :return: A tuple of (indices, errors, score, best_tile), where indices[i] holds the weight indices read for
+                 the i-th afterstate and errors[i] its TD error
+        """
+        grid = headless.new_grid(rng)
+        score = 0
+        indices = []
+        errors = []
+        last_value = None
+        while True:
+            moves, after_states, rewards, values = self.move_values(grid)
+            if not moves:
+                break
+            best = int(np.argmax(values))
+            if last_value is not None:
+                errors.append(values[best] - last_value)
+            after_indices = self._indices(after_states[best])
+            last_value = self.weights[after_indices].sum(dtype=np.float64)
+            indices.append(after_indices.ravel())
+            score += rewards[best]
+            grid = after_states[best].copy()
+            headless.spawn_tile(grid, rng)
+
+        if last_value is not None:
+            errors.append(-last_value)
+        return (np.array(indices, dtype=np.int32).reshape(len(indices), self._cells.shape[0] * 8),
+                np.array(errors, dtype=np.float32), score, int(grid.max()))
+
+    def digest(self):
+        """A short hex digest of the tuples and weights, which tells networks apart, e.g. in cache tags."""
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(np.ascontiguousarray(self.tuples, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(self.weights).tobytes())
+        return digest.hexdigest()
+
+    def save(self, path):
+        """
+        Save the network to a .npz file. The file is replaced in one step, so a crash never leaves it half written.
+        """
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, tuples=self.tuples, weights=self.weights)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["tuples"], data["weights"])
+
+
+def train(network: NTupleNetwork, num_games, alpha=0.0025, seed=None, weights_file=None, checkpoint_every=1000):
+    """
+    Train a network by self-play, saving it to 'weights_file' every 'checkpoint_every' games and at the end.
+
+    :return: The list of final game scores
+    """
+    rng = random.Random(seed)
+    game_scores = []
+    best_tiles = []
+    start_time = time.time()
+    for game in range(1, num_games + 1):
+        score, best_tile = network.learn_game(rng, alpha)
+        game_scores.append(score)
+        best_tiles.append(best_tile)
+        if game % checkpoint_every == 0 or game == num_games:
+            print("Games: %d, average score (last %d): %.0f, max tile: %d, games/s: %.1f" % (
+                game, len(game_scores[-checkpoint_every:]), stats.mean(game_scores[-checkpoint_every:]),
+                max(best_tiles[-checkpoint_every:]), game / (time.time() - start_time)))
+            if weights_file is not None:
+                network.save(weights_file)
+    return game_scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train an n-tuple network for 2048 by self-play.")
+    parser.add_argument("weights", type=str, help="The weights file to train; created if it doesn't exist")
+    parser.add_argument("num_games", nargs='?', default=10000, type=int)
+    parser.add_argument("--tuples", nargs='?', choices=list(TUPLES), default="small", type=str)
+    parser.add_argument('-a', "--alpha", nargs='?', default=0.0025, type=float)
+    parser.add_argument("--seed", nargs='?', default=None, type=int)
+    parser.add_argument("--checkpoint_every", nargs='?', default=1000, type=int)
+    kwargs = vars(parser.parse_args(sys.argv[1:]))
+
+    if os.path.isfile(kwargs["weights"]):
+        network = NTupleNetwork.load(kwargs["weights"])
+    else:
+        network = NTupleNetwork(TUPLES[kwargs["tuples"]])
+    train(network, kwargs["num_games"], alpha=kwargs["alpha"], seed=kwargs["seed"], weights_file=kwargs["weights"],
+          checkpoint_every=kwargs["checkpoint_every"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Profiling of whole runs of the game, with their time split into buckets of the work done.
+
+profile_call runs a function, such as main.run_game, under one of two profilers:
+* "cprofile": cProfile, in the calling thread only. Its statistics are also written to "<output>.pstats", for pstats or
+  snakeviz. Other threads, such as the GameManager's save thread, are left to the sampling profiler: from Python 3.12
+  cProfile is built on sys.monitoring, which allows one active profiler per interpreter, not one per thread.
+* "sample": a sampling profiler, which records the stacks of every thread of the process from a background thread
+  every 'interval' seconds. Its overhead is much lower than cProfile's, and it sees whole stacks, but not call
+  counts.
+
+The run's time is split into BUCKETS by the functions it was spent in (see _RULES). Time in a function that belongs
+to no bucket, such as a NumPy or builtin function, goes to the bucket of its caller. Time the sampling profiler
+sees waiting in another thread, such as the save thread's wait for the next save, is counted as "idle", apart from the
+other buckets.
+
+Both profilers also write collapsed stacks to "<output>.collapsed": one line per stack, of its frames from the root
+separated by semicolons and followed by the microseconds spent in it, as read by flamegraph.pl, inferno and
+speedscope. cProfile only records callers and callees, not stacks, so its stacks are rebuilt from the call graph,
+splitting the time of each function among its callers in proportion to the time each of them spent in it. Worker
+processes, such as those of the shared MCTS tree, are not profiled."""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter, defaultdict
+
+BUCKETS = ("move engine", "heuristics", "search bookkeeping", "rendering", "manager I/O", "other")
+
+PROFILERS = ["cprofile", "sample"]
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (bucket, module, functions), in order of precedence: the functions of a module fall in a bucket, or all of its
+# functions if None. Modules are named as in _module.
+_RULES = [
+    ("idle", "threading", {"wait"}),
+    ("idle", "queue", {"get"}),
+    ("heuristics", "kernels", {"expert_score", "score_grid", "_line_merges"}),
+    ("move engine", "engine", None),
+    ("move engine", "kernels", None),
+    ("move engine", "vecenv", None),
+    ("move engine", "headless", None),
+    ("move engine", "AI", {"quick_merge", "quick_merge_row", "simulate_move", "is_valid_move", "valid_moves",
+                           "random_move", "random_move_event"}),
+    ("move engine", "expectimax", {"quick_merge", "quick_merge_row", "insert_tile", "get_empty_cells",
+                                   "is_valid_move", "valid_moves", "is_end"}),
+    ("move engine", "game", {"_shift_cells", "_spawn_new", "free_cells", "has_free_cells", "has_free_moves"}),
+    ("heuristics", "AI", {"expert_score", "smoothness", "monotonicity", "dist_from_corner", "_line_merge_counts",
+                          "heuristic_move", "heuristic_move_event", "_get_merge_directions",
+                          "_heuristic_choose_direction", "is_safe_move", "safe_moves", "choose_move",
+                          "_num_required_args", "move_diff", "_leaf_score"}),
+    ("heuristics", "expectimax", {"heuristic"}),
+    ("heuristics", "ntuple", None),
+    ("search bookkeeping", "AI", None),
+    ("search bookkeeping", "expectimax", None),
+    ("search bookkeeping", "sharedtree", None),
+    ("search bookkeeping", "zobrist", None),
+    ("search bookkeeping", "evalcache", None),
+    ("search bookkeeping", "budget", None),
+    ("search bookkeeping", "instrument", None),
+    ("search bookkeeping", "agents", None),
+    ("manager I/O", "utils", {"write_to_disk"}),
+    ("rendering", "utils", None),
+    ("rendering", "game", None),
+    ("rendering", "pygame", None),
+    ("rendering", "manager", {"draw"}),
+    ("manager I/O", "manager", None),
+    ("manager I/O", "trajectory", None),
+    ("manager I/O", "lock", None),
+]
+
+
+def _module(filename):
+    """The module of a file: the name of a module of this directory, of an installed package or of a library
+    module."""
+    path = os.path.abspath(filename)
+    name = os.path.splitext(os.path.basename(path))[0]
+    if os.path.dirname(path) == _HERE:
+        return name
+    parts = path.split(os.sep)
+    for packages in ["site-packages", "dist-packages"]:
+        if packages in parts[:-1]:
+            return os.path.splitext(parts[parts.index(packages) + 1])[0]
+    return name
+
+
+def classify(filename, function):
+    """The bucket of a function, or None if it belongs to none (see _RULES)."""
+    if filename == "~":
+        return None
+    module = _module(filename)
+    for bucket, rule_module, functions in _RULES:
+        if module == rule_module and (functions is None or function in functions):
+            return bucket
+    return None
+
+
+def _label(filename, function):
+    """A frame's name in collapsed stacks, which may not hold semicolons."""
+    label = function if filename == "~" else "%s:%s" % (_module(filename), function)
+    return label.replace(";", ",")
+
+
+class StackSampler(object):
+    def __init__(self, interval=0.001):
+        """
+        :param interval: The seconds between samples
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="StackSampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            # Weigh each sample by the time since the last one, which is longer when the sampler waits for the GIL
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append((frame.f_code.co_filename, frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(("~", names.get(ident, "thread-%d" % ident)))
+                self.stacks[tuple(reversed(stack))] += elapsed
+
+
+def _sampled_buckets(stacks):
+    """The seconds per bucket of sampled stacks: each sample goes to the bucket of its innermost classified frame."""
+    buckets = Counter()
+    for stack, seconds in stacks.items():
+        bucket = "other"
+        for frame in reversed(stack):
+            if classify(*frame) is not None:
+                bucket = classify(*frame)
+                break
+        buckets[bucket] += seconds
+    return buckets
+
+
+def _profile_buckets(stats: pstats.Stats):
+    """The seconds per bucket of cProfile statistics: each function's own time goes to its bucket, or is shared among
+    the buckets of its callers in proportion to the time each of them spent in it. Each function's shares are worked
+    out once; callers that are still being worked out, on a cycle of recursion, are left out."""
+    shares = {}
+    pending = set()
+
+    def share(func):
+        # The fraction of func's own time that goes to each bucket
+        if func in shares:
+            return shares[func]
+        bucket = classify(func[0], func[2])
+        if bucket is not None:
+            result = {bucket: 1.0}
+        else:
+            pending.add(func)
+            callers = {caller: edge[2] for caller, edge in stats.stats[func][4].items()
+                       if caller not in pending and caller in stats.stats}
+            total = sum(callers.values())
+            if not total:
+                result = {"other": 1.0}
+            else:
+                result = Counter()
+                for caller, seconds in callers.items():
+                    for caller_bucket, fraction in share(caller).items():
+                        result[caller_bucket] += fraction * seconds / total
+            pending.discard(func)
+        shares[func] = result
+        return result
+
+    buckets = Counter()
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for bucket, fraction in share(func).items():
+            buckets[bucket] += fraction * tt
+    return buckets
+
+
+def _profile_stacks(stats: pstats.Stats, min_fraction=1e-4):
+    """
+    Stacks rebuilt from the call graph of cProfile statistics. Recursion is cut at the first repeated function.
+
+    :param min_fraction: Branches taking less than this fraction of the total time are left out
+    :return: A Counter of the seconds spent in each stack, a tuple of (filename, line, function) frames
+    """
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    roots = [func for func, entry in stats.stats.items() if not entry[4]]
+    min_seconds = min_fraction * stats.total_tt
+    stacks = Counter()
+
+    def walk(func, path, fraction):
+        # fraction is the share of func's calls made through path
+        path = path + (func,)
+        stacks[path] += fraction * stats.stats[func][2]
+        for callee, seconds in callees[func].items():
+            callee_time = stats.stats[callee][3]
+            if callee in path or not callee_time or fraction * seconds < min_seconds:
+                continue
+            walk(callee, path, min(fraction * seconds / callee_time, 1.0))
+
+    for root in roots:
+        walk(root, (), 1.0)
+    return stacks
+
+
+def write_collapsed(stacks, path):
+    """Write a Counter of the seconds per stack of (filename, ..., function) frames as collapsed stacks."""
+    with open(path, 'w') as file:
+        for stack, seconds in sorted(stacks.items()):
+            microseconds = int(round(1e6 * seconds))
+            if microseconds > 0:
+                file.write("%s %d\n" % (";".join(_label(frame[0], frame[-1]) for frame in stack), microseconds))
+
+
+def format_buckets(buckets):
+    """A table of the seconds and percentage of each bucket, with idle time apart."""
+    total = sum(seconds for bucket, seconds in buckets.items() if bucket != "idle") or 1.0
+    lines = ["%-20s %10s %7s" % ("Profile bucket", "seconds", "share")]
+    for bucket in BUCKETS:
+        seconds = buckets.get(bucket, 0.0)
+        lines.append("%-20s %10.3f %6.1f%%" % (bucket, seconds, 100 * seconds / total))
+    lines.append("%-20s %10.3f" % ("idle (other threads)", buckets.get("idle", 0.0)))
+    return "\n".join(lines)
+
+
+def profile_call(func, *args, profiler="cprofile", output="profile", interval=0.001, **kwargs):
+    """
+    Call a function under a profiler, and write its collapsed stacks to "<output>.collapsed" (and, with cProfile,
+    its statistics to "<output>.pstats").
+
+    :param profiler: One of PROFILERS
+    :param output: The path of the output files, without their extension
+    :param interval: The seconds between samples of the "sample" profiler
+    :return: A tuple of (result, buckets): the function's result, and a dictionary of the seconds spent in each of
+             BUCKETS and "idle"
+    """
+    if profiler not in PROFILERS:
+        raise ValueError("Invalid profiler %r; valid profilers are %s." % (profiler, ", ".join(PROFILERS)))
+
+    if profiler == "sample":
+        sampler = StackSampler(interval)
+        sampler.start()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            sampler.stop()
+        buckets = _sampled_buckets(sampler.stacks)
+        stacks = sampler.stacks
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profile.disable()
+        stats = pstats.Stats(profile)
+        stats.dump_stats(output + ".pstats")
+        buckets = _profile_buckets(stats)
+        stacks = _profile_stacks(stats)
+
+    write_collapsed(stacks, output + ".collapsed")
+    return result, {bucket: buckets.get(bucket, 0.0) for bucket in BUCKETS + ("idle",)}
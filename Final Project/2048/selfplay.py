@@ -0,0 +1,142 @@
+"""Parallel self-play training of n-tuple networks.
+
+A learner process keeps the network weights in a multiprocessing.shared_memory buffer. Actor processes read the
+current weights straight from that buffer, play headless games greedily (NTupleNetwork.self_play) and send back the
+weight indices and TD(0) errors of every afterstate. The learner applies the updates of several games at once and
+writes a checkpoint of the weights every few minutes.
+
+Run with `python selfplay.py [-j|--workers WORKERS] [--tuples {small,large}] [-a|--alpha ALPHA] [--seed SEED]
+[--batch_games N] [--checkpoint_every SECONDS] weights [num_games]`."""
+
+import os
+import sys
+import time
+import queue
+import random
+import argparse
+import statistics as stats
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ntuple import NTupleNetwork, TUPLES
+
+
+def _actor(shm_name, tuples, seed, results, stop):
+    """Play games with the shared weights until told to stop, sending the TD errors of each game to 'results'."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        tuples = np.array(tuples)
+        weights = np.ndarray((tuples.shape[0] * 16 ** tuples.shape[1],), dtype=np.float32, buffer=shm.buf)
+        network = NTupleNetwork(tuples, weights)
+        rng = random.Random(seed)
+        while not stop.is_set():
+            results.put(network.self_play(rng))
+    finally:
+        network = weights = None
+        shm.close()
+
+
+def train_parallel(network: NTupleNetwork, num_games, workers=None, alpha=0.0025, seed=None, weights_file=None,
+                   batch_games=16, checkpoint_every=300, report_every=1000):
+    """
+    Train a network by self-play in 'workers' actor processes.
+
+    :param network: The network to train; its weights are updated in place
+    :param num_games: The number of games to learn from
+    :param workers: The number of actor processes; one per CPU if not supplied
+    :param alpha: The learning rate
+    :param seed: If supplied, actor i seeds its games with seed + i
+    :param weights_file: Where to write checkpoints of the weights, and the final weights
+    :param batch_games: The most games whose updates are applied at once
+    :param checkpoint_every: The number of seconds between checkpoints
+    :param report_every: The number of games between progress reports
+    :return: The list of final game scores
+    """
+    workers = workers or os.cpu_count()
+    shm = shared_memory.SharedMemory(create=True, size=network.weights.nbytes)
+    weights = np.ndarray(network.weights.shape, dtype=np.float32, buffer=shm.buf)
+    weights[:] = network.weights
+    network.weights = weights
+
+    results = mp.Queue(maxsize=4 * workers * batch_games)
+    stop = mp.Event()
+    actors = [mp.Process(target=_actor, args=(shm.name, network.tuples.tolist(),
+                                              None if seed is None else seed + i, results, stop), daemon=True)
+              for i in range(workers)]
+
+    game_scores = []
+    best_tiles = []
+    try:
+        for actor in actors:
+            actor.start()
+
+        start_time = last_checkpoint = time.time()
+        while len(game_scores) < num_games:
+            batch = [results.get()]
+            while len(batch) < min(batch_games, num_games - len(game_scores)):
+                try:
+                    batch.append(results.get_nowait())
+                except queue.Empty:
+                    break
+
+            indices = np.concatenate([game[0] for game in batch])
+            errors = np.concatenate([game[1] for game in batch])
+            np.add.at(weights, indices.ravel(), np.repeat(alpha * errors, indices.shape[1]))
+
+            for _, _, score, best_tile in batch:
+                game_scores.append(score)
+                best_tiles.append(best_tile)
+                if len(game_scores) % report_every == 0:
+                    print("Games: %d, average score (last %d): %.0f, max tile: %d, games/s: %.1f" % (
+                        len(game_scores), report_every, stats.mean(game_scores[-report_every:]),
+                        max(best_tiles[-report_every:]), len(game_scores) / (time.time() - start_time)))
+
+            if weights_file is not None and time.time() - last_checkpoint > checkpoint_every:
+                network.save(weights_file)
+                last_checkpoint = time.time()
+    finally:
+        stop.set()
+        # Actors may be blocked on a full queue; keep draining until they have all exited
+        while any(actor.is_alive() for actor in actors):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+
+        network.weights = np.array(weights)
+        weights = None
+        shm.close()
+        shm.unlink()
+
+    if weights_file is not None:
+        network.save(weights_file)
+    return game_scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train an n-tuple network for 2048 by parallel self-play.")
+    parser.add_argument("weights", type=str, help="The weights file to train; created if it doesn't exist")
+    parser.add_argument("num_games", nargs='?', default=100000, type=int)
+    parser.add_argument('-j', "--workers", nargs='?', default=None, type=int)
+    parser.add_argument("--tuples", nargs='?', choices=list(TUPLES), default="small", type=str)
+    parser.add_argument('-a', "--alpha", nargs='?', default=0.0025, type=float)
+    parser.add_argument("--seed", nargs='?', default=None, type=int)
+    parser.add_argument("--batch_games", nargs='?', default=16, type=int)
+    parser.add_argument("--checkpoint_every", nargs='?', default=300, type=float)
+    kwargs = vars(parser.parse_args(sys.argv[1:]))
+
+    if os.path.isfile(kwargs["weights"]):
+        network = NTupleNetwork.load(kwargs["weights"])
+    else:
+        network = NTupleNetwork(TUPLES[kwargs["tuples"]])
+    train_parallel(network, kwargs["num_games"], workers=kwargs["workers"], alpha=kwargs["alpha"],
+                   seed=kwargs["seed"], weights_file=kwargs["weights"], batch_games=kwargs["batch_games"],
+                   checkpoint_every=kwargs["checkpoint_every"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""A long-running local service that suggests moves from any of the 2048 agents.
+
+Boards are POSTed as JSON to /move, along with the agent type and any of its command line parameters:
+
+    {"grid": [[0, 2, 0, 0], [0, 0, 0, 0], [4, 0, 0, 0], [0, 0, 0, 2]], "score": 4,
+     "AI_type": "heuristic", "type": "expert"}
+
+and the reply holds the chosen move and the score of every valid move (see agents.move_scores):
+
+    {"move": "Down", "scores": {"Up": 1598765.2, "Down": 1599012.0, ...}}
+
+The agents, their lookup tables and caches are kept warm between requests. Requests that arrive close together are
+batched, and boards scored by the same evaluation heuristic are evaluated in a single vectorized call. The searching
+agents (rollout, MCTS, expectimax and ntuple) run on a separate agent thread, so that a long search doesn't hold up the
+heuristic requests behind it."""
+
+import sys
+import json
+import time
+import queue
+import argparse
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread, Lock
+
+import numpy as np
+
+import agents
+
+
+class _Request(object):
+    """A move request waiting for the batcher."""
+
+    def __init__(self, grid: np.ndarray, score, opts: dict):
+        self.grid = grid
+        self.score = score
+        self.opts = opts
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+# Agents quick enough to evaluate on the batcher thread; the others are searched on the agent thread
+FAST_AI_TYPES = ["random", "heuristic"]
+
+
+class MoveBatcher(object):
+    """Collects concurrent move requests and evaluates them together on a single worker thread."""
+
+    def __init__(self, batch_window=0.002, max_batch=256, cache_size=100000):
+        """
+        :param batch_window: How long (in seconds) to wait for more requests once the first of a batch arrives
+        :param max_batch: The largest number of requests to evaluate at once
+        :param cache_size: The number of results from deterministic agents to keep
+        """
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+
+        self._queue = queue.Queue()
+        self._cache = OrderedDict()
+        self._cache_lock = Lock()
+        self._running = True
+        # One thread, as the searching agents share state: the expert_score constants and the kept expectimax agents
+        self._agents = ThreadPoolExecutor(max_workers=1, thread_name_prefix="agent")
+        self._worker = Thread(target=self._batch_daemon, daemon=True)
+        self._worker.start()
+
+    @staticmethod
+    def _cache_key(grid: np.ndarray, opts: dict):
+        return grid.tobytes(), grid.shape, tuple(sorted((k, str(v)) for k, v in opts.items()))
+
+    def submit(self, grid: np.ndarray, score=0, **kwargs):
+        """Queue a move request, wait for it to be evaluated and return the (move, scores) tuple."""
+        grid = np.array(grid, dtype=int)
+        if grid.ndim != 2:
+            raise ValueError("The grid must be a list of rows.")
+        kwargs.pop("num_games", None)
+        opts = agents.agent_options(kwargs.pop("AI_type", "heuristic"), **kwargs)
+
+        deterministic = agents.is_deterministic(opts)
+        if deterministic:
+            key = self._cache_key(grid, opts)
+            with self._cache_lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    return self._cache[key]
+
+        request = _Request(grid, score, opts)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        if deterministic:
+            with self._cache_lock:
+                self._cache[key] = request.result
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return request.result
+
+    def _batch_daemon(self):
+        while self._running:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._running = False
+                    break
+                batch.append(request)
+            self._evaluate(batch)
+
+    def _evaluate(self, batch: list):
+        """Evaluate a batch, grouping the requests that can share a vectorized heuristic evaluation."""
+        groups = defaultdict(list)
+        singles = []
+        for request in batch:
+            if request.opts["AI_type"] == "heuristic" and request.opts["type"] in agents.EVAL_HEURISTICS:
+                groups[request.opts["type"], request.opts["expert_weights"]].append(request)
+            else:
+                singles.append(request)
+
+        for (heuristic_type, expert_weights), requests in groups.items():
+            try:
+                results = agents.batch_move_scores([r.grid for r in requests], heuristic_type, expert_weights)
+            except Exception:
+                # One of the grids or weights files is bad; evaluate them one by one to report it
+                singles.extend(requests)
+            else:
+                for request, result in zip(requests, results):
+                    request.result = result
+                    request.done.set()
+
+        for request in singles:
+            if request.opts["AI_type"] in FAST_AI_TYPES:
+                self._move_scores(request)
+            else:
+                self._agents.submit(self._move_scores, request)
+
+    @staticmethod
+    def _move_scores(request: _Request):
+        try:
+            request.result = agents.move_scores(request.grid, request.score, **request.opts)
+        except Exception as e:
+            request.error = e
+        request.done.set()
+
+    def close(self):
+        self._running = False
+        self._queue.put(None)
+        self._worker.join()
+        self._agents.shutdown()
+
+
+class MoveRequestHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def _reply(self, code, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"status": "ok", "AI_types": agents.AI_TYPES})
+        else:
+            self._reply(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/move":
+            self._reply(404, {"error": "Unknown path %s" % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            grid = body.pop("grid")
+            score = body.pop("score", 0)
+            move, scores = self.batcher.submit(grid, score, **body)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            # Anything else is the server's fault, but the client still gets a reply rather than a dropped connection
+            self._reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+        else:
+            self._reply(200, {"move": move, "scores": scores})
+
+    def log_message(self, format, *args):
+        # Keep the console quiet; one line per request adds up quickly
+        pass
+
+
+class MoveServer(ThreadingHTTPServer):
+    # Many clients connect at once when batching pays off; don't reset them
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(host="127.0.0.1", port=2048, batch_window=0.002, max_batch=256):
+    batcher = MoveBatcher(batch_window=batch_window, max_batch=max_batch)
+    handler = type("BoundMoveRequestHandler", (MoveRequestHandler,), {"batcher": batcher})
+    server = MoveServer((host, port), handler)
+    print("Serving 2048 moves on http://%s:%d/move" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve 2048 move suggestions over local HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument('-p', "--port", default=2048, type=int)
+    parser.add_argument('-w', "--batch_window", default=0.002, type=float,
+                        help="Seconds to wait for more requests before evaluating a batch")
+    parser.add_argument("--max_batch", default=256, type=int)
+    kwargs = vars(parser.parse_args(sys.argv[1:]))
+    serve(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
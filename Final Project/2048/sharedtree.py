@@ -0,0 +1,293 @@
+"""Monte-Carlo Tree Search of one tree shared by several worker processes.
+
+The tree lives in a multiprocessing.shared_memory buffer, as arrays indexed by node: a node is a board, found through
+an open-addressing table keyed by the board's Zobrist hash, and holds the visits, value sums and virtual losses of
+its four moves. Every worker runs whole simulations: it descends the tree by UCT, draws a tile spawn after each move,
+and adds the first board not yet in the tree, from which it finishes the simulation with the rollout policy of
+GameTree; it then backs the simulation's score up its own record of the path. While a simulation is under way,
+every move on its path carries a virtual loss (a visit with no score), which steers the other workers to other
+moves.
+
+Statistics are updated without locks, so concurrent updates of the same move may occasionally lose one; only the
+insertion of new nodes takes a lock. Nodes are keyed by board alone, so a board reached by several paths shares its
+statistics."""
+
+import os
+import math
+import random
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import AI
+import engine
+import instrument
+import zobrist
+
+# How full the node table may get before simulations stop adding nodes
+_MAX_LOAD = 0.75
+
+
+def _layout(capacity):
+    """The offsets and shapes of the arrays in the shared buffer."""
+    arrays = [("keys", np.uint64, (capacity,)), ("visits", np.int64, (capacity, 4)),
+              ("values", np.float64, (capacity, 4)), ("virtual", np.int64, (capacity, 4)),
+              ("counters", np.int64, (1,)), ("max_score", np.float64, (1,))]
+    offset = 0
+    layout = []
+    for name, dtype, shape in arrays:
+        layout.append((name, dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+class _Arrays(object):
+    """Views of the shared buffer."""
+
+    def __init__(self, buf, capacity):
+        for name, dtype, shape, offset in _layout(capacity)[0]:
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset))
+        self.mask = capacity - 1
+        self.max_nodes = int(capacity * _MAX_LOAD)
+
+    def find(self, key):
+        """The node of a Zobrist key, or -1 if it isn't in the tree."""
+        slot = key & self.mask
+        while True:
+            found = int(self.keys[slot])
+            if found == key:
+                return slot
+            if found == 0:
+                return -1
+            slot = (slot + 1) & self.mask
+
+    def insert(self, key, lock):
+        """Add a node for a Zobrist key, returning the node, or -1 if the table is full."""
+        with lock:
+            node = self.find(key)
+            if node >= 0:
+                return node
+            if self.counters[0] >= self.max_nodes:
+                return -1
+            slot = key & self.mask
+            while self.keys[slot] != 0:
+                slot = (slot + 1) & self.mask
+            self.counters[0] += 1
+            self.keys[slot] = key
+            return slot
+
+
+def _node_key(key):
+    # 0 marks an empty slot, and is the hash of the empty board
+    return key or 1
+
+
+def _select(arrays, node, legal, exploration, virtual_loss):
+    """Choose a move at a node by UCT, counting virtual losses as visits without a score."""
+    counts = [visits + virtual * virtual_loss
+              for visits, virtual in zip(arrays.visits[node].tolist(), arrays.virtual[node].tolist())]
+    untried = [move for move in legal if counts[move] <= 0]
+    if untried:
+        return random.choice(untried)
+
+    values = arrays.values[node].tolist()
+    max_score = max(float(arrays.max_score[0]), 1.0)
+    log_total = math.log(sum(counts[move] for move in legal))
+    best, best_value = None, float('-inf')
+    for move in legal:
+        value = values[move] / counts[move] / max_score + exploration * (log_total / counts[move]) ** 0.5
+        if value > best_value:
+            best, best_value = move, value
+    return best
+
+
+def _rollout(grid, score, depth, heuristic_type, epsilon):
+    """
+    Finish a simulation with the rollout policy of GameTree: random moves, or a heuristic's.
+
+    :return: A tuple of (grid, score, moves), where moves is the number of moves made
+    """
+    moves = 0
+    for _ in range(depth):
+        if not engine.move_mask(grid):
+            break
+        moves += 1
+        if heuristic_type is None or random.random() < epsilon:
+            move = AI.random_move(grid)
+        else:
+            move = AI.heuristic_move(grid, heuristic_type)
+        grid, score = AI.simulate_move(grid, move, score)
+    return grid, score, moves
+
+
+def simulate(arrays, lock, grid, score, max_search_depth, heuristic_type=None, epsilon=0, exploration=2 ** 0.5,
+             virtual_loss=1, use_expert_score=False, evaluate=None):
+    """
+    Run one simulation from the root of a shared tree, and back its score up.
+
+    :param arrays: The _Arrays of the tree
+    :param grid: The root grid; the root is the node of its Zobrist hash
+    :param score: The root score
+    :param max_search_depth: The number of moves after the first move of the simulation
+    :return: A tuple of (score, moves), the score of the simulation and the number of moves it simulated
+    """
+    table = zobrist.table(grid.shape)
+    key = table.hash(grid)
+    node = arrays.insert(_node_key(key), lock)
+    path = []
+    depth = 0
+    while depth <= max_search_depth:
+        mask = engine.move_mask(grid)
+        if not mask:
+            break
+        move = _select(arrays, node, [i for i in range(4) if mask >> i & 1], exploration, virtual_loss)
+        arrays.virtual[node, move] += 1
+        path.append((node, move))
+
+        new_grid, score = AI.simulate_move(grid, AI._MOVES[move], score)
+        key = table.hash(new_grid)
+        grid = new_grid
+        depth += 1
+
+        child = arrays.find(_node_key(key))
+        if child < 0:
+            # Expand the tree by one node, and finish the simulation outside of it
+            arrays.insert(_node_key(key), lock)
+            grid, score, rollout_moves = _rollout(grid, score, max_search_depth + 1 - depth, heuristic_type, epsilon)
+            depth += rollout_moves
+            break
+        node = child
+
+    value = AI._leaf_score(grid, score, use_expert_score, evaluate)
+    if value > arrays.max_score[0]:
+        arrays.max_score[0] = value
+    for node, move in path:
+        arrays.visits[node, move] += 1
+        arrays.values[node, move] += value
+        arrays.virtual[node, move] -= 1
+    return value, depth
+
+
+def _worker(shm_name, capacity, lock, jobs, done, seed, use_expert_score, evaluate, expert_weights):
+    """Run the simulations of each job until sent None."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = _Arrays(shm.buf, capacity)
+        AI.set_expert_weights(expert_weights)
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            grid, score, num_simulations, max_search_depth, heuristic_type, epsilon, virtual_loss = job
+            moves = 0
+            for _ in range(num_simulations):
+                moves += simulate(arrays, lock, grid, score, max_search_depth, heuristic_type, epsilon,
+                                  virtual_loss=virtual_loss, use_expert_score=use_expert_score,
+                                  evaluate=evaluate)[1]
+            done.put(moves)
+    finally:
+        arrays = None
+        shm.close()
+
+
+class SharedTreeMCTS(object):
+    def __init__(self, workers=None, max_search_depth=10, num_rollouts=100, epsilon=0, use_expert_score=False,
+                 evaluate=None, budget=None, capacity=2 ** 18, virtual_loss=1, seed=None):
+        """
+        Start the worker processes; call close when done.
+
+        :param workers: The number of worker processes; one per CPU if not supplied
+        :param max_search_depth: As for GameTree
+        :param num_rollouts: The number of simulations per legal move of the root, as for GameTree, shared among the
+                             workers
+        :param epsilon: As for GameTree; the chance of a random move in the rollout policy
+        :param use_expert_score: As for GameTree
+        :param evaluate: As for GameTree
+        :param budget: As for GameTree
+        :param capacity: The number of node slots, a power of 2; each takes 104 bytes of shared memory
+        :param virtual_loss: The number of visits a simulation under way counts for
+        :param seed: If supplied, worker i seeds its random numbers with seed + i
+        """
+        if capacity & (capacity - 1):
+            raise ValueError("The capacity of a shared tree must be a power of 2.")
+        self.workers = workers or os.cpu_count()
+        self.max_search_depth = max_search_depth
+        self.num_rollouts = num_rollouts
+        self.epsilon = epsilon
+        self.budget = budget
+        self.capacity = capacity
+        self.virtual_loss = virtual_loss
+        self.last_move = None
+
+        self._shm = shared_memory.SharedMemory(create=True, size=_layout(capacity)[1])
+        self._arrays = _Arrays(self._shm.buf, capacity)
+        self._lock = mp.Lock()
+        self._done = mp.Queue()
+        self._jobs = [mp.Queue() for _ in range(self.workers)]
+        self._processes = [mp.Process(target=_worker, args=(self._shm.name, capacity, self._lock, self._jobs[i],
+                                                            self._done, None if seed is None else seed + i,
+                                                            use_expert_score, evaluate, AI.EXPERT_WEIGHTS),
+                                      daemon=True)
+                           for i in range(self.workers)]
+        for process in self._processes:
+            process.start()
+
+    @instrument.timed("sharedtree")
+    def search(self, cur_grid: np.ndarray, cur_score, heuristic_type=None):
+        """
+        Search a new tree from a grid.
+
+        :return: A dictionary mapping each legal move to its average score
+        """
+        cur_grid = np.array(cur_grid)
+        if self.budget is not None:
+            self.max_search_depth, self.num_rollouts = self.budget(cur_grid)
+        mask = engine.move_mask(cur_grid)
+        num_moves = bin(mask).count("1")
+
+        for name in ["keys", "visits", "values", "virtual", "counters", "max_score"]:
+            getattr(self._arrays, name)[...] = 0
+        total = self.num_rollouts * num_moves
+        for i, jobs in enumerate(self._jobs):
+            share = total // self.workers + (i < total % self.workers)
+            jobs.put((cur_grid, cur_score, share, self.max_search_depth, heuristic_type, self.epsilon,
+                      self.virtual_loss))
+        moves = sum(self._done.get() for _ in self._jobs)
+        instrument.count("sharedtree.rollouts", total)
+        instrument.count("sharedtree.nodes", moves)
+        instrument.count("sharedtree.new_nodes", self.num_nodes())
+
+        root = self._arrays.find(_node_key(zobrist.hash_grid(cur_grid)))
+        scores = {}
+        for move in range(4):
+            if mask >> move & 1:
+                visits = int(self._arrays.visits[root, move]) if root >= 0 else 0
+                scores[AI._MOVES[move]] = float(self._arrays.values[root, move]) / visits if visits else 0.0
+        return scores
+
+    def num_nodes(self):
+        """The number of nodes of the last search's tree."""
+        return int(self._arrays.counters[0])
+
+    def MCTS(self, cur_grid: np.ndarray, cur_score, heuristic_type=None):
+        """Choose a move as GameTree.MCTS does, returning it as a KEYDOWN event."""
+        scores = self.search(cur_grid, cur_score, heuristic_type)
+        best = max(scores.values())
+        self.last_move = random.choice([move for move, score in scores.items() if score == best])
+        return AI.move_event(self.last_move)
+
+    def close(self):
+        if self._shm is None:
+            return
+        for jobs in self._jobs:
+            jobs.put(None)
+        for process in self._processes:
+            process.join()
+        self._arrays = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
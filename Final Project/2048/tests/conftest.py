@@ -0,0 +1,41 @@
+import os
+import sys
+import random
+
+import numpy as np
+import pytest
+
+# The game's modules import each other by their flat names, as when run from their own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import AI
+import headless
+
+# The moves into a game at which boards are taken, so that there are early, middle and late boards
+_BOARD_MOVES = (5, 20, 50, 100, 150, 200, 300, 400)
+
+
+@pytest.fixture(scope="session")
+def boards():
+    """
+    A fixed corpus of boards with a valid move: boards of seeded games of random moves, taken along the way, and
+    seeded random boards with larger tiles, of 4x4 and other shapes.
+    """
+    boards = []
+    for seed in range(4):
+        rng = random.Random(seed)
+        grid = headless.new_grid(rng)
+        for moves in range(max(_BOARD_MOVES) + 1):
+            valid = AI.valid_moves(grid)
+            if not valid:
+                break
+            if moves in _BOARD_MOVES:
+                boards.append(grid.copy())
+            grid = AI.quick_merge(grid, rng.choice(valid))
+            headless.spawn_tile(grid, rng)
+    rng = np.random.default_rng(0)
+    for shape in [(4, 4)] * 40 + [(3, 3), (3, 5), (5, 4), (6, 6)] * 5:
+        grid = np.where(rng.random(shape) < 0.6, 2 ** rng.integers(1, 14, shape), 0)
+        if AI.valid_moves(grid):
+            boards.append(grid)
+    return boards
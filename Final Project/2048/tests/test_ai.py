@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import AI
+
+
+@pytest.mark.parametrize("shape", [(4, 4), (3, 5), (5, 3)])
+def test_merge_directions_of_every_column(shape):
+    for c in range(shape[1]):
+        grid = np.zeros(shape, dtype=int)
+        # A pair of tiles with a gap between them, which still merge
+        grid[0, c] = grid[2, c] = 2
+        moves = AI._get_merge_directions(grid)
+        assert moves[c] == ["Down"]
+        assert moves[2 * shape[1] + c] == ["Up"]
+
+
+@pytest.mark.parametrize("shape", [(4, 4), (3, 5), (5, 3)])
+def test_merge_directions_of_every_row(shape):
+    for r in range(shape[0]):
+        grid = np.zeros(shape, dtype=int)
+        grid[r, 0] = grid[r, -1] = 4
+        moves = AI._get_merge_directions(grid)
+        assert moves[r * shape[1]] == ["Right"]
+        assert moves[(r + 1) * shape[1] - 1] == ["Left"]
+
+
+def test_merge_directions_match_move_mask(boards):
+    for grid in boards:
+        merges = {move for moves in AI._get_merge_directions(grid) for move in moves}
+        for move in merges:
+            assert AI.is_valid_move(grid, move)
@@ -0,0 +1,76 @@
+"""The kernels against the code they replace. Without Numba, the kernels run as plain Python, so these tests check
+their logic; with Numba, they check the compiled kernels."""
+
+import random
+
+import numpy as np
+import pytest
+
+import AI
+import engine
+import kernels
+
+
+def _both(monkeypatch, func, *args, seed=0):
+    """The results of an AI function without and with the kernels, each called after random.seed(seed)."""
+    results = []
+    for enabled in [False, True]:
+        monkeypatch.setattr(kernels, "ENABLED", enabled)
+        random.seed(seed)
+        results.append(func(*args))
+    return results
+
+
+@pytest.mark.parametrize("direction", AI._MOVES)
+def test_quick_merge(monkeypatch, boards, direction):
+    for grid in boards:
+        for count_merges in [False, True]:
+            python, kernel = _both(monkeypatch, AI.quick_merge, grid, direction, 10, count_merges)
+            assert np.array_equal(python[0], kernel[0])
+            assert python[1:] == kernel[1:]
+
+
+@pytest.mark.parametrize("right", [False, True])
+def test_quick_merge_row(monkeypatch, boards, right):
+    for grid in boards:
+        for row in grid:
+            for count_merges in [False, True]:
+                python, kernel = _both(monkeypatch, AI.quick_merge_row, row, right, 0, count_merges)
+                assert list(python[0]) == list(kernel[0])
+                assert python[1:] == kernel[1:]
+
+
+def test_move_mask(monkeypatch, boards):
+    for grid in boards:
+        mask = engine.move_mask(grid)
+        assert mask == engine.move_masks(grid)
+        for enabled in [False, True]:
+            monkeypatch.setattr(kernels, "ENABLED", enabled)
+            # A move is legal exactly when it changes the board
+            moved = sum(1 << i for i, move in enumerate(AI._MOVES) if not np.array_equal(AI.quick_merge(grid, move),
+                                                                                         grid))
+            assert moved == mask
+
+
+def test_simulate_move(monkeypatch, boards):
+    for i, grid in enumerate(boards):
+        for move in AI.valid_moves(grid):
+            python, kernel = _both(monkeypatch, AI.simulate_move, grid, move, 0, seed=i)
+            assert np.array_equal(python[0], kernel[0])
+            assert python[1] == kernel[1]
+
+
+def test_expert_score(monkeypatch, boards):
+    for grid in boards:
+        python, kernel = _both(monkeypatch, AI.expert_score, grid)
+        assert np.isclose(python, kernel, rtol=1e-12, atol=1e-6)
+
+
+def test_compiled_rollouts_match_python(boards):
+    pytest.importorskip("numba")
+    weights = np.array(AI.DEFAULT_EXPERT_WEIGHTS, dtype=np.float64)
+    compiled = kernels._kernel("compiled_rollouts")
+    for i, grid in enumerate(boards[:16]):
+        for use_expert_score in [False, True]:
+            args = (grid, 0, kernels._DIRECTIONS[AI.valid_moves(grid)[0]], 4, 10, i + 1, use_expert_score, weights)
+            assert compiled(*args) == compiled.py_func(*args)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import zobrist
+from AI import quick_merge, valid_moves
+
+
+def test_add_tile_matches_full_hash(boards):
+    table = zobrist.ZobristTable(shape=(4, 4), audit=True)
+    for grid in boards:
+        if grid.shape != table.shape:
+            continue
+        for move in valid_moves(grid):
+            new_grid = quick_merge(grid, move)
+            new_key = table.hash(new_grid)
+            assert new_key == zobrist.ZobristTable().hash(new_grid)
+            empty = np.argwhere(new_grid == 0)
+            if len(empty):
+                spawned = new_grid.copy()
+                spawned[tuple(empty[0])] = 4
+                assert table.add_tile(new_key, empty[0], 4, spawned) == table.hash(spawned)
+    assert table.collisions == 0
+
+
+def test_audit_rejects_wrong_hash():
+    table = zobrist.ZobristTable(audit=True)
+    grid = np.zeros((4, 4), dtype=int)
+    spawned = grid.copy()
+    spawned[1, 2] = 2
+    with pytest.raises(ValueError):
+        # The key of the wrong cell
+        table.add_tile(table.hash(grid), (2, 1), 2, spawned)
+
+
+def test_audit_counts_collisions():
+    table = zobrist.ZobristTable(audit=True)
+    # Give a 2 on the second cell the key of a 2 on the first, so that the two boards collide
+    table._keys[1][1] = table._keys[0][1]
+    first, second = np.zeros((4, 4), dtype=int), np.zeros((4, 4), dtype=int)
+    first[0, 0] = second[0, 1] = 2
+    assert table.hash(first) == table.hash(second)
+    assert table.collisions == 1
+    table.hash(first)
+    assert table.collisions == 1
+
+
+def test_audit_environment_variable(monkeypatch):
+    monkeypatch.setattr(zobrist, "_tables", {})
+    monkeypatch.setenv("ZOBRIST_AUDIT", "1")
+    assert zobrist.table((3, 3)).audit
+    monkeypatch.setattr(zobrist, "_tables", {})
+    monkeypatch.setenv("ZOBRIST_AUDIT", "0")
+    assert not zobrist.table((3, 3)).audit
@@ -0,0 +1,196 @@
+"""A compact, append-only binary log of 2048 games.
+
+A log file starts with the 8-byte magic b'2048TRJ1', followed by one record per finished game:
+
+* a 27-byte game header, struct '<4sBHIQQ': b'GAME', the rules the game was played by (GAME_RULES for Game2048,
+  QUICK_MERGE_RULES for AI.quick_merge), the length of the label, the number of moves, the initial grid packed by
+  engine.pack_grid and the final score;
+* the label, a UTF-8 string describing the game (e.g. the agent's configuration as JSON);
+* 7 bytes per move (MOVE_DTYPE): a flags byte holding the move (bits 0-1, an index into AI._MOVES), whether a tile
+  spawned (bit 2), whether it was a 4 (bit 3) and its cell, row * 4 + column (bits 4-7); the score gained by the
+  move as a uint32; and the time taken to choose the move, in seconds, as a float16.
+
+Games are written whole by a buffered TrajectoryWriter, and read back through a memory map by TrajectoryReader."""
+
+import os
+import json
+import struct
+
+import numpy as np
+
+import AI
+import engine
+
+_MAGIC = b'2048TRJ1'
+_GAME_HEADER = struct.Struct('<4sBHIQQ')
+
+GAME_RULES = 0
+QUICK_MERGE_RULES = 1
+
+MOVE_DTYPE = np.dtype([('flags', 'u1'), ('score_delta', '<u4'), ('think_time', '<f2')])
+
+
+class TrajectoryWriter(object):
+    def __init__(self, path, rules=GAME_RULES, label="", buffer_size=2 ** 20):
+        """
+        Open a log for appending, creating it if it doesn't exist.
+
+        :param path: The log file
+        :param rules: The rules the logged games are played by, unless given per game
+        :param label: The default label of the logged games; anything JSON-serializable
+        :param buffer_size: The size of the write buffer in bytes
+        """
+        self.rules = rules
+        self.label = label
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+        self._moves = None
+
+    @property
+    def in_game(self):
+        """Whether a game has been started and not yet ended."""
+        return self._moves is not None
+
+    def start_game(self, grid: np.ndarray, label=None, rules=None):
+        """Start logging a game from its initial grid. The label and rules default to the writer's."""
+        if np.shape(grid) != (4, 4):
+            raise ValueError("Trajectory logs only hold 4x4 games.")
+        self._initial = engine.pack_grid(grid)
+        self._game_label = self.label if label is None else label
+        self._game_rules = self.rules if rules is None else rules
+        self._moves = []
+
+    def add_move(self, move: str, spawn=None, score_delta=0, think_time=0.0):
+        """
+        Log a move of the current game.
+
+        :param move: One of "Up", "Down", "Left", "Right"
+        :param spawn: The ((row, column), value) of the tile that spawned after the move, or None
+        :param score_delta: The score gained by the move
+        :param think_time: The time taken to choose the move, in seconds
+        """
+        flags = AI._MOVES.index(move)
+        if spawn is not None:
+            (r, c), value = spawn
+            flags |= 0x4 | (0x8 if value == 4 else 0) | ((r * 4 + c) << 4)
+        self._moves.append((flags, score_delta, think_time))
+
+    def end_game(self, final_score):
+        """Write the current game to the log."""
+        label = self._game_label if isinstance(self._game_label, str) else json.dumps(self._game_label)
+        label = label.encode()
+        self._file.write(_GAME_HEADER.pack(b'GAME', self._game_rules, len(label), len(self._moves), self._initial or 0,
+                                           final_score))
+        self._file.write(label)
+        self._file.write(np.array(self._moves, dtype=MOVE_DTYPE).tobytes())
+        self._moves = None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def find_spawn(merged_grid: np.ndarray, new_grid: np.ndarray):
+    """
+    Find the tile that spawned after a move, given the grid after merging and the grid after spawning.
+
+    :return: The ((row, column), value) of the new tile, or None if no tile spawned
+    """
+    cells = np.argwhere(np.asarray(merged_grid) != np.asarray(new_grid))
+    if len(cells) != 1:
+        return None
+    r, c = cells[0]
+    return (int(r), int(c)), int(new_grid[r][c])
+
+
+class TrajectoryReader(object):
+    def __init__(self, path):
+        """Map a log file and index its games."""
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.zeros(0, np.uint8)
+        if bytes(self._data[:len(_MAGIC)]) != _MAGIC:
+            raise ValueError("%s is not a trajectory log." % path)
+
+        offsets = []
+        offset = len(_MAGIC)
+        while offset + _GAME_HEADER.size <= len(self._data):
+            magic, _, label_length, num_moves, _, _ = _GAME_HEADER.unpack_from(self._data, offset)
+            end = offset + _GAME_HEADER.size + label_length + num_moves * MOVE_DTYPE.itemsize
+            if magic != b'GAME' or end > len(self._data):
+                # A game cut short by a crash; everything before it is intact
+                break
+            offsets.append(offset)
+            offset = end
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def game(self, i):
+        """
+        Read one game.
+
+        :return: A dictionary of the game's "rules", "label", "initial_grid", "final_score" and "moves", a MOVE_DTYPE
+                 array backed by the memory map
+        """
+        offset = int(self.offsets[i])
+        _, rules, label_length, num_moves, initial, final_score = _GAME_HEADER.unpack_from(self._data, offset)
+        offset += _GAME_HEADER.size
+        label = bytes(self._data[offset:offset + label_length]).decode()
+        offset += label_length
+        moves = self._data[offset:offset + num_moves * MOVE_DTYPE.itemsize].view(MOVE_DTYPE)
+        return {"rules": rules, "label": label, "initial_grid": engine.unpack_grid(initial),
+                "final_score": final_score, "moves": moves}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.game(i)
+
+    def all_moves(self):
+        """
+        Every move of every game, for bulk analysis.
+
+        :return: A tuple of (moves, game_index), where game_index[j] is the index of the game moves[j] belongs to
+        """
+        games = [self.game(i)["moves"] for i in range(len(self))]
+        lengths = [len(moves) for moves in games]
+        return (np.concatenate(games) if games else np.zeros(0, MOVE_DTYPE),
+                np.repeat(np.arange(len(games)), lengths))
+
+
+def decode_moves(moves: np.ndarray):
+    """
+    Unpack the flags of a MOVE_DTYPE array.
+
+    :return: A dictionary of arrays: "move" (an index into AI._MOVES), "spawned", "spawn_value" (0 if nothing
+             spawned), "spawn_row", "spawn_column", "score_delta" and "think_time"
+    """
+    flags = moves['flags']
+    spawned = (flags & 0x4) != 0
+    cell = flags >> 4
+    return {"move": flags & 0x3, "spawned": spawned, "spawn_value": np.where(spawned, 2 << ((flags >> 3) & 1), 0),
+            "spawn_row": cell // 4, "spawn_column": cell % 4, "score_delta": moves['score_delta'],
+            "think_time": moves['think_time'].astype(float)}
+
+
+def replay(game: dict):
+    """
+    Replay a logged game.
+
+    :return: A generator of the (grid, score) after each move, starting with the initial grid
+    """
+    grid = game["initial_grid"]
+    score = 0
+    yield grid, score
+    decoded = decode_moves(game["moves"])
+    for i in range(len(game["moves"])):
+        move = AI._MOVES[decoded["move"][i]]
+        if game["rules"] == QUICK_MERGE_RULES:
+            grid, gained = AI.quick_merge(grid, move, 0)
+        else:
+            grid, gained = engine.game_merge(grid, move)
+        if decoded["spawned"][i]:
+            grid[decoded["spawn_row"][i], decoded["spawn_column"][i]] = decoded["spawn_value"][i]
+        score += gained
+        yield grid, score
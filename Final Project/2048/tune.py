@@ -0,0 +1,181 @@
+"""Tune the constants of AI.expert_score with CMA-ES.
+
+A candidate vector of constants is scored by the average final score of headless games played by the one-ply
+"expert" heuristic (the move whose resulting grid has the best expert_score). Every candidate of a generation plays
+the same tile spawn seeds, so candidates are compared on the same games, and all of a generation's games are played
+as one parallel batch. The search runs over log(constant / default), which keeps every constant positive.
+
+The state of the search is saved after every generation, and a run with the same checkpoint file continues where it
+left off. The best vector so far is written as a JSON list, ready for `--expert_weights`.
+
+Run with `python tune.py [-g|--generations GENERATIONS] [-n|--num_games NUM_GAMES] [-j|--workers WORKERS]
+[--popsize POPSIZE] [--sigma SIGMA] [--seed SEED] [--checkpoint CHECKPOINT] [-o|--out OUT]`."""
+
+import os
+import sys
+import json
+import random
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+
+import AI
+import headless
+
+
+class CMAES(object):
+    """A minimal (mu/mu_w, lambda)-CMA-ES, after Hansen's "The CMA Evolution Strategy: A Tutorial". Maximizes."""
+
+    def __init__(self, mean, sigma, popsize=None):
+        n = len(mean)
+        self.mean = np.array(mean, dtype=float)
+        self.sigma = float(sigma)
+        self.popsize = popsize or 4 + int(3 * np.log(n))
+        self.C = np.eye(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.generation = 0
+
+        mu = self.popsize // 2
+        weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+    def ask(self, rng: np.random.Generator):
+        """Sample a generation of candidates."""
+        eigenvalues, B = np.linalg.eigh(self.C)
+        D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        z = rng.standard_normal((self.popsize, len(self.mean)))
+        return self.mean + self.sigma * (z * D) @ B.T
+
+    def tell(self, candidates: np.ndarray, fitness):
+        """Update the distribution from the candidates of a generation and their fitness (higher is better)."""
+        n = len(self.mean)
+        order = np.argsort(fitness)[::-1][:len(self.weights)]
+        old_mean = self.mean
+        self.mean = self.weights @ candidates[order]
+
+        eigenvalues, B = np.linalg.eigh(self.C)
+        inv_sqrt_C = B @ np.diag(1 / np.sqrt(np.maximum(eigenvalues, 1e-20))) @ B.T
+        step = (self.mean - old_mean) / self.sigma
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_C @ step
+        hsig = np.linalg.norm(self.ps) / np.sqrt(1 - (1 - self.cs) ** (2 * (self.generation + 1))) / self.chi_n < \
+            1.4 + 2 / (n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * step
+
+        steps = (candidates[order] - old_mean) / self.sigma
+        self.C = (1 - self.c1 - self.cmu) * self.C + \
+            self.c1 * (np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C) + \
+            self.cmu * (steps.T * self.weights) @ steps
+        self.sigma *= np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1))
+        self.generation += 1
+
+    def state(self):
+        return {"mean": self.mean.tolist(), "sigma": self.sigma, "popsize": self.popsize, "C": self.C.tolist(),
+                "pc": self.pc.tolist(), "ps": self.ps.tolist(), "generation": self.generation}
+
+    @classmethod
+    def from_state(cls, state: dict):
+        es = cls(state["mean"], state["sigma"], state["popsize"])
+        es.C = np.array(state["C"])
+        es.pc = np.array(state["pc"])
+        es.ps = np.array(state["ps"])
+        es.generation = state["generation"]
+        return es
+
+
+def to_weights(x):
+    """Map a point of the search space to a vector of expert_score constants."""
+    return [float(w) for w in np.array(AI.DEFAULT_EXPERT_WEIGHTS) * np.exp(x)]
+
+
+def play_expert_game(args):
+    """Play one headless game with the one-ply expert heuristic and the given constants; returns the final score."""
+    weights, seed = args
+    tie_breaker = random.Random(seed)
+
+    def choose_move(grid, score):
+        moves = AI.valid_moves(grid)
+        values = AI.expert_score(np.stack([AI.quick_merge(grid, move) for move in moves]), weights)
+        return moves[tie_breaker.choice(np.flatnonzero(values == values.max()))]
+
+    return headless.play_game(choose_move, seed=seed)["score"]
+
+
+def tune(generations=50, num_games=16, workers=None, popsize=None, sigma=0.3, seed=0, checkpoint=None, out=None):
+    """
+    Tune the expert_score constants.
+
+    :param generations: The total number of generations to run, including those of a resumed run
+    :param num_games: The number of games each candidate plays per generation
+    :param workers: The number of processes playing games; one per CPU if not supplied
+    :param popsize: The number of candidates per generation; CMA-ES's default if not supplied
+    :param sigma: The initial step size, in log space
+    :param seed: The seed of the candidates and of the games' tile spawns
+    :param checkpoint: A JSON file to save the search state to, and to resume from if it exists
+    :param out: A JSON file to write the best constants to
+    :return: A tuple of the best constants and their average score
+    """
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        es = CMAES.from_state(state["es"])
+        best, best_score = state["best"], state["best_score"]
+        print("Resuming at generation %d." % es.generation)
+    else:
+        es = CMAES(np.zeros(len(AI.DEFAULT_EXPERT_WEIGHTS)), sigma, popsize)
+        best, best_score = list(AI.DEFAULT_EXPERT_WEIGHTS), float('-inf')
+
+    with mp.Pool(workers) as pool:
+        while es.generation < generations:
+            rng = np.random.default_rng([seed, es.generation])
+            candidates = es.ask(rng)
+            seeds = [int(s) for s in rng.integers(2 ** 31, size=num_games)]
+
+            # One batch for the whole generation, with common spawn seeds across candidates
+            jobs = [(to_weights(x), s) for x in candidates for s in seeds]
+            scores = np.array(pool.map(play_expert_game, jobs)).reshape(len(candidates), num_games)
+            fitness = scores.mean(axis=1)
+            es.tell(candidates, fitness)
+
+            generation_best = int(np.argmax(fitness))
+            if fitness[generation_best] > best_score:
+                best, best_score = to_weights(candidates[generation_best]), float(fitness[generation_best])
+            print("Generation %d: mean score %.0f, best %.0f, best so far %.0f, sigma %.3f" % (
+                es.generation, fitness.mean(), fitness[generation_best], best_score, es.sigma))
+
+            if out is not None:
+                with open(out, 'w') as f:
+                    json.dump(best, f)
+            if checkpoint is not None:
+                with open(checkpoint + '.tmp', 'w') as f:
+                    json.dump({"es": es.state(), "best": best, "best_score": best_score}, f)
+                os.replace(checkpoint + '.tmp', checkpoint)
+
+    print("Best constants:", best)
+    return best, best_score
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the constants of the expert heuristic with CMA-ES.")
+    parser.add_argument('-g', "--generations", nargs='?', default=50, type=int)
+    parser.add_argument('-n', "--num_games", nargs='?', default=16, type=int)
+    parser.add_argument('-j', "--workers", nargs='?', default=None, type=int)
+    parser.add_argument("--popsize", nargs='?', default=None, type=int)
+    parser.add_argument("--sigma", nargs='?', default=0.3, type=float)
+    parser.add_argument("--seed", nargs='?', default=0, type=int)
+    parser.add_argument("--checkpoint", nargs='?', default="tune_state.json", type=str)
+    parser.add_argument('-o', "--out", nargs='?', default="expert_weights.json", type=str)
+    kwargs = vars(parser.parse_args(sys.argv[1:]))
+    tune(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
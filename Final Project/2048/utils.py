@@ -2,10 +2,8 @@ import os
 import tempfile
 import time
 
-import pygame
-
 # Accurate timer for platform.
-timer = [time.time, time.clock][os.name == 'nt']
+timer = time.perf_counter
 
 # Get the temp file dir.
 tempdir = tempfile.gettempdir()
@@ -19,6 +17,7 @@ def center(total, size):
 def load_font(name, size, cache={}):
     if (name, size) in cache:
         return cache[name, size]
+    import pygame
     if name.startswith('SYS:'):
         font = pygame.font.SysFont(name[4:], size)
     else:
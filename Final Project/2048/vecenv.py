@@ -0,0 +1,131 @@
+"""A vectorized, gym-style environment of many 2048 games at once.
+
+The games are held as one array of tile exponents, one byte per cell (0 for an empty cell, 1 for a 2, ...), and
+every step is a handful of array operations over all of them: moves are made by engine.move_exponents, which follows
+the merge and score rules of AI.quick_merge on boards of any size, and tiles spawn as in headless games (one tile per
+move on a random free cell, a 4 with probability 1/11). Each game draws its spawns from its own SplitMix64 stream, so
+a game's tiles depend only on its seed and its moves, not on the other games of the batch."""
+
+import numpy as np
+
+import AI
+import engine
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _splitmix64(state: np.ndarray):
+    """
+    Advance SplitMix64 generators.
+
+    :return: A tuple of (new_state, output), the next 64-bit output of each generator
+    """
+    with np.errstate(over='ignore'):
+        state = state + _GOLDEN_GAMMA
+        z = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return state, z ^ (z >> np.uint64(31))
+
+
+class VecEnv2048(object):
+    def __init__(self, num_games, shape=(4, 4)):
+        """
+        Create the games; call reset before stepping them.
+
+        :param num_games: The number of games played at once
+        :param shape: The (rows, columns) of the boards
+        """
+        self.num_games = num_games
+        self.shape = tuple(shape)
+        self.boards = np.zeros((num_games,) + self.shape, dtype=np.uint8)
+        self.scores = np.zeros(num_games, dtype=np.int64)
+        self.moves = np.zeros(num_games, dtype=np.int64)
+        # The last board and score of every game that finished in the last step
+        self.final_boards = np.zeros_like(self.boards)
+        self.final_scores = np.zeros_like(self.scores)
+        self._rng_state = np.zeros(num_games, dtype=np.uint64)
+
+    def reset(self, seeds=None):
+        """
+        Start new games.
+
+        :param seeds: One seed per game, a single seed from which every game's seed is derived, or None for random
+                      seeds
+        :return: A tuple of (boards, legal), as returned by step
+        """
+        if seeds is None or np.ndim(seeds) == 0:
+            seeds = np.random.default_rng(seeds).integers(2 ** 63, size=self.num_games)
+        self._rng_state[:] = np.asarray(seeds, dtype=np.uint64)
+        self._new_games(np.ones(self.num_games, dtype=bool))
+        return self.boards.copy(), self.legal_moves()
+
+    def _new_games(self, games: np.ndarray):
+        self.boards[games] = 0
+        self.scores[games] = 0
+        self.moves[games] = 0
+        self._spawn(games)
+        self._spawn(games)
+
+    def _spawn(self, games: np.ndarray):
+        """Spawn a tile on a random free cell of each of the 'games' (a boolean mask), where there is one."""
+        cells = self.boards.reshape(self.num_games, -1)
+        empty = cells == 0
+        num_empty = empty.sum(axis=1)
+        games = games & (num_empty > 0)
+        if not games.any():
+            return
+        self._rng_state[games], random = _splitmix64(self._rng_state[games])
+
+        # Pick the k-th free cell, and a 4 with probability 1/11, by multiplying 32-bit halves of the output
+        k = ((random >> np.uint64(32)) * num_empty[games].astype(np.uint64)) >> np.uint64(32)
+        is_four = (((random & np.uint64(0xFFFFFFFF)) * np.uint64(11)) >> np.uint64(32)) == 0
+        cell = np.argmax(np.cumsum(empty[games], axis=1) > k[:, None].astype(np.int64), axis=1)
+        cells[np.flatnonzero(games), cell] = np.where(is_four, 2, 1)
+
+    def legal_moves(self):
+        """
+        The legal moves of every game.
+
+        :return: A boolean array of shape (num_games, 4), with the moves in the order of AI._MOVES
+        """
+        return engine.legal_moves(self.boards)
+
+    def step(self, actions):
+        """
+        Make one move in every game. An illegal move leaves its game unchanged, with no reward and no new tile.
+        Games with no legal moves left are finished and immediately replaced by new games: their last board and score
+        are kept in final_boards and final_scores, and their entries of the returned boards and legal moves are those
+        of the new game.
+
+        :param actions: One move per game, as indices into AI._MOVES ("Up", "Down", "Left", "Right")
+        :return: A tuple of (boards, rewards, done, legal): the boards as tile exponents, of shape
+                 (num_games, rows, columns); the score gained by each move; whether each game finished; and the legal
+                 moves of each board, as returned by legal_moves
+        """
+        actions = np.asarray(actions)
+        rewards = np.zeros(self.num_games, dtype=np.int64)
+        moved = np.zeros(self.num_games, dtype=bool)
+        for d in range(len(AI._MOVES)):
+            games = np.flatnonzero(actions == d)
+            if len(games) == 0:
+                continue
+            self.boards[games], rewards[games], moved[games] = engine.move_exponents(self.boards[games],
+                                                                                     AI._MOVES[d])
+
+        self._spawn(moved)
+        self.scores += rewards
+        self.moves += moved
+        legal = self.legal_moves()
+        done = ~legal.any(axis=1)
+
+        if done.any():
+            self.final_boards[done] = self.boards[done]
+            self.final_scores[done] = self.scores[done]
+            # The next game continues the finished game's random stream
+            self._new_games(done)
+            legal[done] = self.legal_moves()[done]
+        return self.boards.copy(), rewards, done, legal
+
+    def grids(self):
+        """The boards as tile values, as in Game2048.grid."""
+        return np.where(self.boards > 0, 1 << self.boards.astype(np.int64), 0)
@@ -0,0 +1,86 @@
+"""Zobrist hashing of 2048 boards.
+
+Every (cell, tile exponent) pair gets a random 64-bit key, and a board hashes to the XOR of the keys of its tiles, with
+empty cells contributing nothing. A spawned tile updates a hash with a single XOR (add_tile). A move may change any
+cell, and finding the cells it did change costs more in Python than hashing the new board outright, so boards after a
+move are hashed in full (hash).
+
+Tables are shared per board shape (see table), so that hashes agree across every search structure of a process. Set
+the environment variable ZOBRIST_AUDIT=1 to audit them: every hash is then checked against a full rehash and against
+every other board seen with the same hash, and collisions are counted."""
+
+import os
+
+import numpy as np
+
+import engine
+
+# Tables are seeded, so that hashes are also the same from one run to the next
+_SEED = 2048
+
+_tables = {}
+
+
+class ZobristTable(object):
+    def __init__(self, shape=(4, 4), seed=_SEED, audit=False):
+        """
+        :param shape: The (rows, columns) of the boards
+        :param seed: The seed of the random keys
+        :param audit: Whether to check every hash, see the module docstring
+        """
+        self.shape = tuple(shape)
+        size = self.shape[0] * self.shape[1]
+        rng = np.random.default_rng(seed)
+        self.keys = rng.integers(0, 2 ** 64, size=(size, 1 << engine.ROW_BITS), dtype=np.uint64)
+        self.keys[:, 0] = 0
+        self._keys = self.keys.tolist()
+
+        self.audit = audit
+        self.collisions = 0
+        self._seen = {}
+
+    def hash(self, grid: np.ndarray):
+        """The hash of a grid, as a Python int."""
+        key = 0
+        for cell, value in enumerate(np.asarray(grid).ravel().tolist()):
+            if value:
+                key ^= self._keys[cell][value.bit_length() - 1]
+        if self.audit:
+            self._check(key, grid)
+        return key
+
+    def add_tile(self, key: int, position, value, grid: np.ndarray = None):
+        """
+        The hash of a grid after a tile spawns on an empty cell.
+
+        :param position: The (row, column) of the new tile
+        :param grid: The grid after the spawn; only needed to audit the hash
+        """
+        key ^= self._keys[position[0] * self.shape[1] + position[1]][int(value).bit_length() - 1]
+        if self.audit and grid is not None:
+            self._check(key, grid)
+        return key
+
+    def _check(self, key: int, grid: np.ndarray):
+        grid = np.asarray(grid)
+        audit, self.audit = self.audit, False
+        expected = self.hash(grid)
+        self.audit = audit
+        if key != expected:
+            raise ValueError("Incremental Zobrist hash %#x of %s should be %#x." % (key, grid.tolist(), expected))
+        board = grid.astype(np.int64).tobytes()
+        if self._seen.setdefault(key, board) != board:
+            self.collisions += 1
+
+
+def table(shape=(4, 4)):
+    """The shared table for boards of a shape."""
+    shape = tuple(shape)
+    if shape not in _tables:
+        _tables[shape] = ZobristTable(shape, audit=os.environ.get("ZOBRIST_AUDIT", "") not in ["", "0"])
+    return _tables[shape]
+
+
+def hash_grid(grid: np.ndarray):
+    """The hash of a grid with the shared table of its shape."""
+    return table(np.shape(grid)).hash(grid)
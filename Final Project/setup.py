@@ -23,6 +23,8 @@ setup(
 
     },
     install_requires=['pygame', 'appdirs'],
+    # Module __getattr__ needs 3.7, and the shared-memory workers and sweeps 3.8
+    python_requires='>=3.8',
 
     author='quantum',
     author_email='quantum2048@gmail.com',
@@ -41,12 +43,11 @@ setup(
         'Operating System :: Microsoft :: Windows',
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Games/Entertainment',
     ],
 )